@@ -0,0 +1 @@
+default_app_config = 'tom_education.apps.TomEducationConfig'
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class TomEducationConfig(AppConfig):
     name = 'tom_education'
+
+    def ready(self):
+        import tom_education.signals  # noqa: F401
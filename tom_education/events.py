@@ -0,0 +1,199 @@
+"""
+Publish/subscribe notifications of changes to asynchronous processes, which
+are pushed to browsers as server-sent events instead of having them poll the
+status APIs.
+
+Events are dicts with 'type' and 'data' keys, published on channels named
+'target.<pk>' (status changes of all processes for a target) and
+'process.<pk>' (status changes and log lines of a single process)
+"""
+import json
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds of inactivity after which a keep-alive comment is sent on an event
+# stream, so that proxies do not close the connection
+HEARTBEAT_INTERVAL = 15
+# Default number of seconds after which an event stream is closed (see the
+# 'event_stream_duration' pipeline setting). Browsers reconnect
+# automatically, so this just bounds how long each request holds a server
+# worker
+STREAM_DURATION = 300
+# Milliseconds browsers should wait before reconnecting
+RECONNECT_DELAY = 3000
+
+_event_broker = None
+
+
+class LocalEventBroker:
+    """
+    Event broker which delivers events to subscribers in the same process
+    only. This is used in tests, and is only suitable for single-process
+    development servers otherwise
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Map channel names to sets of subscriber queues
+        self.queues = {}
+
+    def publish(self, channel, event):
+        with self.lock:
+            queues = list(self.queues.get(channel, ()))
+        for q in queues:
+            q.put((channel, event))
+
+    def subscribe(self, channels):
+        subscription = LocalSubscription(self, channels)
+        with self.lock:
+            for channel in channels:
+                self.queues.setdefault(channel, set()).add(subscription.queue)
+        return subscription
+
+
+class LocalSubscription:
+    def __init__(self, broker, channels):
+        self.broker = broker
+        self.channels = channels
+        self.queue = queue.Queue()
+
+    def get(self, timeout):
+        """
+        Return the next (channel, event) tuple, or None if no event arrives
+        within `timeout` seconds
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self.broker.lock:
+            for channel in self.channels:
+                queues = self.broker.queues.get(channel, set())
+                queues.discard(self.queue)
+                if not queues:
+                    self.broker.queues.pop(channel, None)
+
+
+class RedisEventBroker:
+    """
+    Event broker using Redis pub/sub, which delivers events published by any
+    process (e.g. dramatiq workers) to subscribers in web server processes
+    """
+    def __init__(self, url='redis://localhost:6379', prefix='tom_education:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def publish(self, channel, event):
+        self.client.publish(self.prefix + channel, json.dumps(event))
+
+    def subscribe(self, channels):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*(self.prefix + channel for channel in channels))
+        return RedisSubscription(pubsub, self.prefix)
+
+
+class RedisSubscription:
+    def __init__(self, pubsub, prefix):
+        self.pubsub = pubsub
+        self.prefix = prefix
+
+    def get(self, timeout):
+        message = self.pubsub.get_message(timeout=timeout)
+        if message is None:
+            return None
+        channel = message['channel'].decode()[len(self.prefix):]
+        return channel, json.loads(message['data'])
+
+    def close(self):
+        self.pubsub.close()
+
+
+def get_event_broker():
+    """
+    Return the broker configured with the 'event_broker' pipeline setting, or
+    None if events are not enabled
+    """
+    global _event_broker
+    if _event_broker is None:
+        pipeline_settings = getattr(settings, 'TOM_EDUCATION_PIPELINE_SETTINGS', {})
+        config = pipeline_settings.get('event_broker')
+        if config is None:
+            return None
+        _event_broker = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+    return _event_broker
+
+
+def clear_event_broker():
+    global _event_broker
+    _event_broker = None
+
+
+def publish(channels, event_type, data):
+    """
+    Publish an event on each of `channels` once the current transaction (if
+    any) commits, so that subscribers which react to the event by querying
+    the database see the change. Errors are logged rather than raised, so
+    that saving a process never fails because of this
+    """
+    broker = get_event_broker()
+    if broker is None:
+        return
+    event = {'type': event_type, 'data': data}
+
+    def send():
+        for channel in channels:
+            try:
+                broker.publish(channel, event)
+            except Exception as ex:
+                logger.warning(f'Could not publish event on {channel}: {ex}')
+
+    transaction.on_commit(send)
+
+
+class EventStream:
+    """
+    Iterator of server-sent event messages (as bytes) for the events received
+    by a subscription, for use as the content of a StreamingHttpResponse. The
+    stream ends after `duration` seconds, and the subscription is closed when
+    the response is closed
+    """
+    def __init__(self, subscription, duration=STREAM_DURATION, heartbeat=HEARTBEAT_INTERVAL):
+        self.subscription = subscription
+        self.duration = duration
+        self.heartbeat = heartbeat
+        self.messages = self.generate()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.messages)
+
+    def generate(self):
+        yield f'retry: {RECONNECT_DELAY}\n\n'.encode()
+        deadline = time.monotonic() + self.duration
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            item = self.subscription.get(timeout=min(self.heartbeat, remaining))
+            if item is None:
+                yield b': keep-alive\n\n'
+                continue
+            _, event = item
+            yield f'event: {event["type"]}\ndata: {json.dumps(event["data"])}\n\n'.encode()
+
+    def close(self):
+        self.messages.close()
+        self.subscription.close()
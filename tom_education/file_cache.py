@@ -0,0 +1,164 @@
+import hashlib
+import os
+from pathlib import Path
+import tempfile
+import threading
+
+
+# FileCache objects shared by all users of each (directory, max_bytes) in this
+# process, so that their running sizes are kept between runs
+_file_caches = {}
+_file_caches_lock = threading.Lock()
+
+
+def get_file_cache(directory, max_bytes):
+    """
+    Return the shared FileCache for `directory` with size limit `max_bytes`,
+    creating it on first use
+    """
+    key = (str(directory), max_bytes)
+    with _file_caches_lock:
+        if key not in _file_caches:
+            _file_caches[key] = FileCache(directory, max_bytes)
+        return _file_caches[key]
+
+
+def clear_file_caches():
+    with _file_caches_lock:
+        _file_caches.clear()
+
+
+class FileCache:
+    """
+    A content-addressed cache of files in a directory on local disk, shared by
+    all processes using the same directory.
+
+    Entries are identified by a key (e.g. a hash of the content they were
+    derived from), and are evicted in least-recently-used order once the total
+    size of the cache exceeds `max_bytes` (if not None). The modification time
+    of each file is used to record when it was last used.
+
+    The total size is found by scanning the directory on the first insert, and
+    kept as a running total after that, so the directory is only scanned again
+    when the total goes over `max_bytes`. Entries added by other processes are
+    not counted until then
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.size = None
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        """
+        Return the path where the entry for `key` is (or would be) stored
+        """
+        return self.directory / key[:2] / key
+
+    def get(self, key):
+        """
+        Return the path to the entry for `key` and mark it as recently used, or
+        return None if there is no such entry
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def __contains__(self, key):
+        return self.path(key).exists()
+
+    def put(self, key, write, keep=()):
+        """
+        Add an entry for `key`. `write` is a function which is called with a
+        binary file object to write the contents of the entry. Returns the
+        path to the new entry. Entries whose keys are in `keep` are only
+        evicted to make space for the new entry if the cache would still be
+        over `max_bytes` otherwise (see evict()). If `key` is None, the SHA-256 hex
+        digest of the contents is used, which is computed as they are written
+        (the key is the name of the returned path).
+
+        The entry is written to a temporary file and moved into place, so other
+        processes never see partially written entries
+        """
+        tmp_dir = self.path(key).parent if key else self.directory
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=tmp_dir, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                if key:
+                    write(tmp_file)
+                else:
+                    hashing_file = HashingWriter(tmp_file)
+                    write(hashing_file)
+                    key = hashing_file.hexdigest()
+            path = self.path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_name, path)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+        if self.max_bytes is not None:
+            with self.lock:
+                if self.size is not None:
+                    self.size += path.stat().st_size
+                if self.size is None or self.size > self.max_bytes:
+                    self.size = self.evict(keep=keep, pinned={key})
+        return path
+
+    def evict(self, keep=(), pinned=()):
+        """
+        Delete least recently used entries, other than those whose keys are in
+        `keep`, until the total size of the cache is at most `max_bytes`. If
+        that is not enough, entries in `keep` are deleted too, so the size of
+        the cache stays bounded however many entries callers ask to keep.
+        Entries whose keys are in `pinned` are never deleted.
+
+        Returns the total size of the remaining entries
+        """
+        entries = []
+        total = 0
+        for path in self.directory.glob('*/*'):
+            if path.name.startswith('.tmp'):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        for protected in (set(keep) | set(pinned), set(pinned)):
+            remaining = []
+            for entry in entries:
+                _, size, path = entry
+                if total <= self.max_bytes or path.name in protected:
+                    remaining.append(entry)
+                    continue
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                total -= size
+            entries = remaining
+        return total
+
+
+class HashingWriter:
+    """
+    Wrapper for a binary file object which computes the SHA-256 digest of the
+    data written to it
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
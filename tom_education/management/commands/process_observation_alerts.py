@@ -5,7 +5,7 @@ from tom_dataproducts.models import DataProduct
 from tom_observations.facility import get_service_class
 
 from tom_education.constants import RAW_FILE_EXTENSION
-from tom_education.models import ObservationAlert, TimelapsePipeline
+from tom_education.models import AsyncError, ObservationAlert, TimelapsePipeline
 
 
 class Command(BaseCommand):
@@ -52,13 +52,13 @@ class Command(BaseCommand):
             except AsyncError as ex:
                 self.stderr.write(f'Failed to create timelapse: {ex}')
                 return
-            new_tl = new_pipeline.group.dataproduct_set.first()
 
-            # Delete old timelapses
+            # Delete old timelapses, keeping every variant created by the new
+            # pipeline
             # TODO: control deletion from settings.py
             timelapses = (DataProduct.objects
                                      .filter(target=target, data_product_type=settings.DATA_PRODUCT_TYPES['timelapse'][0])
-                                     .exclude(pk=new_tl.pk)
+                                     .exclude(group=new_pipeline.group)
                                      .all())
             for tl in timelapses:
                 tl.delete()
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.18 on 2026-10-16 18:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_dataproducts', '0008_auto_20191205_1952'),
+        ('tom_education', '0004_auto_20190925_1557'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataProductMetadata',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data_name', models.CharField(max_length=255)),
+                ('date_obs', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('filter', models.CharField(blank=True, max_length=50)),
+                ('exptime', models.FloatField(blank=True, null=True)),
+                ('naxis1', models.IntegerField(blank=True, null=True)),
+                ('naxis2', models.IntegerField(blank=True, null=True)),
+                ('data_product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='metadata', to='tom_dataproducts.dataproduct')),
+            ],
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 3.2.18 on 2026-10-16 18:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_logs_to_lines(apps, schema_editor):
+    PipelineProcess = apps.get_model('tom_education', 'PipelineProcess')
+    PipelineLogLine = apps.get_model('tom_education', 'PipelineLogLine')
+    for process in PipelineProcess.objects.exclude(logs__isnull=True).exclude(logs=''):
+        PipelineLogLine.objects.bulk_create([
+            PipelineLogLine(process=process, index=i, text=text)
+            for i, text in enumerate(process.logs.splitlines(keepends=True))
+        ])
+
+
+def copy_lines_to_logs(apps, schema_editor):
+    PipelineProcess = apps.get_model('tom_education', 'PipelineProcess')
+    for process in PipelineProcess.objects.all():
+        lines = process.log_lines.order_by('index').values_list('text', flat=True)
+        process.logs = ''.join(lines)
+        process.save(update_fields=['logs'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_education', '0006_dataproductmetadata_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PipelineLogLine',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('text', models.TextField()),
+                ('process', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='log_lines', to='tom_education.pipelineprocess')),
+            ],
+            options={
+                'unique_together': {('process', 'index')},
+            },
+        ),
+        migrations.RunPython(copy_logs_to_lines, copy_lines_to_logs),
+        migrations.RemoveField(
+            model_name='pipelineprocess',
+            name='logs',
+        ),
+    ]
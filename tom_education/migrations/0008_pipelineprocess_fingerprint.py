@@ -0,0 +1,18 @@
+# Generated by Django 3.2.18 on 2026-10-16 19:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_education', '0007_pipelinelogline'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipelineprocess',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
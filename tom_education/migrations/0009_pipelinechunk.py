@@ -0,0 +1,30 @@
+# Generated by Django 3.2.18 on 2026-10-16 19:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_dataproducts', '0008_auto_20191205_1952'),
+        ('tom_education', '0008_pipelineprocess_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PipelineChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('status', models.CharField(default='pending', max_length=50)),
+                ('failure_message', models.CharField(blank=True, max_length=255)),
+                ('result_json', models.TextField(blank=True)),
+                ('input_files', models.ManyToManyField(related_name='_tom_education_pipelinechunk_input_files_+', to='tom_dataproducts.DataProduct')),
+                ('process', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='tom_education.pipelineprocess')),
+            ],
+            options={
+                'unique_together': {('process', 'index')},
+            },
+        ),
+    ]
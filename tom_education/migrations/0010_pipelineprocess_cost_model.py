@@ -0,0 +1,33 @@
+# Generated by Django 3.2.18 on 2026-10-16 19:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_education', '0009_pipelinechunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipelineprocess',
+            name='duration',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pipelineprocess',
+            name='estimated_duration',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pipelineprocess',
+            name='input_bytes',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pipelineprocess',
+            name='started',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
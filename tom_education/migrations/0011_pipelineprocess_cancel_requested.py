@@ -0,0 +1,18 @@
+# Generated by Django 3.2.18 on 2026-10-16 19:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_education', '0010_pipelineprocess_cost_model'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipelineprocess',
+            name='cancel_requested',
+            field=models.BooleanField(default=False),
+        ),
+    ]
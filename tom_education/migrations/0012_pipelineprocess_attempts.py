@@ -0,0 +1,18 @@
+# Generated by Django 3.2.18 on 2026-10-16 19:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_education', '0011_pipelineprocess_cancel_requested'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipelineprocess',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.18 on 2026-10-16 19:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_education', '0012_pipelineprocess_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='asyncprocess',
+            name='modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='asyncprocess',
+            index=models.Index(fields=['target', 'created'], name='tom_educati_target__14213e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='asyncprocess',
+            index=models.Index(fields=['target', 'modified'], name='tom_educati_target__1c6c2c_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.18 on 2026-10-16 19:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_education', '0013_asyncprocess_modified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipelineprocess',
+            name='reused_from',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='tom_education.pipelineprocess'),
+        ),
+    ]
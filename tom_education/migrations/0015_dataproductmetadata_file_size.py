@@ -0,0 +1,18 @@
+# Generated by Django 3.2.18 on 2026-10-16 19:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_education', '0014_pipelineprocess_reused_from'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataproductmetadata',
+            name='file_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
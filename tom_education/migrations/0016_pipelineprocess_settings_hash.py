@@ -0,0 +1,18 @@
+# Generated by Django 3.2.18 on 2026-10-16 19:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_education', '0015_dataproductmetadata_file_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipelineprocess',
+            name='settings_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from tom_education.models.async_process import *
+from tom_education.models.data_product_metadata import *
 from tom_education.models.observation_alert import *
 from tom_education.models.observation_template import *
 from tom_education.models.pipelines import *
@@ -3,12 +3,15 @@ from datetime import datetime
 from django.db import models
 from tom_targets.models import Target
 
+from tom_education.events import publish
+
 
 # Statuses for asynchronous processes
 ASYNC_STATUS_PENDING = 'pending'
 ASYNC_STATUS_CREATED = 'created'
 ASYNC_STATUS_FAILED = 'failed'
-ASYNC_TERMINAL_STATES = (ASYNC_STATUS_CREATED, ASYNC_STATUS_FAILED)
+ASYNC_STATUS_CANCELLED = 'cancelled'
+ASYNC_TERMINAL_STATES = (ASYNC_STATUS_CREATED, ASYNC_STATUS_FAILED, ASYNC_STATUS_CANCELLED)
 
 
 class AsyncError(Exception):
@@ -17,10 +20,19 @@ class AsyncError(Exception):
     """
 
 
+class ProcessCancelled(Exception):
+    """
+    An asynchronous process stopped because cancellation was requested
+    """
+
+
 class AsyncProcess(models.Model):
     process_type = models.CharField(null=True, blank=True, max_length=100)
     identifier = models.CharField(null=False, blank=False, max_length=100, unique=True)
     created = models.DateTimeField(auto_now_add=True)
+    # Time of the last change, so that clients can fetch only processes which
+    # have changed
+    modified = models.DateTimeField(auto_now=True)
     status = models.CharField(max_length=50, default=ASYNC_STATUS_PENDING)
     # Time at which the processes entered a terminal state
     terminal_timestamp = models.DateTimeField(null=True, blank=True)
@@ -28,6 +40,12 @@ class AsyncProcess(models.Model):
     # Process may optionally be associated with a target
     target = models.ForeignKey(Target, on_delete=models.CASCADE, null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['target', 'created']),
+            models.Index(fields=['target', 'modified']),
+        ]
+
     def clean(self):
         self.process_type = self.__class__.__name__
         if self.status in ASYNC_TERMINAL_STATES:
@@ -36,6 +54,23 @@ class AsyncProcess(models.Model):
     def save(self, *args, **kwargs):
         self.full_clean()
         super().save(*args, **kwargs)
+        self.notify_status()
+
+    def get_event_channels(self):
+        """
+        Return the names of the channels on which events about this process
+        are published (see tom_education.events)
+        """
+        channels = [f'process.{self.pk}']
+        if self.target_id is not None:
+            channels.append(f'target.{self.target_id}')
+        return channels
+
+    def notify_status(self):
+        """
+        Publish an event saying that the status of this process has changed
+        """
+        publish(self.get_event_channels(), 'status', {'identifier': self.identifier, 'status': self.status})
 
     def run(self):
         """
@@ -0,0 +1,208 @@
+from datetime import datetime
+import hashlib
+import logging
+from pathlib import Path, PurePath
+
+from astropy.io import fits
+from django.conf import settings
+from django.core.files import File
+from django.db import models
+from django.utils import timezone
+from tom_dataproducts.models import DataProduct
+
+
+logger = logging.getLogger(__name__)
+
+# Header keyword whose value is stored in DataProductMetadata.date_obs
+DATE_FIELD = 'DATE-OBS'
+# Filename suffixes of files for which FITS headers are read
+FITS_SUFFIXES = ('.fits', '.fz')
+
+
+class DataProductMetadata(models.Model):
+    """
+    Information about a DataProduct's file, extracted once when the product is
+    ingested so that it can be queried (e.g. to sort timelapse frames) without
+    reading the file again.
+
+    `content_hash` is computed on demand by get_content_hash() (or when a
+    pipeline uploads an output), since it requires reading the whole file.
+    `file_size` is stored for all files; the other fields come from FITS
+    headers and are only set for FITS files
+    """
+    data_product = models.OneToOneField(DataProduct, on_delete=models.CASCADE, related_name='metadata')
+    # Name of the file the metadata was read from, used to detect when the file
+    # for the data product changes
+    data_name = models.CharField(max_length=255)
+    # SHA-256 hex digest of the file contents, or empty if not computed yet
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    # Size of the file in bytes, so that the total size of pipeline inputs can
+    # be found without querying the storage backend
+    file_size = models.BigIntegerField(null=True, blank=True)
+    date_obs = models.DateTimeField(null=True, blank=True, db_index=True)
+    filter = models.CharField(max_length=50, blank=True)
+    exptime = models.FloatField(null=True, blank=True)
+    naxis1 = models.IntegerField(null=True, blank=True)
+    naxis2 = models.IntegerField(null=True, blank=True)
+
+    def is_current(self, product):
+        """
+        Return True if this metadata was extracted from the current file for
+        `product`
+        """
+        return self.data_name == product.data.name
+
+    @classmethod
+    def index(cls, product, path=None, content_hash=None):
+        """
+        Read the size and FITS headers of a data product's file and create or
+        update its metadata. Returns the DataProductMetadata object. If the
+        FITS headers cannot be read, the fields from them are left empty.
+
+        The rest of the file is not read: `content_hash` is set if given, kept
+        if the file has not changed, and otherwise cleared. `path` is a local
+        copy of the file to read instead of the one in the storage backend
+        """
+        values = {'data_name': product.data.name}
+        if content_hash is None:
+            content_hash = cls.objects.filter(
+                data_product=product, data_name=product.data.name
+            ).values_list('content_hash', flat=True).first()
+        values['content_hash'] = content_hash or ''
+        try:
+            values['file_size'] = Path(path).stat().st_size if path else product.data.size
+        except (OSError, ValueError) as ex:
+            logger.warning(f'Could not read the size of {product.data.name}: {ex}')
+            values['file_size'] = None
+        if product.data.name.endswith(FITS_SUFFIXES):
+            try:
+                values.update(read_fits_metadata(path or product.data.file))
+            except (OSError, ValueError) as ex:
+                logger.warning(f'Could not read FITS headers from {product.data.name}: {ex}')
+        metadata, _ = cls.objects.update_or_create(data_product=product, defaults=values)
+        return metadata
+
+
+def hash_file(fileobj):
+    """
+    Return the SHA-256 hex digest of the contents of a Django File object or
+    a local path, reading it in chunks
+    """
+    digest = hashlib.sha256()
+    if isinstance(fileobj, (str, PurePath)):
+        with open(fileobj, 'rb') as f:
+            for chunk in iter(lambda: f.read(File.DEFAULT_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    fileobj.open('rb')
+    try:
+        for chunk in fileobj.chunks():
+            digest.update(chunk)
+    finally:
+        fileobj.close()
+    return digest.hexdigest()
+
+
+def get_content_hash(product, compute=True):
+    """
+    Return the content hash for a DataProduct's file from its metadata. If it
+    has not been stored yet, the file is hashed and the result stored, or
+    None is returned if `compute` is False
+    """
+    metadata = get_current_metadata(product)
+    if metadata and metadata.content_hash:
+        return metadata.content_hash
+    if not compute:
+        return None
+    return store_content_hash(product, hash_file(product.data))
+
+
+def store_content_hash(product, content_hash):
+    """
+    Store the content hash for a DataProduct's file, e.g. when it was
+    computed while the file was being read for another purpose
+    """
+    metadata = get_current_metadata(product) or DataProductMetadata.index(product)
+    metadata.content_hash = content_hash
+    metadata.save(update_fields=['content_hash'])
+    return content_hash
+
+
+def get_current_metadata(product):
+    """
+    Return the DataProductMetadata for the current file of a DataProduct, or
+    None if it has not been indexed
+    """
+    try:
+        metadata = product.metadata
+    except DataProductMetadata.DoesNotExist:
+        return None
+    return metadata if metadata.is_current(product) else None
+
+
+def parse_fits_date(dt_str):
+    """
+    Parse a date string from a FITS header, and return a datetime that is
+    timezone-aware if time zone support is enabled. Raises ValueError if the
+    string is not a valid ISO format date
+    """
+    dt = datetime.fromisoformat(dt_str)
+    if settings.USE_TZ and timezone.is_naive(dt):
+        dt = timezone.make_aware(dt, timezone.utc)
+    return dt
+
+
+def read_fits_metadata(fits_file, date_field=DATE_FIELD):
+    """
+    Read metadata from the headers of a FITS file (a path or file-like object)
+    and return a dict of DataProductMetadata field values.
+
+    HDUs are loaded lazily and reading stops once the observation date and
+    image dimensions have been found, so data sections are not read. Missing
+    values are left as their defaults
+    """
+    values = {'date_obs': None, 'filter': '', 'exptime': None, 'naxis1': None, 'naxis2': None}
+    # Django File objects are reopened (and closed afterwards), since they
+    # may have been closed after a previous read
+    is_django_file = isinstance(fits_file, File)
+    if is_django_file:
+        fits_file.open('rb')
+    try:
+        with fits.open(fits_file, lazy_load_hdus=True) as hdul:
+            for hdu in hdul:
+                header = hdu.header
+                if not values['filter'] and 'FILTER' in header:
+                    values['filter'] = str(header['FILTER'])
+                if values['exptime'] is None and 'EXPTIME' in header:
+                    values['exptime'] = float(header['EXPTIME'])
+                if values['naxis1'] is None and header.get('NAXIS') == 2:
+                    values['naxis1'] = header['NAXIS1']
+                    values['naxis2'] = header['NAXIS2']
+                if values['date_obs'] is None and date_field in header:
+                    values['date_obs'] = parse_fits_date(header[date_field])
+                if values['date_obs'] is not None and values['naxis1'] is not None:
+                    break
+    finally:
+        if is_django_file:
+            fits_file.close()
+    return values
+
+
+def index_data_product(product):
+    """
+    Extract metadata for a newly saved DataProduct if it has a file and has
+    not already been indexed. Errors reading the file are logged rather than
+    raised, so that saving a data product never fails because of this
+    """
+    name = product.data.name if product.data else ''
+    if not name:
+        return
+    try:
+        if product.metadata.is_current(product):
+            return
+    except DataProductMetadata.DoesNotExist:
+        pass
+    try:
+        DataProductMetadata.index(product)
+    except Exception as ex:
+        logger.warning(f'Could not read metadata for {name}: {ex}')
@@ -1,21 +1,36 @@
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timedelta
+import hashlib
 import json
 import tempfile
+import threading
+import time
 from pathlib import Path
 import re
 import os.path
+import shutil
 
 from django.conf import settings
-from django.core.files.base import ContentFile
-from django.db import models
+from django.core.files import File
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
 from django.utils.module_loading import import_string
+from dramatiq.middleware.time_limit import TimeLimitExceeded
 from tom_dataproducts.models import DataProduct, ReducedDatum, DataProductGroup
 from astropy.time import Time
 
 
-from tom_education.models.async_process import AsyncError, AsyncProcess, ASYNC_STATUS_CREATED
+from tom_education.events import publish
+from tom_education.file_cache import FileCache, get_file_cache
+from tom_education.models.async_process import (
+    AsyncError, AsyncProcess, ASYNC_STATUS_CREATED, ASYNC_STATUS_FAILED, ASYNC_STATUS_PENDING,
+    ASYNC_TERMINAL_STATES, ProcessCancelled
+)
+from tom_education.models.data_product_metadata import (
+    DataProductMetadata, get_content_hash, hash_file, store_content_hash
+)
 from tom_education.utils import assert_valid_suffix
 
 
@@ -25,6 +40,24 @@ class InvalidPipelineError(Exception):
     """
 
 
+# Size of chunks to read when staging input files from storage
+STAGING_CHUNK_SIZE = 1024 ** 2
+
+# Number of ReducedDatum outputs to save per query
+REDUCED_DATUM_BATCH_SIZE = 1000
+
+# Number of recent runs of a pipeline used to estimate the run time of new ones
+COST_MODEL_RUNS = 20
+
+# Minimum time in seconds between checks for cancellation of a running process
+CANCEL_CHECK_INTERVAL = 1
+
+# Status of a map/reduce pipeline while the reduce step is running
+PIPELINE_STATUS_REDUCING = 'Combining chunk results'
+
+# Created on first use by PipelineProcess.get_registry()
+_pipeline_registry = None
+
 PipelineOutput = namedtuple('PipelineOutput', ['path', 'output_type', 'data_product_type','data'],
                             defaults=('',))  # data_product_type is optional
 
@@ -38,13 +71,97 @@ class PipelineProcess(AsyncProcess):
     short_name = 'pipeline'
     flags = None
     allowed_suffixes = None
+    # Version of the pipeline's processing, which should be increased when a
+    # change would give different outputs for the same inputs
+    version = 1
+    # Whether a run can reuse the outputs of a previous successful run with
+    # the same fingerprint
+    memoize = True
+    # Number of input files per chunk for pipelines which implement do_map()
+    # and do_reduce(), or None if the pipeline is run in a single step
+    chunk_size = None
+    # dramatiq queue and priority for tasks running this pipeline (lower
+    # numbers have higher priority), and the maximum number of these tasks
+    # that may run at once across all workers, or None for no limit
+    queue_name = 'default'
+    priority = 0
+    max_concurrency = None
+    # Whether intermediate results are saved to durable scratch space (see
+    # get_checkpoint_store()), and how many times a run which fails
+    # unexpectedly is retried to resume from them
+    checkpoints = False
+    max_retries = 0
+
+    # Index of the next log line to be written, set on the first call to
+    # log()
+    _next_log_index = None
+    # Time at which check_cancelled() last checked the database
+    _last_cancel_check = None
 
     input_files = models.ManyToManyField(DataProduct, related_name='pipeline')
     group = models.ForeignKey(DataProductGroup, null=True, blank=True, on_delete=models.SET_NULL)
-    logs = models.TextField(null=True, blank=True)
     flags_json = models.TextField(null=True, blank=True)
+    # Hash of the inputs, flags and pipeline version, used to find previous
+    # runs whose outputs can be reused
+    fingerprint = models.CharField(max_length=64, blank=True, db_index=True)
+    # Previous run whose outputs were reused by this process, if any. Reused
+    # runs share the group of the original, so are excluded from listings of
+    # outputs
+    reused_from = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    # Hash of the settings the outputs were made with, for pipelines whose
+    # outputs depend on settings, used to check whether a later run can build
+    # on them
+    settings_hash = models.CharField(max_length=64, blank=True)
+    # Total size of the input files, and the estimated and actual run time in
+    # seconds, used to set time limits and estimate the run time of later runs
+    input_bytes = models.BigIntegerField(null=True, blank=True)
+    estimated_duration = models.FloatField(null=True, blank=True)
+    started = models.DateTimeField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True)
+    # Set to ask a running process to stop at its next checkpoint
+    cancel_requested = models.BooleanField(default=False)
+    # Number of times the process has been started
+    attempts = models.PositiveIntegerField(default=0)
 
     def run(self):
+        self.check_inputs()
+        if self.reuse_previous_outputs():
+            return
+
+        self.check_cancelled(force=True)
+        self.start()
+        with tempfile.TemporaryDirectory() as tmpdir_name:
+            tmpdir = Path(tmpdir_name)
+
+            # Do the actual work
+            outputs = self.do_pipeline(tmpdir, **self.get_flags())
+            self.save_outputs(outputs)
+
+        self.finish()
+
+    def start(self):
+        """
+        Record the time at which processing started
+        """
+        self.started = timezone.now()
+        self.attempts += 1
+        self.save()
+
+    def finish(self):
+        """
+        Mark the process as successfully finished and record its run time
+        """
+        if self.started:
+            self.duration = (timezone.now() - self.started).total_seconds()
+        self.status = ASYNC_STATUS_CREATED
+        self.save()
+        self.clear_checkpoints()
+
+    def check_inputs(self):
+        """
+        Raise AsyncError if the process cannot be run with its target and
+        input files
+        """
         if self.target is None:
             raise AsyncError('Process must have an associated target')
         if not self.input_files.exists():
@@ -58,16 +175,43 @@ class PipelineProcess(AsyncProcess):
                 except AssertionError as ex:
                     raise AsyncError("Error running pipeline {}".format(ex))
 
-        with tempfile.TemporaryDirectory() as tmpdir_name:
-            tmpdir = Path(tmpdir_name)
+    def reuse_previous_outputs(self):
+        """
+        If memoization is enabled and a previous run has the same fingerprint,
+        use its outputs for this process and return True. Otherwise return
+        False
+        """
+        if not self.memoize:
+            return False
+        self.hash_input_files()
+        self.fingerprint = self.compute_fingerprint()
+        previous = self.get_memoized_run()
+        if not previous:
+            return False
+        self.log(f'Using outputs from previous run {previous.identifier}')
+        self.group = previous.group
+        self.reused_from = previous
+        self.settings_hash = previous.settings_hash
+        self.status = ASYNC_STATUS_CREATED
+        self.save()
+        return True
 
-            # Do the actual work
-            flags = json.loads(self.flags_json) if self.flags_json else {}
-            outputs = self.do_pipeline(tmpdir, **flags)
+    def get_flags(self):
+        return json.loads(self.flags_json) if self.flags_json else {}
 
-            # Save outputs
-            new_dps = []
+    def save_outputs(self, outputs):
+        """
+        Create DataProduct and ReducedDatum objects for the outputs returned
+        by do_pipeline() or do_reduce(), and collect new data products into a
+        group. If saving fails or the process is cancelled, data products
+        created so far are deleted
+        """
+        new_dps = []
+        uploads = []
+        reduced_data = []
+        try:
             for output in outputs:
+                self.check_cancelled()
                 if not isinstance(output, PipelineOutput):
                     output = PipelineOutput(*output)
 
@@ -75,52 +219,489 @@ class PipelineProcess(AsyncProcess):
 
                 if output_type == DataProduct:
                     identifier = f'{self.identifier}_{path.name}'
-                    prod = DataProduct.objects.create(product_id=identifier, target=self.target, data_product_type=data_product_type)
-                    prod.data.save(identifier, ContentFile(path.read_bytes()))
+                    prod = DataProduct.objects.create(product_id=identifier, target=self.target,
+                                                      data_product_type=data_product_type, extra_data=data or '')
+                    uploads.append((prod, identifier, path))
                     new_dps.append(prod)
 
                 elif output_type == ReducedDatum:
-                    identifier = f'{self.identifier}_{data[0]:.0f}'
-                    phot_data =  {
-                          'magnitude': data[1],
-                          'error': data[2]
-                        }
-                    t = Time(data[0], format='mjd', scale='utc')
-                    try:
-                        dp = DataProduct.objects.get(data=data[3])
-                    except Exception as e:
-                        dp = None
-                    rd, created = ReducedDatum.objects.get_or_create(
-                        target=self.target,
-                        data_product = dp,
-                        data_type=data_product_type,
-                        source_name=identifier,
-                        timestamp=t.to_value('datetime') ,
-                    )
-                    rd.value = json.dumps(phot_data)
-                    rd.save()
+                    reduced_data.append((data_product_type, data))
 
                 else:
                     raise AsyncError(f"Invalid output type '{output_type}'")
 
-            # Create a group to collect DataProduct outputs into
-            if new_dps:
-                self.group = DataProductGroup.objects.create(name=f'{self.identifier}_outputs')
-                for prod in new_dps:
-                    prod.group.add(self.group)
-                    prod.save()
+            if uploads:
+                self.upload_outputs(uploads)
+            self.check_cancelled(force=True)
+        except Exception:
+            for prod in new_dps:
+                if prod.data:
+                    prod.data.delete(save=False)
+                prod.delete()
+            raise
 
-        self.status = ASYNC_STATUS_CREATED
+        if reduced_data:
+            self.save_reduced_data(reduced_data)
+
+        # Create a group to collect DataProduct outputs into
+        if new_dps:
+            self.group = DataProductGroup.objects.create(name=f'{self.identifier}_outputs')
+            for prod in new_dps:
+                prod.group.add(self.group)
+                prod.save()
+
+    def stage_input_files(self, products=None):
+        """
+        Return a dict mapping DataProduct PKs to local paths to the files for
+        the given products (all input files by default), so that pipelines can
+        read them from disk.
+
+        Files in local filesystem storage are used in place. Otherwise files
+        are fetched concurrently into the staging cache, keyed by content hash,
+        so each file is only downloaded once per worker machine. Files whose
+        hash is not known yet are hashed as they are downloaded.
+
+        Files staged by this call are kept in the cache in preference to other
+        entries, but can still be evicted if they do not all fit, so callers
+        with many inputs should stage them in batches just before use
+        """
+        if products is None:
+            products = list(self.input_files.all())
+
+        paths = {}
+        to_fetch = []
+        for product in products:
+            try:
+                paths[product.pk] = Path(product.data.path)
+            except NotImplementedError:
+                to_fetch.append((product, product.data.storage, product.data.name,
+                                 get_content_hash(product, compute=False)))
+        if not to_fetch:
+            return paths
+
+        cache = self.get_staging_cache()
+        keys = {key for *_, key in to_fetch if key}
+        keys_lock = threading.Lock()
+
+        def fetch(product, storage, name, key):
+            path = cache.get(key) if key else None
+            if path is None:
+                def write(f):
+                    with storage.open(name, 'rb') as src:
+                        shutil.copyfileobj(src, f, STAGING_CHUNK_SIZE)
+                # Prefer evicting other files to those staged for this call
+                with keys_lock:
+                    keep = set(keys)
+                path = cache.put(key, write, keep=keep)
+                with keys_lock:
+                    keys.add(path.name)
+            return path
+
+        workers = min(self.get_pipeline_settings().get('staging_workers', 4), len(to_fetch))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(fetch, *args) for args in to_fetch]
+            for future, (product, *_, key) in zip(futures, to_fetch):
+                path = future.result()
+                paths[product.pk] = path
+                if not key:
+                    store_content_hash(product, path.name)
+        return paths
+
+    def hash_input_files(self, products=None):
+        """
+        Make sure the content hashes of the given products (all input files by
+        default) are stored. Files in remote storage which have not been
+        hashed yet are staged, so they are hashed as they are downloaded and
+        are not read again when staged for processing
+        """
+        if products is None:
+            products = list(self.input_files.select_related('metadata'))
+        self.stage_input_files([p for p in products if get_content_hash(p, compute=False) is None])
+
+    @classmethod
+    def get_staging_cache(cls):
+        """
+        Return the FileCache used to stage input files from remote storage
+        """
+        cache_settings = cls.get_pipeline_settings().get('staging_cache', {})
+        path = cache_settings.get('path', os.path.join(tempfile.gettempdir(), 'tom_education_staging'))
+        return get_file_cache(path, cache_settings.get('max_bytes', 10 * 1024 ** 3))
+
+    def get_checkpoint_store(self):
+        """
+        Return a FileCache in durable scratch space where stages of this
+        process can save intermediate results, or None if the pipeline does
+        not use checkpoints. Entries are kept until the process finishes, so a
+        retried run can use them instead of repeating work
+        """
+        if not self.checkpoints:
+            return None
+        return FileCache(self.get_checkpoint_dir(), max_bytes=None)
+
+    def get_checkpoint_dir(self):
+        base = self.get_pipeline_settings().get(
+            'checkpoint_dir', os.path.join(tempfile.gettempdir(), 'tom_education_checkpoints')
+        )
+        return Path(base) / self.identifier
+
+    def clear_checkpoints(self):
+        """
+        Delete the intermediate results saved by this process
+        """
+        if self.checkpoints:
+            shutil.rmtree(self.get_checkpoint_dir(), ignore_errors=True)
+
+    def should_retry(self, ex):
+        """
+        Return True if the run should be retried after the exception `ex`.
+        Only unexpected errors and time limits are retried, since an
+        AsyncError would happen again
+        """
+        if not self.checkpoints or self.attempts > self.max_retries:
+            return False
+        return not isinstance(ex, AsyncError) or isinstance(ex.__cause__, TimeLimitExceeded)
+
+    def upload_outputs(self, uploads):
+        """
+        Save output files to the storage backend for their data products.
+        `uploads` is a sequence of (DataProduct, name, path).
+
+        Files are streamed from disk rather than read into memory, so memory
+        use does not depend on the size of the outputs (storage backends read
+        File objects in chunks, e.g. as a multipart upload for S3). Up to the
+        'upload_workers' pipeline setting files are uploaded concurrently.
+
+        Metadata (including the content hash) is read from the local files
+        before the products are saved, so that the uploads are not read back
+        from the storage backend to index them
+        """
+        def upload(prod, name, path):
+            with path.open('rb') as f:
+                prod.data.save(name, File(f, name=name), save=False)
+
+        workers = min(self.get_pipeline_settings().get('upload_workers', 4), len(uploads))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(upload, *args) for args in uploads]
+                try:
+                    for future in futures:
+                        future.result()
+                        self.check_cancelled()
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        else:
+            for args in uploads:
+                self.check_cancelled()
+                upload(*args)
+
+        for prod, _, path in uploads:
+            DataProductMetadata.index(prod, path=path, content_hash=hash_file(path))
+            prod.save()
+
+    def save_reduced_data(self, rows):
+        """
+        Create or update ReducedDatum objects for photometry outputs. `rows`
+        is a sequence of (data_product_type, data), where `data` is
+        [<MJD timestamp>, <photometry data>, <photometry error>, <associated input file>].
+
+        Rows are upserted in batches of REDUCED_DATUM_BATCH_SIZE in a single
+        transaction, keyed on target, source name and timestamp, so the number
+        of queries depends on the number of batches rather than rows
+        """
+        # Resolve associated input files in one query. As before, a file which
+        # is shared by several data products is not associated with any
+        products = {}
+        names = {data[3] for _, data in rows}
+        for prod in DataProduct.objects.filter(data__in=names):
+            products[prod.data.name] = None if prod.data.name in products else prod
+
+        with transaction.atomic():
+            for start in range(0, len(rows), REDUCED_DATUM_BATCH_SIZE):
+                self._save_reduced_data_batch(rows[start:start + REDUCED_DATUM_BATCH_SIZE], products)
+
+    def _save_reduced_data_batch(self, rows, products):
+        timestamps = Time([data[0] for _, data in rows], format='mjd', scale='utc').to_value('datetime')
+        new_data = {}
+        for (data_product_type, data), timestamp in zip(rows, timestamps):
+            if settings.USE_TZ:
+                timestamp = timezone.make_aware(timestamp, timezone.utc)
+            source_name = f'{self.identifier}_{data[0]:.0f}'
+            new_data[(source_name, timestamp)] = ReducedDatum(
+                target=self.target,
+                data_product=products.get(data[3]),
+                data_type=data_product_type,
+                source_name=source_name,
+                timestamp=timestamp,
+                value=json.dumps({'magnitude': data[1], 'error': data[2]})
+            )
+
+        existing = ReducedDatum.objects.filter(
+            target=self.target,
+            source_name__in={source_name for source_name, _ in new_data},
+            timestamp__in={timestamp for _, timestamp in new_data}
+        )
+        to_update = []
+        updated_keys = set()
+        for datum in existing:
+            key = (datum.source_name, datum.timestamp)
+            if key not in new_data:
+                continue
+            new_datum = new_data[key]
+            datum.data_product = new_datum.data_product
+            datum.data_type = new_datum.data_type
+            datum.value = new_datum.value
+            to_update.append(datum)
+            updated_keys.add(key)
+
+        if to_update:
+            ReducedDatum.objects.bulk_update(to_update, ['data_product', 'data_type', 'value'])
+        ReducedDatum.objects.bulk_create(
+            [datum for key, datum in new_data.items() if key not in updated_keys]
+        )
+
+    def get_fingerprint_data(self):
+        """
+        Return a JSON-serializable object describing everything that
+        determines the outputs of this process. Sub-classes whose outputs
+        depend on other things (e.g. settings) should extend this
+        """
+        return {
+            'pipeline': self.__class__.__name__,
+            'version': self.version,
+            'flags': self.get_flags(),
+            'inputs': sorted(get_content_hash(prod) for prod in self.input_files.all()),
+        }
+
+    def compute_fingerprint(self):
+        """
+        Return the SHA-256 hex digest of the fingerprint data for this process
+        """
+        data = json.dumps(self.get_fingerprint_data(), sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get_memoized_run(self):
+        """
+        Return the most recent successful run of the same pipeline for this
+        target with the same fingerprint whose outputs still exist, or None
+        """
+        candidates = (PipelineProcess.objects
+                      .filter(target=self.target, process_type=self.__class__.__name__,
+                              fingerprint=self.fingerprint, status=ASYNC_STATUS_CREATED,
+                              group__isnull=False, reused_from__isnull=True)
+                      .exclude(pk=self.pk)
+                      .select_related('group')
+                      .order_by('-terminal_timestamp'))
+        for candidate in candidates:
+            if candidate.group.dataproduct_set.exists():
+                return candidate
+        return None
+
+    @classmethod
+    def get_seconds_per_byte(cls):
+        """
+        Return the average run time per byte of input for recent successful
+        runs of this pipeline, or None if there are none
+        """
+        runs = list(PipelineProcess.objects
+                    .filter(process_type=cls.__name__, status=ASYNC_STATUS_CREATED,
+                            duration__isnull=False, input_bytes__gt=0)
+                    .order_by('-pk')
+                    .values_list('duration', 'input_bytes')[:COST_MODEL_RUNS])
+        if not runs:
+            return None
+        return sum(duration for duration, _ in runs) / sum(size for _, size in runs)
+
+    def estimate_duration(self):
+        """
+        Set the total size of the input files and the estimated run time from
+        previous runs, and save. Raises AsyncError if the estimate exceeds the
+        'max_estimated_duration' pipeline setting
+        """
+        self.input_bytes = self.get_input_bytes()
+        seconds_per_byte = self.get_seconds_per_byte()
+        self.estimated_duration = None if seconds_per_byte is None else seconds_per_byte * self.input_bytes
         self.save()
 
-    def do_pipeline(self, tmpdir):
+        ceiling = self.get_pipeline_settings().get('max_estimated_duration')
+        if ceiling and self.estimated_duration and self.estimated_duration > ceiling:
+            raise AsyncError(f'Estimated run time of {self.estimated_duration:.0f} seconds is longer '
+                             f'than the maximum of {ceiling} seconds')
+
+    def get_input_bytes(self):
+        """
+        Return the total size of the input files in bytes. Sizes are read from
+        DataProductMetadata in one query; only files which have not been
+        indexed with their current name and size are indexed first
+        """
+        total = 0
+        unindexed = []
+        rows = self.input_files.values_list('pk', 'data', 'metadata__data_name', 'metadata__file_size')
+        for pk, name, indexed_name, size in rows:
+            if name and (name != indexed_name or size is None):
+                unindexed.append(pk)
+            else:
+                total += size or 0
+        for prod in DataProduct.objects.filter(pk__in=unindexed):
+            total += DataProductMetadata.index(prod).file_size or 0
+        return total
+
+    def get_time_limit(self):
+        """
+        Return the time limit in seconds for running this process: a multiple
+        of the estimated run time if there is one, or a default otherwise
+        """
+        pipeline_settings = self.get_pipeline_settings()
+        if self.estimated_duration is None:
+            return pipeline_settings.get('default_time_limit', 3600)
+        return max(pipeline_settings.get('min_time_limit', 60),
+                   self.estimated_duration * pipeline_settings.get('time_limit_factor', 3))
+
+    @property
+    def eta(self):
+        """
+        The estimated time at which a running process will finish, or None if
+        not known
+        """
+        if self.status in ASYNC_TERMINAL_STATES or not self.started or self.estimated_duration is None:
+            return None
+        return self.started + timedelta(seconds=self.estimated_duration)
+
+    def do_pipeline(self, tmpdir, **flags):
         """
         Perform the actual work, and return a sequence of PipelineOutput
         objects (or tuples) for each output file to be saved.
 
+        Should raise AsyncError(failure_message) on failure.
+
+        For map/reduce pipelines this runs every chunk in turn followed by the
+        reduce step, for when the process is run outside of a worker
+        """
+        if not self.chunk_size:
+            raise NotImplementedError('Must be implemented in child classes')
+        results = [self.do_map(tmpdir, products, **flags) for products in self.split_inputs()]
+        return self.do_reduce(tmpdir, results, **flags)
+
+    def do_map(self, tmpdir, products, **flags):
+        """
+        Process one chunk of input files (a list of DataProducts), and return
+        a JSON-serializable result to be passed to do_reduce(). Chunks may be
+        processed concurrently by different workers.
+
         Should raise AsyncError(failure_message) on failure
         """
-        raise NotImplementedError('Must be implemented in child classes')
+        raise NotImplementedError('Must be implemented in map/reduce pipelines')
+
+    def do_reduce(self, tmpdir, results, **flags):
+        """
+        Combine the list of results returned by do_map() for each chunk, in
+        chunk order, and return outputs as for do_pipeline()
+        """
+        raise NotImplementedError('Must be implemented in map/reduce pipelines')
+
+    def split_inputs(self):
+        """
+        Return a list of chunks of at most `chunk_size` input files
+        """
+        products = list(self.input_files.order_by('pk'))
+        return [products[i:i + self.chunk_size] for i in range(0, len(products), self.chunk_size)]
+
+    def create_chunks(self):
+        """
+        Split the input files into PipelineChunk objects, replacing any from a
+        previous run, and return them
+        """
+        chunks = []
+        with transaction.atomic():
+            self.chunks.all().delete()
+            for index, products in enumerate(self.split_inputs()):
+                chunk = PipelineChunk.objects.create(process=self, index=index)
+                chunk.input_files.add(*products)
+                chunks.append(chunk)
+        self.status = f'Processing chunks (0/{len(chunks)})'
+        self.save()
+        return chunks
+
+    def run_chunk(self, chunk):
+        """
+        Run the map step for a PipelineChunk of this process and store the
+        result. Returns True if this was the last chunk to finish, in which case
+        the caller should start the reduce step
+        """
+        try:
+            self.check_cancelled(force=True)
+            with tempfile.TemporaryDirectory() as tmpdir_name:
+                result = self.do_map(Path(tmpdir_name), list(chunk.input_files.order_by('pk')),
+                                     **self.get_flags())
+        except Exception as ex:
+            chunk.status = ASYNC_STATUS_FAILED
+            chunk.failure_message = str(ex)[:255]
+            chunk.save()
+            raise
+
+        chunk.result_json = json.dumps(result)
+        chunk.status = ASYNC_STATUS_CREATED
+        chunk.save()
+        return self.update_chunk_progress()
+
+    def update_chunk_progress(self):
+        """
+        Set the status of this process from the number of finished chunks.
+        Returns True if all chunks have finished and the reduce step has not
+        yet been started. The process row is locked so that exactly one worker
+        starts the reduce step
+        """
+        with transaction.atomic():
+            status = (PipelineProcess.objects.select_for_update()
+                      .values_list('status', flat=True).get(pk=self.pk))
+            if status in ASYNC_TERMINAL_STATES or status == PIPELINE_STATUS_REDUCING:
+                return False
+            total = self.chunks.count()
+            done = self.chunks.filter(status=ASYNC_STATUS_CREATED).count()
+            self.log(f'Finished chunk {done}/{total}')
+            self.status = PIPELINE_STATUS_REDUCING if done == total else f'Processing chunks ({done}/{total})'
+            # Only update the status, since other workers may be using this
+            # process too
+            PipelineProcess.objects.filter(pk=self.pk).update(status=self.status, modified=timezone.now())
+            self.notify_status()
+            return done == total
+
+    def run_reduce(self):
+        """
+        Run the reduce step on the results of all chunks and save the outputs
+        """
+        self.check_cancelled(force=True)
+        results = [json.loads(chunk.result_json) for chunk in self.chunks.order_by('index')]
+        with tempfile.TemporaryDirectory() as tmpdir_name:
+            outputs = self.do_reduce(Path(tmpdir_name), results, **self.get_flags())
+            self.save_outputs(outputs)
+
+        self.finish()
+
+    def request_cancel(self):
+        """
+        Ask the process to stop at its next checkpoint. Only the flag is
+        saved, so this is safe to call while the process is running
+        """
+        self.cancel_requested = True
+        PipelineProcess.objects.filter(pk=self.pk).update(cancel_requested=True)
+
+    def check_cancelled(self, force=False):
+        """
+        Cancellation checkpoint for long-running steps: raise ProcessCancelled
+        if cancellation has been requested. The database is checked at most
+        once every CANCEL_CHECK_INTERVAL seconds unless `force` is True, so
+        this is cheap to call in loops
+        """
+        now = time.monotonic()
+        if not force and self._last_cancel_check is not None \
+                and now - self._last_cancel_check < CANCEL_CHECK_INTERVAL:
+            return
+        self._last_cancel_check = now
+        if PipelineProcess.objects.filter(pk=self.pk, cancel_requested=True).exists():
+            self.cancel_requested = True
+            raise ProcessCancelled('Cancelled')
 
     @contextmanager
     def update_status(self, status):
@@ -129,10 +710,51 @@ class PipelineProcess(AsyncProcess):
         yield None
 
     def log(self, msg, end='\n'):
-        if not self.logs:
-            self.logs = ''
-        self.logs += msg + end
-        self.save()
+        """
+        Append a message to the logs for this process. Each message is stored
+        as a new PipelineLogLine, so logging does not rewrite the existing
+        logs or save the process itself
+        """
+        while True:
+            if self._next_log_index is None:
+                last = self.log_lines.order_by('-index').values_list('index', flat=True).first()
+                self._next_log_index = 0 if last is None else last + 1
+            try:
+                with transaction.atomic():
+                    PipelineLogLine.objects.create(process=self, index=self._next_log_index, text=msg + end)
+            except IntegrityError:
+                # Another worker logged to this process (e.g. for a different
+                # chunk) since the index was read
+                self._next_log_index = None
+                continue
+            publish([f'process.{self.pk}'], 'log', {
+                'identifier': self.identifier, 'index': self._next_log_index, 'text': msg + end,
+            })
+            self._next_log_index += 1
+            return
+
+    @property
+    def logs(self):
+        return self.get_logs()[0]
+
+    def get_logs(self, offset=0):
+        """
+        Return (text, next_offset), where `text` is the log text for this
+        process starting from log line number `offset`, and `next_offset` is
+        the offset to use to retrieve only new lines in a later call
+        """
+        lines = list(self.log_lines.filter(index__gte=offset).order_by('index')
+                                   .values_list('index', 'text'))
+        if not lines:
+            return '', offset
+        return ''.join(text for _, text in lines), lines[-1][0] + 1
+
+    @classmethod
+    def get_pipeline_settings(cls):
+        """
+        Return settings which apply to all pipelines
+        """
+        return getattr(settings, 'TOM_EDUCATION_PIPELINE_SETTINGS', {})
 
     @classmethod
     def get_available(cls):
@@ -141,13 +763,32 @@ class PipelineProcess(AsyncProcess):
         """
         return getattr(settings, 'TOM_EDUCATION_PIPELINES', {})
 
+    @classmethod
+    def get_registry(cls):
+        """
+        Return the PipelineRegistry for the pipelines in settings.py, which is
+        created on first use
+        """
+        global _pipeline_registry
+        if _pipeline_registry is None:
+            _pipeline_registry = PipelineRegistry(cls.get_available())
+        return _pipeline_registry
+
     @classmethod
     def get_subclass(cls, name):
         """
         Return the sub-class corresponding to the name given
         """
+        return cls.get_registry().get(name)
+
+    @classmethod
+    def import_subclass(cls, path):
+        """
+        Import and validate the sub-class at the given dotted path. Raises
+        InvalidPipelineError if it is not a valid PipelineProcess sub-class
+        """
         try:
-            pipeline_cls = import_string(cls.get_available()[name])
+            pipeline_cls = import_string(path)
         except ImportError as ex:
             raise InvalidPipelineError(ex)
 
@@ -197,3 +838,79 @@ class PipelineProcess(AsyncProcess):
         pipe.input_files.add(*products)
         pipe.save()
         return pipe
+
+
+class PipelineRegistry:
+    """
+    The pipelines given in TOM_EDUCATION_PIPELINES, imported and validated
+    once per process rather than on each lookup
+    """
+    def __init__(self, available):
+        self.pipelines = {}
+        # Error messages for pipelines which could not be imported
+        self.errors = {}
+        for name, path in available.items():
+            try:
+                self.pipelines[name] = PipelineProcess.import_subclass(path)
+            except InvalidPipelineError as ex:
+                self.errors[name] = str(ex)
+        self.names = sorted(available.keys())
+        # Flags for each pipeline that has any
+        self.flags = {name: pipeline_cls.flags for name, pipeline_cls in self.pipelines.items()
+                      if pipeline_cls.flags}
+
+    def get(self, name):
+        """
+        Return the pipeline class for `name`. Raises KeyError if there is no
+        such pipeline, or InvalidPipelineError if it is invalid
+        """
+        if name in self.errors:
+            raise InvalidPipelineError(self.errors[name])
+        return self.pipelines[name]
+
+    def check(self):
+        """
+        Raise InvalidPipelineError if any pipeline is invalid
+        """
+        for msg in self.errors.values():
+            raise InvalidPipelineError(msg)
+
+
+def clear_pipeline_registry():
+    """
+    Discard the pipeline registry so that it is created again from settings on
+    next use
+    """
+    global _pipeline_registry
+    _pipeline_registry = None
+
+
+class PipelineLogLine(models.Model):
+    """
+    A message logged by a PipelineProcess. Log lines are only ever appended,
+    and are numbered from 0 for each process so that clients can fetch new
+    lines from a given offset
+    """
+    process = models.ForeignKey(PipelineProcess, on_delete=models.CASCADE, related_name='log_lines')
+    index = models.PositiveIntegerField()
+    text = models.TextField()
+
+    class Meta:
+        unique_together = ('process', 'index')
+
+
+class PipelineChunk(models.Model):
+    """
+    A subset of the input files of a map/reduce PipelineProcess, which is
+    processed by do_map() in its own task
+    """
+    process = models.ForeignKey(PipelineProcess, on_delete=models.CASCADE, related_name='chunks')
+    index = models.PositiveIntegerField()
+    input_files = models.ManyToManyField(DataProduct, related_name='+')
+    status = models.CharField(max_length=50, default=ASYNC_STATUS_PENDING)
+    failure_message = models.CharField(max_length=255, blank=True)
+    # JSON-encoded return value of do_map()
+    result_json = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = ('process', 'index')
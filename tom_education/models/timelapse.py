@@ -1,8 +1,15 @@
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack
 from io import BytesIO
-import os.path
-import tempfile
+import hashlib
+import json
 import logging
+import multiprocessing
+from pathlib import Path
+import shutil
+import subprocess
+import tempfile
 
 from astropy.io import fits
 from astroscrappy import detect_cosmics
@@ -11,12 +18,21 @@ from django.core.exceptions import ValidationError
 from django.core.files import File
 from django.db import models
 from dramatiq.middleware.time_limit import TimeLimitExceeded
-from fits2image.conversions import fits_to_jpg
+from fits2image.scaling import (
+    calc_zscale_min_max, extract_samples, gamma_adjust_table, linear_scale
+)
+from PIL import Image
 import astropy.stats
 import imageio
+import imageio_ffmpeg
+import numpy as np
 
 from tom_dataproducts.models import DataProduct
-from tom_education.models.async_process import AsyncError
+from tom_education.models.async_process import AsyncError, ASYNC_STATUS_CREATED
+from tom_education.file_cache import get_file_cache
+from tom_education.models.data_product_metadata import (
+    DATE_FIELD, DataProductMetadata, get_content_hash, read_fits_metadata
+)
 from tom_education.models.pipelines import PipelineProcess, PipelineOutput
 from tom_education.utils import assert_valid_suffix
 
@@ -24,9 +40,25 @@ from tom_education.utils import assert_valid_suffix
 TIMELAPSE_GIF = 'gif'
 TIMELAPSE_MP4 = 'mp4'
 TIMELAPSE_WEBM = 'webm'
+TIMELAPSE_FORMATS = (TIMELAPSE_GIF, TIMELAPSE_MP4, TIMELAPSE_WEBM)
 
 logger = logging.getLogger(__name__)
 
+# Background normalisation engines
+BACKGROUND_EXACT = 'exact'
+BACKGROUND_MESH = 'mesh'
+BACKGROUND_MEDIAN = 'median'
+
+# Methods for scaling the brightness of frames: each frame separately, or the
+# same scaling for all frames in the timelapse
+SCALING_FRAME = 'frame'
+SCALING_ZSCALE = 'zscale'
+SCALING_PERCENTILE = 'percentile'
+SCALING_METHODS = (SCALING_FRAME, SCALING_ZSCALE, SCALING_PERCENTILE)
+
+# HDU types which may contain the image data for a frame
+IMAGE_HDU_TYPES = (fits.PrimaryHDU, fits.ImageHDU, fits.CompImageHDU)
+
 class TimelapsePipeline(PipelineProcess):
     """
     Pipeline process to make a timelapse from a sequence of FITS images
@@ -53,121 +85,452 @@ class TimelapsePipeline(PipelineProcess):
 
     def do_pipeline(self, tmpdir, **flags):
         tl_settings = self.get_settings()
-        fmt = tl_settings.get('format', TIMELAPSE_GIF)
         fps = tl_settings.get('fps', 10)
-        image_size = tl_settings.get('size', 500)
         if fps <= 0:
             raise AsyncError(f'Invalid FPS {fps}')
+        variants = self.get_output_variants()
+        self.settings_hash = self.compute_settings_hash()
 
         # Filenames for pipeline-produced files include the pipeline
-        # identifier, so keep this name short
-        outfile = tmpdir / f't.{fmt}'
-
-        with outfile.open('wb') as f:
-            try:
-                self.write_timelapse(f, fmt, fps, image_size, **flags)
-            except ValueError as ex:
-                logger.error('ValueError: {}'.format(ex))
-                raise AsyncError('Invalid parameters. Are all images the same size?')
-            except TimeLimitExceeded:
-                raise AsyncError("Timelapse took longer than 10 mins to create")
-            except PipelineProcess.DoesNotExist:
-                raise AsyncError("Timelapse record has been deleted")
-
-        return [PipelineOutput(outfile, DataProduct, settings.DATA_PRODUCT_TYPES['timelapse'][0], None)]
+        # identifier, so keep these names short
+        if len(variants) == 1:
+            outfiles = [tmpdir / f't.{fmt}' for fmt, _ in variants]
+        else:
+            outfiles = [tmpdir / f't{size}.{fmt}' for fmt, size in variants]
+
+        with self.handle_timelapse_errors():
+            products = None
+            appended = False
+            # Frames can only be appended if they are scaled independently of
+            # the rest of the timelapse
+            fmt, image_size = variants[0]
+            can_append = (len(variants) == 1
+                          and fmt in (TIMELAPSE_MP4, TIMELAPSE_WEBM)
+                          and self.get_scaling_settings()['method'] == SCALING_FRAME)
+            if tl_settings.get('incremental') and can_append:
+                products = self.sorted_frames()
+                appended = self.append_to_previous(tmpdir, outfiles[0], products, fmt, fps,
+                                                   image_size, **flags)
+            if not appended:
+                with ExitStack() as stack:
+                    outputs = [
+                        (stack.enter_context(outfile.open('wb')), fmt, size)
+                        for outfile, (fmt, size) in zip(outfiles, variants)
+                    ]
+                    self.write_timelapses(outputs, fps, products=products, **flags)
+
+        # Record the size of each variant, so that the target API can report it
+        data_product_type = settings.DATA_PRODUCT_TYPES['timelapse'][0]
+        return [
+            PipelineOutput(outfile, DataProduct, data_product_type, json.dumps({'size': size}))
+            for outfile, (_, size) in zip(outfiles, variants)
+        ]
+
+    @contextmanager
+    def handle_timelapse_errors(self):
+        """
+        Context manager to convert expected errors when creating a timelapse
+        into AsyncError
+        """
+        try:
+            yield
+        except ValueError as ex:
+            logger.error('ValueError: {}'.format(ex))
+            raise AsyncError('Invalid parameters. Are all images the same size?')
+        except TimeLimitExceeded as ex:
+            minutes = self.get_time_limit() / 60
+            raise AsyncError(f"Timelapse took longer than {minutes:.0f} mins to create") from ex
+        except PipelineProcess.DoesNotExist:
+            raise AsyncError("Timelapse record has been deleted")
+
+    def get_previous_timelapse(self, fmt):
+        """
+        Return the most recent successful TimelapsePipeline for this target
+        with the same flags and render settings whose output is in format
+        `fmt`, or None
+        """
+        candidates = (TimelapsePipeline.objects
+                      .filter(target=self.target, status=ASYNC_STATUS_CREATED,
+                              process_type='TimelapsePipeline', flags_json=self.flags_json,
+                              settings_hash=self.compute_settings_hash(), group__isnull=False)
+                      .exclude(pk=self.pk)
+                      .order_by('-terminal_timestamp'))
+        for candidate in candidates:
+            output = candidate.group.dataproduct_set.first()
+            if output and output.data.name.endswith(f'.{fmt}'):
+                return candidate
+        return None
+
+    def append_to_previous(self, tmpdir, outfile, products, fmt, fps, image_size, **flags):
+        """
+        Try to create the timelapse by appending frames for new products to the
+        output of the previous timelapse for this target, instead of rendering
+        every frame again. This is only possible when the previous timelapse
+        used a subset of `products` which all come before the new ones in date
+        order, and when it was created with the same render settings (see
+        get_render_settings()).
+
+        Returns True if the timelapse was written to `outfile`, or False if a
+        full rebuild is required
+        """
+        previous = self.get_previous_timelapse(fmt)
+        if previous is None:
+            return False
+        previous_pks = set(previous.input_files.values_list('pk', flat=True))
+        num_previous = len(previous_pks)
+        if not num_previous or num_previous >= len(products):
+            return False
+        if {p.pk for p in products[:num_previous]} != previous_pks:
+            self.log('New frames are not all later than the previous timelapse: rebuilding')
+            return False
+
+        new_products = products[num_previous:]
+        previous_file = tmpdir / f'previous.{fmt}'
+        with previous.group.dataproduct_set.first().data.open('rb') as src:
+            with previous_file.open('wb') as dst:
+                shutil.copyfileobj(src, dst)
+
+        segment_file = tmpdir / f'segment.{fmt}'
+        with segment_file.open('wb') as f:
+            self.write_timelapse(f, fmt, fps, image_size, products=new_products, **flags)
+
+        if video_properties(previous_file) != video_properties(segment_file):
+            self.log('Previous timelapse has a different size or frame rate: rebuilding')
+            return False
+
+        self.log(f'Appending {len(new_products)} new frames to {previous.identifier}')
+        try:
+            concatenate_videos([previous_file, segment_file], outfile, fmt)
+        except subprocess.CalledProcessError as ex:
+            logger.error('Failed to concatenate timelapses: {}'.format(ex.stderr))
+            self.log('Could not append to previous timelapse: rebuilding')
+            return False
+        return True
 
     def write_timelapse(self, outfile, fmt=TIMELAPSE_GIF, fps=10,
-                        image_size=500, **flags):
+                        image_size=500, products=None, **flags):
         """
         Write the timelapse to the given output file, which may be a path or
-        file-like object
+        file-like object. `products` is the sorted sequence of DataProducts to
+        use as frames; if not given, all input files are used
         """
-        writer_kwargs = {
-            'format': fmt,
-            'mode': 'I',
-            'fps': fps
-        }
-
-        # When saving to MP4 or WebM, imageio uses ffmpeg, which determines
-        # output format from file extension. When using a BytesIO buffer,
-        # imageio creates a temporary file with no extension, so the ffmpeg
-        # call fails. We need to specify the output format explicitly instead
-        # in this case
-        if fmt in (TIMELAPSE_MP4, TIMELAPSE_WEBM):
-            writer_kwargs['output_params'] = ['-f', fmt,'-crf','30','-lossless','1']
+        self.write_timelapses([(outfile, fmt, image_size)], fps, products=products, **flags)
 
-            # Need to specify codec for WebM
-            if fmt == TIMELAPSE_WEBM:
-                writer_kwargs['codec'] = 'vp8'
-
-            # The imageio plugin does not recognise webm as a format, so set
-            # 'format' to 'mp4' in either case (this does not affect the ffmpeg
-            # call)
-            writer_kwargs['format'] = TIMELAPSE_MP4
+    def write_timelapses(self, outputs, fps=10, products=None, **flags):
+        """
+        Write several variants of the timelapse at once. `outputs` is a
+        sequence of (outfile, format, image size) tuples. Each frame is read
+        and processed once at the largest size, and resized for the smaller
+        variants
+        """
+        crop_scale = self.get_settings().get('crop_scale', 0.5) if flags.get('crop') else None
+        background = self.get_background_settings() if flags.get('normalise_background') else None
+        scaling = self.get_scaling_settings()
+        max_size = max(size for _, _, size in outputs)
+
+        with ExitStack() as stack:
+            writers = [
+                (stack.enter_context(imageio.get_writer(outfile, **get_writer_kwargs(fmt, fps))), size)
+                for outfile, fmt, size in outputs
+            ]
+            if products is None:
+                self.log('Sorting frames')
+                products = self.sorted_frames()
+            if scaling['method'] == SCALING_FRAME:
+                frames = self.render_frames(products, max_size, crop_scale, background)
+            else:
+                frames = self.render_frames_with_stack_scaling(
+                    products, max_size, crop_scale, background, **scaling
+                )
+            for product, frame in frames:
+                self.check_cancelled()
+                for writer, size in writers:
+                    writer.append_data(frame if size == max_size else resize_rendered_frame(frame, size))
 
-        num_frames = self.input_files.count()
+        self.log('Finished')
 
+    def render_frames(self, products, image_size, crop_scale=None, background=None, scaled=True):
+        """
+        Generator yielding (product, frame) for each of the given products, in
+        the same order as `products`. See `process_frame` for the meaning of
+        the arguments.
+
+        If the 'frame_cache' timelapse setting is given, frames rendered with
+        the same parameters in previous runs are loaded from the cache instead
+        of being rendered again. Frames are also saved as checkpoints if the
+        pipeline uses them, so a retried run only renders the remaining
+        frames. If the 'workers' setting is greater than 1, the remaining
+        frames are rendered in parallel on a pool of that many processes.
+
+        Progress is logged and cancellation checked for each frame, since
+        this is where the expensive work happens (for stack scaling, before
+        any frame is written)
+        """
+        args = (image_size, crop_scale, background, scaled)
+        caches = [c for c in (self.get_frame_cache(), self.get_checkpoint_store()) if c]
+        keys = {}
+        to_render = products
+        if caches:
+            self.hash_input_files(products)
+            keys = {p.pk: frame_cache_key(get_content_hash(p), *args) for p in products}
+            to_render = [p for p in products if not any(keys[p.pk] in cache for cache in caches)]
+            self.log(f'Using {len(products) - len(to_render)} cached frames')
+
+        rendered = self._render(to_render, *args)
+        render_pks = {p.pk for p in to_render}
+        for i, product in enumerate(products):
+            self.check_cancelled()
+            self.log(f'Processing frame {i + 1}/{len(products)}')
+            cached_path = None
+            if product.pk not in render_pks:
+                cached_path = next(filter(None, (cache.get(keys[product.pk]) for cache in caches)), None)
+
+            if cached_path:
+                frame = np.load(cached_path)
+            elif product.pk in render_pks:
+                frame = next(rendered)
+            else:
+                # Cache entry was evicted by another process since checking
+                # above
+                frame = next(self._render([product], *args))
+
+            for cache in caches:
+                if keys[product.pk] not in cache:
+                    cache.put(keys[product.pk], lambda f: np.save(f, frame))
+            yield product, frame
+
+    def render_frames_with_stack_scaling(self, products, image_size, crop_scale=None,
+                                         background=None, method=SCALING_ZSCALE,
+                                         samples=100000, **params):
+        """
+        Generator yielding (product, frame) for each of the given products, as
+        for `render_frames`, but with the same brightness scaling applied to
+        every frame.
+
+        The scaling limits are computed with `stack_scale_limits` from a total
+        of `samples` pixels chosen at random across all (resized) frames.
+        Unscaled frames are kept in a temporary directory until the limits are
+        known
+        """
+        rng = np.random.default_rng(0)
+        per_frame = max(1, samples // max(1, len(products)))
+        pixel_samples = []
         with tempfile.TemporaryDirectory() as tmpdir:
-            with imageio.get_writer(outfile, **writer_kwargs) as writer:
-                self.log('Sorting frames')
-                for i, product in enumerate(self.sorted_frames()):
-                    self.log(f'Processing frame {i + 1}/{num_frames}')
-
-                    fits_path = product.data.file
-                    if flags.get('normalise_background') or flags.get('crop'):
-                        fits_path.open()
-                        data, header = fits.getdata(fits_path, header=True)
-                        fits_path.close()
-                        try:
-                            if flags.get('crop'):
-                                scale = self.get_settings().get('crop_scale', 0.5)
-                                data, header = crop_image(data, header, scale)
-                            if flags.get('normalise_background'):
-                                data = normalise_background(data, header)
-
-                        except ValueError as ex:
-                            raise AsyncError(
-                                "Error in file '{}': {}".format(product.data.name, ex)
-                            )
-                        fits_path = os.path.join(tmpdir, 'tmp.fits')
-                        hdul = fits.HDUList([fits.PrimaryHDU(data, header=header)])
-                        with open(fits_path, 'wb') as f:
-                            hdul.writeto(f)
-
-                    # Note: imageio supports loading FITS files, but does not
-                    # choose brightness levels intelligently. Use fits_to_jpg
-                    # instead to go FITS -> JPG -> timelapse
-                    jpg_path = os.path.join(tmpdir, 'frame_{}.jpg'.format(i))
-                    fits_to_jpg(fits_path, jpg_path, width=image_size, height=image_size)
-                    writer.append_data(imageio.imread(jpg_path))
+            paths = []
+            self.log('Computing scaling for the whole timelapse')
+            unscaled = self.render_frames(products, image_size, crop_scale, background, False)
+            for i, (product, data) in enumerate(unscaled):
+                path = Path(tmpdir) / f'{i}.npy'
+                np.save(path, data)
+                paths.append(path)
+                pixels = data[np.isfinite(data)]
+                pixel_samples.append(rng.choice(pixels, size=min(per_frame, pixels.size), replace=False))
+
+            zmin, zmax = stack_scale_limits(np.concatenate(pixel_samples), method, **params)
+            self.log(f'Scaling all frames between {zmin:.6g} and {zmax:.6g}')
+            for product, path in zip(products, paths):
+                yield product, scale_frame(np.load(path), zmin, zmax)
+
+    def _render(self, products, *args):
+        """
+        Generator yielding rendered frames for the given products, in order.
+        Rendering is done in a process pool if the 'workers' setting is
+        greater than 1.
+
+        Input files are staged in batches just ahead of rendering, so that the
+        number of staged files waiting to be read does not grow with the
+        number of frames. Staged files can still be evicted from the staging
+        cache by other runs before they are read, in which case they are
+        fetched again
+        """
+        workers = self.get_settings().get('workers', 1)
+        batch_size = max(self.get_pipeline_settings().get('staging_workers', 4), 2 * workers)
+
+        def stage_in_batches():
+            for start in range(0, len(products), batch_size):
+                batch = products[start:start + batch_size]
+                paths = self.stage_input_files(batch)
+                for product in batch:
+                    yield paths[product.pk]
+
+        local_paths = stage_in_batches()
+        if workers > 1:
+            results = self._render_in_pool(local_paths, workers, *args)
+        else:
+            results = (process_staged_frame(path, *args) for path in local_paths)
+
+        for product in products:
+            try:
+                frame = next(results)
+                if frame is None:
+                    self.log(f'{product.data.name} was removed from the staging cache: fetching it again')
+                    frame = process_frame(self.stage_input_files([product])[product.pk], *args)
+                yield frame
+            except ValueError as ex:
+                raise AsyncError(
+                    "Error in file '{}': {}".format(product.data.name, ex)
+                )
 
-        self.log('Finished')
+    def _render_in_pool(self, paths, workers, *args):
+        """
+        Generator yielding rendered frames (or None for missing files, as for
+        `process_staged_frame`) for the FITS files at the given local paths,
+        rendered in a process pool. At most 2 * `workers` frames
+        are queued at once, so memory use does not grow with the number of
+        frames
+        """
+        # Use fork so that worker processes inherit Django settings
+        context = multiprocessing.get_context('fork')
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            try:
+                for path in paths:
+                    pending.append(executor.submit(process_staged_frame, path, *args))
+                    if len(pending) >= 2 * workers:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
 
     def sorted_frames(self):
         """
-        Return the sequence of DataProduct objects sorted by the date stored in
-        the FITS header
-        """
-        def sort_key(product):
-            product.data.file.open()
-            for hdu in fits.open(product.data.file):
-                try:
-                    dt_str = hdu.header[self.FITS_DATE_FIELD]
-                except KeyError:
-                    continue
-                product.data.file.close()
-                return datetime.fromisoformat(dt_str)
+        Return the sequence of DataProduct objects sorted by the observation
+        date stored in the FITS header
+        """
+        products = list(self.input_files.select_related('metadata'))
+        dates = {product.pk: self.get_observation_date(product) for product in products}
+        return sorted(products, key=lambda product: dates[product.pk])
+
+    def get_observation_date(self, product):
+        """
+        Return the observation date for a DataProduct. The date is taken from
+        the DataProductMetadata index where possible; otherwise the FITS
+        headers are read (and the index updated for next time)
+        """
+        # The index only stores DATE_FIELD, so cannot be used if sorting by a
+        # different header
+        use_index = self.FITS_DATE_FIELD == DATE_FIELD
+        if use_index:
+            try:
+                metadata = product.metadata
+            except DataProductMetadata.DoesNotExist:
+                metadata = None
+            if metadata and metadata.is_current(product) and metadata.date_obs:
+                return metadata.date_obs
+
+        try:
+            if use_index:
+                date_obs = DataProductMetadata.index(product).date_obs
+            else:
+                date_obs = read_fits_metadata(product.data.file, self.FITS_DATE_FIELD)['date_obs']
+        except ValueError as ex:
+            raise AsyncError("Error in file '{}': {}".format(product.data.name, ex))
+
+        if date_obs is None:
             raise AsyncError(
                 "Error in file '{}': could not find observation date in FITS header '{}'"
                 .format(product.data.name, self.FITS_DATE_FIELD)
             )
+        return date_obs
 
-        return sorted(self.input_files.all(), key=sort_key)
+    def get_fingerprint_data(self):
+        data = super().get_fingerprint_data()
+        data['settings'] = self.get_render_settings()
+        return data
+
+    @classmethod
+    def get_render_settings(cls):
+        """
+        Return the timelapse settings which affect the output, with defaults
+        filled in. Settings which only affect how the timelapse is made (e.g.
+        'workers' and 'frame_cache') are not included
+        """
+        tl_settings = cls.get_settings()
+        return {
+            'fps': tl_settings.get('fps', 10),
+            'variants': cls.get_output_variants(),
+            'crop_scale': tl_settings.get('crop_scale', 0.5),
+            'background': cls.get_background_settings(),
+            'scaling': cls.get_scaling_settings(),
+        }
+
+    @classmethod
+    def compute_settings_hash(cls):
+        """
+        Return the SHA-256 hex digest of the render settings, which is stored
+        on each run so that only timelapses made with the same settings are
+        appended to
+        """
+        data = json.dumps(cls.get_render_settings(), sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
 
     @classmethod
     def get_settings(cls):
         return getattr(settings, 'TOM_EDUCATION_TIMELAPSE_SETTINGS', {})
 
+    @classmethod
+    def get_output_variants(cls):
+        """
+        Return a list of (format, image size) for each timelapse to create,
+        from the 'outputs' timelapse setting if given, or the 'format' and
+        'size' settings otherwise. Raises AsyncError if a format is not
+        recognised, or if the same format and size is given more than once
+        (since output files are named after them)
+        """
+        tl_settings = cls.get_settings()
+        outputs = tl_settings.get('outputs') or [{}]
+        variants = [
+            (output.get('format', tl_settings.get('format', TIMELAPSE_GIF)),
+             output.get('size', tl_settings.get('size', 500)))
+            for output in outputs
+        ]
+        for fmt, _ in variants:
+            if fmt not in TIMELAPSE_FORMATS:
+                raise AsyncError(f"Invalid timelapse format '{fmt}'")
+        for i, variant in enumerate(variants):
+            if variant in variants[:i]:
+                raise AsyncError("Timelapse output '{}' with size {} is given more than once".format(*variant))
+        return variants
+
+    @classmethod
+    def get_background_settings(cls):
+        """
+        Return a dict of keyword arguments for `normalise_background` from the
+        'background' timelapse setting. Raises AsyncError if the method is not
+        recognised
+        """
+        bg_settings = dict(cls.get_settings().get('background', {}))
+        bg_settings.setdefault('method', BACKGROUND_EXACT)
+        if bg_settings['method'] not in BACKGROUND_ENGINES:
+            raise AsyncError(f"Unknown background method '{bg_settings['method']}'")
+        return bg_settings
+
+    @classmethod
+    def get_scaling_settings(cls):
+        """
+        Return a dict of keyword arguments for
+        `render_frames_with_stack_scaling` from the 'scaling' timelapse
+        setting. Raises AsyncError if the method is not recognised
+        """
+        scaling_settings = dict(cls.get_settings().get('scaling', {}))
+        scaling_settings.setdefault('method', SCALING_FRAME)
+        if scaling_settings['method'] not in SCALING_METHODS:
+            raise AsyncError(f"Unknown scaling method '{scaling_settings['method']}'")
+        return scaling_settings
+
+    @classmethod
+    def get_frame_cache(cls):
+        """
+        Return a FileCache for rendered frames, or None if the frame cache is
+        not configured
+        """
+        cache_settings = cls.get_settings().get('frame_cache')
+        if not cache_settings:
+            return None
+        return get_file_cache(cache_settings['path'], cache_settings.get('max_bytes', 1024 ** 3))
+
 def get_data_index(hdul):
     """
     Get the index of the data HDU in the given HDUList, and return (i, data).
@@ -178,39 +541,340 @@ def get_data_index(hdul):
             return (i, hdu.data)
     raise ValueError('no data HDU found')
 
-def normalise_background(data, header):
+def get_image_hdu(hdul):
+    """
+    Get the first 2D image HDU in the given HDUList without reading its data,
+    and return (i, hdu). Raises ValueError if no such HDU is found
+    """
+    for i, hdu in enumerate(hdul):
+        if isinstance(hdu, IMAGE_HDU_TYPES) and hdu.header.get('NAXIS') == 2:
+            return (i, hdu)
+    raise ValueError('no data HDU found')
+
+def read_frame(fits_file, crop_scale=None):
+    """
+    Read the first 2D image HDU from the given FITS file (a path or file-like
+    object), and return (data, header). Raises ValueError if no such HDU is
+    found.
+
+    If `crop_scale` is given, only the central region of the image (as for
+    `crop_image`) is read. For tile-compressed images this means only the
+    tiles covering that region are decompressed
+    """
+    # Django File objects are reopened (and closed afterwards), since they
+    # may have been closed after a previous read
+    is_django_file = isinstance(fits_file, File)
+    if is_django_file:
+        fits_file.open('rb')
+    try:
+        with fits.open(fits_file) as hdul:
+            if crop_scale is None:
+                idx, data = get_data_index(hdul)
+                return data, hdul[idx].header.copy()
+
+            _, hdu = get_image_hdu(hdul)
+            header = hdu.header.copy()
+            bounds = crop_bounds((header['NAXIS2'], header['NAXIS1']), crop_scale)
+            # CompImageHDU only has `section` in astropy >= 5.0
+            if hasattr(hdu, 'section'):
+                data = hdu.section[bounds]
+            else:
+                data = hdu.data[bounds]
+            header['NAXIS1'] = data.shape[1]
+            header['NAXIS2'] = data.shape[0]
+            return data, header
+    finally:
+        if is_django_file:
+            fits_file.close()
+
+def process_frame(fits_file, image_size, crop_scale=None, background=None, scaled=True):
+    """
+    Read a FITS file, optionally crop it and normalise its background, and
+    return the frame as an 8-bit image array ready to be passed to an imageio
+    writer. `background` is a dict of keyword arguments for
+    `normalise_background`, or None to skip background normalisation.
+
+    If `scaled` is False, the frame is resized but not scaled, and is returned
+    as a float32 array
+    """
+    data, header = read_frame(fits_file, crop_scale)
+    if background is not None:
+        data = normalise_background(data, header, **background)
+    if not scaled:
+        return resize_frame(data, image_size)
+    return render_frame(data, image_size)
+
+def process_staged_frame(path, *args, **kwargs):
+    """
+    As `process_frame`, for a file in the staging cache: returns None if the
+    file no longer exists (i.e. it has been evicted), so it can be fetched
+    again
+    """
+    try:
+        return process_frame(path, *args, **kwargs)
+    except FileNotFoundError:
+        return None
+
+def get_writer_kwargs(fmt, fps):
+    """
+    Return keyword arguments for `imageio.get_writer` to write a timelapse in
+    the given format
+    """
+    writer_kwargs = {
+        'format': fmt,
+        'mode': 'I',
+        'fps': fps
+    }
+
+    # When saving to MP4 or WebM, imageio uses ffmpeg, which determines
+    # output format from file extension. When using a BytesIO buffer,
+    # imageio creates a temporary file with no extension, so the ffmpeg
+    # call fails. We need to specify the output format explicitly instead
+    # in this case
+    if fmt in (TIMELAPSE_MP4, TIMELAPSE_WEBM):
+        writer_kwargs['output_params'] = ['-f', fmt,'-crf','30','-lossless','1']
+
+        # Need to specify codec for WebM
+        if fmt == TIMELAPSE_WEBM:
+            writer_kwargs['codec'] = 'vp8'
+
+        # The imageio plugin does not recognise webm as a format, so set
+        # 'format' to 'mp4' in either case (this does not affect the ffmpeg
+        # call)
+        writer_kwargs['format'] = TIMELAPSE_MP4
+    return writer_kwargs
+
+def video_properties(path):
+    """
+    Return (frame size, fps) for the video file at the given path
+    """
+    with imageio.get_reader(path, format='ffmpeg') as reader:
+        meta = reader.get_meta_data()
+    return (tuple(meta['size']), meta['fps'])
+
+def concatenate_videos(paths, outfile, fmt):
     """
-    Normalise the background brightness level across the data HDU in the given
-    HDUList
+    Concatenate MP4 or WebM videos with identical encoding parameters into
+    `outfile`, by copying streams (i.e. without re-encoding). Raises
+    subprocess.CalledProcessError on failure
     """
+    list_file = Path(outfile).with_suffix('.txt')
+    list_file.write_text(''.join(f"file '{Path(p).resolve()}'\n" for p in paths))
+    subprocess.run(
+        [imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error', '-f', 'concat',
+         '-safe', '0', '-i', str(list_file), '-c', 'copy', '-f', fmt, str(outfile)],
+        check=True, capture_output=True
+    )
 
-    # Remove negative values and cosmic rays
-    # TODO: get parameters for detect_cosmics and sigma_clip from settings
+def frame_cache_key(content_hash, image_size, crop_scale=None, background=None, scaled=True):
+    """
+    Return the key for a rendered frame in the frame cache, from the hash of
+    the input file and the parameters used to render it
+    """
+    params = {
+        'hash': content_hash,
+        'size': image_size,
+        'crop_scale': crop_scale,
+        'background': background,
+        'scaled': scaled,
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def render_frame(data, image_size, contrast=0.1, gamma_adjust=2.5):
+    """
+    Scale 2D image data to an 8-bit greyscale frame and resize it to fit in a
+    square of side `image_size`, maintaining the aspect ratio.
+
+    This performs the same brightness scaling as fits2image's `fits_to_jpg`,
+    but works on the array directly instead of going via files on disk
+    """
+    h, w = data.shape
+    samples = extract_samples(data, {'NAXIS1': w, 'NAXIS2': h})
+    median = np.median(samples)
+    _, zmax, _ = calc_zscale_min_max(samples, contrast=contrast, iterations=1)
+    scaled = linear_scale(data, median, zmax, gamma_adjust=gamma_adjust)
+
+    im = Image.fromarray(scaled).transpose(Image.FLIP_TOP_BOTTOM)
+    im.thumbnail((image_size, image_size), Image.LANCZOS)
+    return np.asarray(im)
+
+def resize_rendered_frame(frame, image_size):
+    """
+    Resize an 8-bit frame from `render_frame` to fit in a square of side
+    `image_size`
+    """
+    im = Image.fromarray(frame)
+    im.thumbnail((image_size, image_size), Image.LANCZOS)
+    return np.asarray(im)
+
+def resize_frame(data, image_size):
+    """
+    Resize unscaled 2D image data to fit in a square of side `image_size` as
+    for `render_frame`, and return it as a float32 array
+    """
+    im = Image.fromarray(np.asarray(data, dtype=np.float32)).transpose(Image.FLIP_TOP_BOTTOM)
+    im.thumbnail((image_size, image_size), Image.LANCZOS)
+    return np.asarray(im)
 
+def stack_scale_limits(samples, method=SCALING_ZSCALE, contrast=0.1, percentiles=(1, 99.5)):
+    """
+    Compute brightness scaling limits (zmin, zmax) for a whole timelapse from
+    a sample of pixel values. 'zscale' uses the same limits as per-frame
+    scaling (the median and the zscale upper limit); 'percentile' uses the
+    given lower and upper percentiles
+    """
+    if method == SCALING_PERCENTILE:
+        zmin, zmax = np.percentile(samples, percentiles)
+    elif method == SCALING_ZSCALE:
+        samples = np.sort(samples)
+        zmin = np.median(samples)
+        _, zmax, _ = calc_zscale_min_max(samples, contrast=contrast, iterations=1)
+    else:
+        raise ValueError(f"Unknown scaling method '{method}'")
+    return float(zmin), float(zmax)
+
+def scale_frame(data, zmin, zmax, gamma_adjust=2.5):
+    """
+    Scale image data to 8-bit between fixed limits with a gamma adjustment,
+    giving the same result as fits2image's `linear_scale`. The gamma
+    adjustment is applied as a lookup table
+    """
+    if zmax <= zmin:
+        zmin, zmax = zmin - 1, zmax + 1
+    scaled = np.clip(data, zmin, zmax).astype(np.float32)
+    scaled -= zmin
+    scaled *= 255 / (zmax - zmin)
+    lut = gamma_adjust_table(np.uint8, gamma_adjust=gamma_adjust)
+    return np.take(lut, np.rint(scaled).astype(np.intp))
+
+def normalise_background(data, header, method=BACKGROUND_EXACT, **params):
+    """
+    Normalise the background brightness level across the given image data,
+    using the background engine `method`. `params` are passed to the engine
+    function. The data is converted to float32 before processing
+    """
+    try:
+        engine = BACKGROUND_ENGINES[method]
+    except KeyError:
+        raise ValueError(f"Unknown background method '{method}'")
+    data = data.astype(np.float32)
+    return data - engine(data, **params)
+
+def exact_background(data, sigclip=3, sigfrac=0.05, objlim=1, sigma=3, maxiters=10):
+    """
+    Background engine which removes negative values and cosmic rays from the
+    full resolution image, and takes pixels which are not outliers after sigma
+    clipping as the background. This is slow but accurate
+    """
     _, imdata = detect_cosmics(
-        data.clip(0, None), sigclip=3, sigfrac=0.05, objlim=1
+        data.clip(0, None), sigclip=sigclip, sigfrac=sigfrac, objlim=objlim
     )
-    # Perform sigma clipping to normalise background brightness
-    clipped = astropy.stats.sigma_clip(imdata, sigma=3, maxiters=10)
-    data -= clipped.filled(0)
-    return data
+    clipped = astropy.stats.sigma_clip(imdata, sigma=sigma, maxiters=maxiters)
+    return clipped.filled(0)
 
-def crop_image(data, header, scale):
+def mesh_background(data, box_size=64, filter_size=3, sigma=3, maxiters=5):
     """
-    Crop the image in the given HDUList around the centre point. If the
-    original size is (W, H), the cropped size will be (scale * W, scale * H).
+    Background engine which estimates the background in each box of
+    `box_size` x `box_size` pixels as the sigma-clipped median, smooths the
+    resulting mesh with a median filter and interpolates it back to the full
+    image size
+    """
+    blocks = image_blocks(data, box_size)
+    _, mesh, _ = astropy.stats.sigma_clipped_stats(
+        blocks, mask=np.isnan(blocks), sigma=sigma, maxiters=maxiters, axis=2
+    )
+    return upsample_mesh(median_filter(mesh, filter_size), data.shape, box_size)
+
+def median_background(data, box_size=16, filter_size=5):
+    """
+    Background engine which median filters a copy of the image downsampled
+    by taking the median of each box of `box_size` x `box_size` pixels, and
+    interpolates it back to the full image size. This is the fastest engine
+    """
+    mesh = np.nanmedian(image_blocks(data, box_size), axis=2)
+    return upsample_mesh(median_filter(mesh, filter_size), data.shape, box_size)
+
+def image_blocks(data, box_size):
+    """
+    Split a 2D image into boxes of `box_size` x `box_size` pixels, and return
+    an array of shape (rows, columns, box_size ** 2). Boxes at the edges which
+    extend past the image are padded with NaN
+    """
+    h, w = data.shape
+    ny = -(-h // box_size)
+    nx = -(-w // box_size)
+    padded = np.full((ny * box_size, nx * box_size), np.nan, dtype=np.float32)
+    padded[:h, :w] = data
+    return (padded.reshape(ny, box_size, nx, box_size)
+                  .transpose(0, 2, 1, 3)
+                  .reshape(ny, nx, box_size * box_size))
+
+def median_filter(data, size):
+    """
+    Apply a median filter with a `size` x `size` window to a (small) 2D array,
+    extending the edges of the array
+    """
+    if size <= 1:
+        return data
+    before = (size - 1) // 2
+    after = size - 1 - before
+    padded = np.pad(data, ((before, after), (before, after)), mode='edge')
+    h, w = data.shape
+    windows = [padded[i:i + h, j:j + w] for i in range(size) for j in range(size)]
+    return np.median(np.stack(windows), axis=0)
+
+def upsample_mesh(mesh, shape, box_size):
+    """
+    Bilinearly interpolate a mesh of values computed for boxes of `box_size`
+    pixels (see `image_blocks`) to an image of the given shape
+    """
+    def weights(n_boxes, n):
+        # Interpolate between the centres of the (possibly partial) boxes
+        starts = np.arange(n_boxes) * box_size
+        centres = (starts + np.minimum(starts + box_size, n) - 1) / 2
+        if n_boxes == 1:
+            idx = np.zeros(n, dtype=int)
+            return idx, idx, np.zeros(n, dtype=np.float32)
+        pos = np.arange(n)
+        idx = np.clip(np.searchsorted(centres, pos) - 1, 0, n_boxes - 2)
+        frac = np.clip((pos - centres[idx]) / (centres[idx + 1] - centres[idx]), 0, 1)
+        return idx, idx + 1, frac.astype(np.float32)
+
+    h, w = shape
+    mesh = mesh.astype(np.float32)
+    x0, x1, fx = weights(mesh.shape[1], w)
+    rows = mesh[:, x0] * (1 - fx) + mesh[:, x1] * fx
+    y0, y1, fy = weights(mesh.shape[0], h)
+    return rows[y0] * (1 - fy)[:, None] + rows[y1] * fy[:, None]
+
+BACKGROUND_ENGINES = {
+    BACKGROUND_EXACT: exact_background,
+    BACKGROUND_MESH: mesh_background,
+    BACKGROUND_MEDIAN: median_background,
+}
+
+def crop_bounds(shape, scale):
+    """
+    Return a tuple of slices selecting the region of an image of the given
+    (H, W) shape that is kept when cropping by `scale` around the centre point
     """
     if scale < 0 or scale > 1:
         raise ValueError("scale must be in [0, 1]")
-    # idx, data = get_data_index(hdul)
-    h, w = data.shape
+    h, w = shape
     half_h = int(h * 0.5 * scale)
     half_w = int(w * 0.5 * scale)
 
     mid_y = int(h / 2)
     mid_x = int(w / 2)
 
-    data = data[mid_y - half_h:mid_y + half_h, mid_x - half_w:mid_x + half_w]
+    return (slice(mid_y - half_h, mid_y + half_h), slice(mid_x - half_w, mid_x + half_w))
+
+def crop_image(data, header, scale):
+    """
+    Crop the image in the given HDUList around the centre point. If the
+    original size is (W, H), the cropped size will be (scale * W, scale * H).
+    """
+    data = data[crop_bounds(data.shape, scale)]
     new_h, new_w = data.shape
     header['NAXIS1'] = new_w
     header['NAXIS2'] = new_h
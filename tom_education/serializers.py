@@ -1,3 +1,4 @@
+import json
 import os.path
 
 from django.shortcuts import reverse
@@ -21,17 +22,20 @@ class AsyncProcessSerializer(serializers.ModelSerializer):
     terminal_timestamp = TimestampField()
     failure_message = serializers.SerializerMethodField()
     view_url = serializers.SerializerMethodField()
+    eta = serializers.SerializerMethodField()
 
     class Meta:
         model = AsyncProcess
         fields = [
             'identifier', 'created', 'status', 'terminal_timestamp', 'failure_message', 'view_url',
-            'process_type'
+            'process_type', 'eta'
         ]
 
     def get_view_url(self, obj):
         """
-        Special case for PipelineProcess objects: provide link to detail view
+        Special case for PipelineProcess objects: provide link to detail view.
+        Querysets of AsyncProcess objects should use
+        select_related('pipelineprocess') to avoid a query for each object
         """
         if hasattr(obj, 'pipelineprocess'):
             return reverse('tom_education:pipeline_detail', kwargs={'pk': obj.pk})
@@ -40,17 +44,27 @@ class AsyncProcessSerializer(serializers.ModelSerializer):
     def get_failure_message(self, obj):
         return obj.failure_message or None
 
+    def get_eta(self, obj):
+        """
+        Estimated finish time of running PipelineProcess objects
+        """
+        if not isinstance(obj, PipelineProcess):
+            obj = getattr(obj, 'pipelineprocess', None)
+        eta = obj.eta if obj else None
+        return TimestampField().to_representation(eta) if eta else None
+
 
 class PipelineProcessSerializer(AsyncProcessSerializer):
     group_name = serializers.SerializerMethodField()
     group_url = serializers.SerializerMethodField()
     logs = serializers.SerializerMethodField()
+    log_offset = serializers.SerializerMethodField()
 
     class Meta:
         model = PipelineProcess
         fields = [
             'identifier', 'created', 'status', 'terminal_timestamp', 'failure_message', 'view_url',
-            'logs', 'group_name', 'group_url'
+            'logs', 'log_offset', 'group_name', 'group_url', 'eta'
         ]
 
     def get_group_name(self, obj):
@@ -63,21 +77,48 @@ class PipelineProcessSerializer(AsyncProcessSerializer):
             return reverse('tom_dataproducts:group-detail', kwargs={'pk': obj.group.pk})
         return None
 
+    def _get_logs(self, obj):
+        """
+        Return (text, next_offset) for logs from the offset given in the
+        serializer context. Logs are only fetched once per object, so that the
+        text and offset are consistent
+        """
+        if getattr(self, '_logs_for', None) != obj.pk:
+            self._logs_for = obj.pk
+            self._logs = obj.get_logs(offset=self.context.get('log_offset', 0))
+        return self._logs
+
     def get_logs(self, obj):
+        return self._get_logs(obj)[0]
+
+    def get_log_offset(self, obj):
         """
-        Make sure logs is always a string
+        Offset to request in the next call to get new log lines only
         """
-        return obj.logs or ''
+        return self._get_logs(obj)[1]
 
 
 class TargetSerializer(serializers.ModelSerializer):
     """
     Serialize a subset of the Target fields, plus any extra fields
     """
+    extra_fields = serializers.SerializerMethodField()
+
     class Meta:
         model = Target
         fields = ['name', 'extra_fields']
 
+    def get_extra_fields(self, obj):
+        """
+        Use the extra fields prefetched as `defined_extras` by
+        TargetListApiView if present
+        """
+        extras = getattr(obj, 'defined_extras', None)
+        if extras is None:
+            return obj.extra_fields
+        types = {extra_field['name']: extra_field['type'] for extra_field in settings.EXTRA_FIELDS}
+        return {te.key: te.typed_value(types[te.key]) for te in extras}
+
 class PhotometrySerializer(serializers.Serializer):
     """
     Serializer for photometry data file URL and image
@@ -95,6 +136,9 @@ class PhotometrySerializer(serializers.Serializer):
         return full_url
 
     def get_plot(self, obj):
+        # TargetListApiView fetches the latest plot for all targets at once
+        if hasattr(obj, 'latest_plot'):
+            return obj.latest_plot.data.url if obj.latest_plot else None
         try:
             dp = DataProduct.objects.filter(target=obj, data_product_type='plot').latest('created')
             return dp.data.url
@@ -105,16 +149,26 @@ class PhotometrySerializer(serializers.Serializer):
 class TimelapsePipelineSerializer(serializers.Serializer):
     """
     Serialize basic info for a timelapse from a TimelapsePipeline object,
-    including the (relative) URL to the actual timelapse file
+    including the (relative) URL to the actual timelapse file. If several
+    variants were created (see the 'outputs' timelapse setting), the
+    top-level fields describe the first, and all are listed in `variants`
     """
     name = serializers.SerializerMethodField()
     format = serializers.SerializerMethodField()
     url = serializers.SerializerMethodField()
     created = serializers.SerializerMethodField()
     frames = serializers.SerializerMethodField()
+    variants = serializers.SerializerMethodField()
+
+    def _get_dataproducts(self, obj):
+        """
+        Return the timelapse files in the order the variants were created.
+        This uses group__dataproduct_set if it has been prefetched
+        """
+        return sorted(obj.group.dataproduct_set.all(), key=lambda dp: dp.pk)
 
     def _get_dataproduct(self, obj):
-        return obj.group.dataproduct_set.first()
+        return self._get_dataproducts(obj)[0]
 
     def get_name(self, obj):
         return os.path.basename(self._get_dataproduct(obj).data.name)
@@ -129,7 +183,25 @@ class TimelapsePipelineSerializer(serializers.Serializer):
     def get_created(self, obj):
         return TimestampField().to_representation(obj.terminal_timestamp)
 
+    def get_variants(self, obj):
+        variants = []
+        for dp in self._get_dataproducts(obj):
+            try:
+                size = json.loads(dp.extra_data).get('size')
+            except (ValueError, AttributeError):
+                size = None
+            variants.append({
+                'format': dp.data.name.split('.')[-1],
+                'size': size,
+                'url': dp.data.url,
+            })
+        return variants
+
     def get_frames(self, obj):
+        # Use the count annotated by TargetDetailApiView if present
+        frame_count = getattr(obj, 'frame_count', None)
+        if frame_count is not None:
+            return frame_count
         return obj.input_files.count()
 
 
@@ -0,0 +1,52 @@
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from tom_dataproducts.models import DataProduct
+from tom_targets.models import Target, TargetExtra
+
+from tom_education.events import clear_event_broker
+from tom_education.file_cache import clear_file_caches
+from tom_education.models import AsyncProcess, clear_pipeline_registry, index_data_product
+from tom_education.views import clear_target_api_cache
+
+
+@receiver(post_save, sender=DataProduct)
+def data_product_saved(sender, instance, **kwargs):
+    """
+    Extract FITS header metadata when a data product is ingested
+    """
+    index_data_product(instance)
+
+
+@receiver(setting_changed)
+def pipelines_setting_changed(sender, setting, **kwargs):
+    """
+    Reload pipelines when they are changed in settings (e.g. in tests)
+    """
+    if setting == 'TOM_EDUCATION_PIPELINES':
+        clear_pipeline_registry()
+
+
+@receiver(setting_changed)
+def pipeline_settings_changed(sender, setting, **kwargs):
+    """
+    Reconnect to the event broker and recreate file caches when pipeline or
+    timelapse settings are changed
+    """
+    if setting == 'TOM_EDUCATION_PIPELINE_SETTINGS':
+        clear_event_broker()
+    if setting in ('TOM_EDUCATION_PIPELINE_SETTINGS', 'TOM_EDUCATION_TIMELAPSE_SETTINGS'):
+        clear_file_caches()
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def target_api_data_changed(sender, instance, **kwargs):
+    """
+    Clear the cached target detail API response when the target or anything
+    included in the response changes
+    """
+    if isinstance(instance, Target):
+        clear_target_api_cache(instance.pk)
+    elif isinstance(instance, (TargetExtra, DataProduct, AsyncProcess)) and instance.target_id is not None:
+        clear_target_api_cache(instance.target_id)
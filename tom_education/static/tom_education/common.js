@@ -25,3 +25,39 @@ function truncate(str, max_length) {
     }
     return str.substr(0, max_length - 3) + '...';
 }
+
+/*
+ * Call `update` whenever the server pushes an event on the event stream at
+ * `url`, or every AJAX_POLL_INTERVAL milliseconds if event streams are not
+ * available. `handlers` maps event types to functions called with the
+ * MessageEvent
+ */
+function subscribeOrPoll(url, handlers, update) {
+    var poller = null;
+    function startPolling() {
+        if (poller === null) {
+            update();
+            poller = window.setInterval(update, AJAX_POLL_INTERVAL);
+        }
+    }
+
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+    var source = new EventSource(url);
+    // Catch up on changes made before (re)connecting
+    source.onopen = function() {
+        update();
+    };
+    for (var type in handlers) {
+        source.addEventListener(type, handlers[type]);
+    }
+    source.onerror = function() {
+        // Browsers reconnect automatically unless the server refused the
+        // stream (e.g. because events are not enabled)
+        if (source.readyState === EventSource.CLOSED) {
+            startPolling();
+        }
+    };
+}
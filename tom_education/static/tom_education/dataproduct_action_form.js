@@ -11,27 +11,56 @@ var $PIPELINE_HIDDEN = $('input[name=pipeline_name]');
 var first_api_response_time = null;
 
 /*
- * Start periodically polling the API to get info on processes for the given
- * target
+ * Keep the displayed statuses of processes for the given target up to date.
+ * Statuses are fetched whenever the server pushes an event saying that a
+ * process has changed, or periodically if event streams are not available
  */
-function startStatusPolling(target_pk) {
-    var process_statuses = null;
+function startStatusUpdates(target_pk) {
+    // Processes received so far, keyed by identifier. After the first
+    // request, only processes which have changed since the previous response
+    // are requested
+    var processes = {};
+    var since = null;
+    var etag = null;
 
-    window.setInterval(function() {
+    function fetchStatuses() {
         // TODO: don't hardcode URL
         var url = '/api/async/status/' + target_pk + '/';
-        $.get(url, function(data) {
+        $.ajax({
+            'url': url,
+            'data': since === null ? {} : {'since': since},
+            'headers': etag === null ? {} : {'If-None-Match': etag},
+            'dataType': 'json',
+        }).done(function(data, textStatus, xhr) {
+            // Nothing has changed
+            if (xhr.status === 304) {
+                return;
+            }
             if (first_api_response_time === null) {
                 first_api_response_time = data.timestamp;
             }
-            if (JSON.stringify(process_statuses) !== JSON.stringify(data)) {
-                process_statuses = data;
-                showProcesses(process_statuses.processes);
+            var first_response = (since === null);
+            if (!first_response && data.processes.length === 0) {
+                // Nothing new: keep polling with the same 'since', which the
+                // ETag is only valid for
+                etag = xhr.getResponseHeader('ETag');
+            } else {
+                since = data.timestamp;
+                etag = null;
+                for (var i=0; i<data.processes.length; i++) {
+                    processes[data.processes[i].identifier] = data.processes[i];
+                }
+                var sorted = Object.values(processes).sort(function(a, b) {
+                    return b.created - a.created;
+                });
+                showProcesses(sorted);
             }
-        }, 'json').fail(function() {
+        }).fail(function() {
             showError('Failed to retrieve process statuses');
         });
-    }, AJAX_POLL_INTERVAL);
+    }
+
+    subscribeOrPoll('/api/async/stream/' + target_pk + '/', {'status': fetchStatuses}, fetchStatuses);
 }
 
 /*
@@ -141,4 +170,4 @@ $PIPELINE_SELECT.change(function() {
     }
 });
 
-startStatusPolling($FORM.data('target'));
+startStatusUpdates($FORM.data('target'));
@@ -1,14 +1,22 @@
 const URL = '/api/pipeline/logs/' + PIPELINE_PROCESS_PK + '/';
+const CANCEL_URL = '/api/pipeline/cancel/' + PIPELINE_PROCESS_PK + '/';
+const STREAM_URL = '/api/pipeline/stream/' + PIPELINE_PROCESS_PK + '/';
+const TERMINAL_STATES = ['created', 'failed', 'cancelled'];
 var $CREATED      = $('#process-created');
 var $STATUS       = $('#process-status');
 var $FINISHED     = $('#process-finished');
 var $OUTPUTS      = $('#process-outputs-link');
+var $CANCEL       = $('#cancel-process');
 var $FOLLOW_LOGS  = $('#follow-logs')[0];
 var $LOGS_WRAPPER = $('pre.logs');
 var $LOGS         = $LOGS_WRAPPER.find('code');
+// Offset of the next log line to fetch: only new lines are requested on each
+// update
+var logOffset     = 0;
 
-window.setInterval(function() {
-    $.get(URL, function(data) {
+function fetchProcess() {
+    var offset = logOffset;
+    $.get(URL, {'offset': offset}, function(data) {
         $CREATED.text(getDateString(data.created));
 
         var status_text = capitaliseFirst(data.status);
@@ -17,6 +25,8 @@ window.setInterval(function() {
         }
         $STATUS.text(status_text);
 
+        $CANCEL.toggle(!TERMINAL_STATES.includes(data.status));
+
         var finished_text = data.terminal_timestamp ? getDateString(data.terminal_timestamp) : 'N/A';
         $FINISHED.text(finished_text);
 
@@ -32,14 +42,62 @@ window.setInterval(function() {
             $OUTPUTS.text('N/A');
         }
 
-        $LOGS.text(data.logs);
-        // Scroll logs element if the user wishes
-        if ($FOLLOW_LOGS.checked) {
-            $LOGS_WRAPPER.animate({
-                'scrollTop': $LOGS.height(),
-            }, 1000, 'linear');
+        // Lines pushed by the server while this request was in progress have
+        // already been shown
+        if (offset !== logOffset) {
+            return;
+        }
+        if (logOffset === 0) {
+            $LOGS.text(data.logs);
         }
+        else if (data.logs) {
+            $LOGS.text($LOGS.text() + data.logs);
+        }
+        logOffset = data.log_offset;
+        followLogs();
     }, 'json').fail(function() {
         showError('Failed to retrieve process information');
     });
-}, AJAX_POLL_INTERVAL);
+}
+
+/*
+ * Append a log line pushed by the server, or fetch the missing lines if some
+ * were missed
+ */
+function appendLogLine(event) {
+    var line = JSON.parse(event.data);
+    if (line.index < logOffset) {
+        return;
+    }
+    if (line.index > logOffset) {
+        fetchProcess();
+        return;
+    }
+    $LOGS.text($LOGS.text() + line.text);
+    logOffset = line.index + 1;
+    followLogs();
+}
+
+/*
+ * Scroll logs element if the user wishes
+ */
+function followLogs() {
+    if ($FOLLOW_LOGS.checked) {
+        $LOGS_WRAPPER.animate({
+            'scrollTop': $LOGS.height(),
+        }, 1000, 'linear');
+    }
+}
+
+subscribeOrPoll(STREAM_URL, {'status': fetchProcess, 'log': appendLogLine}, fetchProcess);
+
+$CANCEL.click(function() {
+    $CANCEL.prop('disabled', true);
+    $.ajax({
+        'url': CANCEL_URL,
+        'method': 'POST',
+        'headers': {'X-CSRFToken': CSRF_TOKEN},
+    }).always(function() {
+        $CANCEL.text('Cancelling...');
+    });
+});
@@ -1,15 +1,36 @@
+from contextlib import contextmanager
 import sys
 import logging
 
+from django.utils.module_loading import import_string
 import dramatiq
+from dramatiq.middleware.time_limit import TimeLimitExceeded
+from dramatiq.rate_limits import ConcurrentRateLimiter
 from redis.exceptions import RedisError
 
 from tom_education.models import (
-    AsyncError, ASYNC_STATUS_FAILED, PipelineProcess
+    AsyncError, ASYNC_STATUS_CANCELLED, ASYNC_STATUS_FAILED, PipelineChunk, PipelineProcess,
+    ProcessCancelled
 )
 
 logger = logging.getLogger(__name__)
 
+# Time limit in milliseconds for pipeline tasks
+PIPELINE_TIME_LIMIT = 3600_000
+# Delay in milliseconds before retrying a pipeline task which could not start
+# because its pipeline was at its concurrency limit
+CONCURRENCY_RETRY_DELAY = 10_000
+# Minimum delay in milliseconds before retrying a failed run of a pipeline
+# which uses checkpoints
+RETRY_MIN_BACKOFF = 5_000
+
+# Actors for pipeline tasks on non-default queues or priorities, keyed by
+# (actor name, queue name, priority)
+_pipeline_actors = {}
+# Rate limiter backend for pipeline concurrency limits, created on first use
+_concurrency_backend = None
+
+
 def task(**kwargs):
     """
     Decorator that wraps dramatiq.actor, but runs tasks synchronously during
@@ -19,6 +40,7 @@ def task(**kwargs):
         if 'test' not in sys.argv:
             return dramatiq.actor(func, **kwargs)
         func.send = func
+        func.send_with_options = lambda args=(), **options: func(*args)
         return func
     return wrap
 
@@ -27,13 +49,28 @@ def send_task(task, process, *args):
     """
     Wrapper around queuing a task to start an AsyncProcess sub-class, which
     sets the status and failure message of the process if an exception occurs
-    when submitting.
+    when submitting. The task is sent to the queue and priority of the
+    process's class (see get_pipeline_actor()).
+
+    For pipelines, the run time is estimated first: the process fails without
+    being queued if the estimate is too long, and otherwise the task's time
+    limit is set from the estimate.
 
     The task must accept the process's PK as its first argument. *args are
     forwarded to the task.
     """
+    options = {}
+    if isinstance(process, PipelineProcess):
+        try:
+            process.estimate_duration()
+        except AsyncError as ex:
+            process.status = ASYNC_STATUS_FAILED
+            process.failure_message = str(ex)
+            process.save()
+            return
+        options = get_message_options(process)
     try:
-        task.send(process.pk, *args)
+        get_pipeline_actor(task, process.__class__).send_with_options(args=(process.pk, *args), **options)
     except RedisError as ex:
         logger.error('failed to submit job: {}'.format(ex))
         process.status = ASYNC_STATUS_FAILED
@@ -41,7 +78,120 @@ def send_task(task, process, *args):
         process.save()
 
 
-@task(time_limit=3600_000, max_retries=0)
+def get_message_options(process):
+    """
+    Return the dramatiq message options for tasks running a PipelineProcess:
+    the time limit, and retries for pipelines which use checkpoints. These
+    are used for every message for the process, including when it is
+    deferred or split into chunks
+    """
+    options = {'time_limit': get_time_limit_ms(process)}
+    if process.checkpoints and process.max_retries:
+        # Let dramatiq retry the message so the run resumes from its
+        # checkpoints (see run_process())
+        options['max_retries'] = process.max_retries
+        options['min_backoff'] = RETRY_MIN_BACKOFF
+    return options
+
+
+def get_time_limit_ms(process):
+    """
+    Return the time limit for tasks running a PipelineProcess in milliseconds
+    """
+    return int(process.get_time_limit() * 1000)
+
+
+def get_pipeline_actor(task, process_cls):
+    """
+    Return an actor which runs the same function as `task`, on the queue and
+    with the priority given by the `queue_name` and `priority` attributes of
+    `process_cls`. Actors are created once per queue and priority, and are
+    named after them so that workers and the web server agree on the names
+    """
+    queue_name = getattr(process_cls, 'queue_name', None)
+    priority = getattr(process_cls, 'priority', 0)
+    if not isinstance(task, dramatiq.Actor):
+        return task
+    if queue_name in (None, task.queue_name) and priority == task.priority:
+        return task
+
+    queue_name = queue_name or task.queue_name
+    key = (task.actor_name, queue_name, priority)
+    if key not in _pipeline_actors:
+        _pipeline_actors[key] = dramatiq.actor(
+            task.fn,
+            actor_name=f'{task.actor_name}_{queue_name}_{priority}',
+            queue_name=queue_name,
+            priority=priority,
+            broker=task.broker,
+            **task.options
+        )
+    return _pipeline_actors[key]
+
+
+def declare_pipeline_actors():
+    """
+    Create the actors for all pipelines in settings, so that workers can
+    process messages on their queues
+    """
+    registry = PipelineProcess.get_registry()
+    for pipeline_cls in registry.pipelines.values():
+        for pipeline_task in (run_pipeline, run_pipeline_chunk, run_pipeline_reduce):
+            get_pipeline_actor(pipeline_task, pipeline_cls)
+
+
+def get_concurrency_backend():
+    """
+    Return the dramatiq rate limiter backend used to enforce the
+    `max_concurrency` limit of pipelines across workers. This is configured
+    with the 'concurrency_backend' pipeline setting, and defaults to Redis
+    (or an in-memory stub during tests)
+    """
+    global _concurrency_backend
+    if _concurrency_backend is None:
+        default = {
+            'BACKEND': ('dramatiq.rate_limits.backends.StubBackend' if 'test' in sys.argv
+                        else 'dramatiq.rate_limits.backends.RedisBackend'),
+        }
+        config = PipelineProcess.get_pipeline_settings().get('concurrency_backend', default)
+        _concurrency_backend = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+    return _concurrency_backend
+
+
+@contextmanager
+def pipeline_slot(process):
+    """
+    Context manager which acquires one of the `max_concurrency` slots shared
+    by all runs of the pipeline for `process`, and yields whether a slot was
+    available. Slots expire after the process's time limit in case a worker
+    dies while holding one
+    """
+    pipeline_cls = process.__class__
+    if not pipeline_cls.max_concurrency:
+        yield True
+        return
+    limiter = ConcurrentRateLimiter(
+        get_concurrency_backend(),
+        f'tom_education_pipeline_{pipeline_cls.__name__}',
+        limit=pipeline_cls.max_concurrency,
+        ttl=get_time_limit_ms(process)
+    )
+    with limiter.acquire(raise_on_failure=False) as acquired:
+        yield acquired
+
+
+def defer_task(task, process, *args):
+    """
+    Queue `task` for a PipelineProcess to be tried again after
+    CONCURRENCY_RETRY_DELAY
+    """
+    logger.info(f'{process.__class__.__name__} is at its concurrency limit: retrying later')
+    get_pipeline_actor(task, process.__class__).send_with_options(
+        args=args, delay=CONCURRENCY_RETRY_DELAY, **get_message_options(process)
+    )
+
+
+@task(time_limit=PIPELINE_TIME_LIMIT, max_retries=0)
 def run_pipeline(process_pk, cls_name):
     """
     Task to run a PipelineProcess sub-class. `cls_name` is the name of the
@@ -58,35 +208,138 @@ def run_pipeline(process_pk, cls_name):
         logger.error('could not find {} with PK {}'.format(pipeline_cls.__name__, process_pk),
               file=sys.stderr)
         return
-    run_process(process)
+    with pipeline_slot(process) as acquired:
+        if not acquired:
+            defer_task(run_pipeline, process, process_pk, cls_name)
+        elif process.chunk_size:
+            run_process(process, lambda: start_chunks(process, cls_name))
+        else:
+            run_process(process)
 
 
-def run_process(process):
+def start_chunks(process, cls_name):
     """
-    Helper function to call the run() method of an AsyncProcess, catch errors,
-    and update statuses and error messages.
+    Split the input files of a map/reduce pipeline into chunks, and queue a
+    task to run the map step for each
+    """
+    process.check_inputs()
+    if process.reuse_previous_outputs():
+        return
+    process.start()
+    chunks = process.create_chunks()
+    process.log(f'Processing {process.input_files.count()} files in {len(chunks)} chunks')
+    chunk_task = get_pipeline_actor(run_pipeline_chunk, process.__class__)
+    for chunk in chunks:
+        chunk_task.send_with_options(args=(chunk.pk, cls_name), **get_message_options(process))
+
+
+@task(time_limit=PIPELINE_TIME_LIMIT, max_retries=0)
+def run_pipeline_chunk(chunk_pk, cls_name):
+    """
+    Task to run the map step for a PipelineChunk. The task which finishes the
+    last chunk queues the reduce step
+    """
+    pipeline_cls = PipelineProcess.get_subclass(cls_name)
+    try:
+        chunk = PipelineChunk.objects.get(pk=chunk_pk)
+        process = pipeline_cls.objects.get(pk=chunk.process_id)
+    except (PipelineChunk.DoesNotExist, pipeline_cls.DoesNotExist):
+        logger.error('could not find pipeline chunk with PK {}'.format(chunk_pk))
+        return
+
+    def run():
+        if process.run_chunk(chunk):
+            get_pipeline_actor(run_pipeline_reduce, pipeline_cls).send_with_options(
+                args=(process.pk, cls_name), **get_message_options(process)
+            )
+
+    with pipeline_slot(process) as acquired:
+        if not acquired:
+            defer_task(run_pipeline_chunk, process, chunk_pk, cls_name)
+        else:
+            run_process(process, run)
+
+
+@task(time_limit=PIPELINE_TIME_LIMIT, max_retries=0)
+def run_pipeline_reduce(process_pk, cls_name):
+    """
+    Task to run the reduce step of a map/reduce pipeline once all chunks have
+    finished
+    """
+    pipeline_cls = PipelineProcess.get_subclass(cls_name)
+    try:
+        process = pipeline_cls.objects.get(pk=process_pk)
+    except pipeline_cls.DoesNotExist:
+        logger.error('could not find {} with PK {}'.format(pipeline_cls.__name__, process_pk))
+        return
+    with pipeline_slot(process) as acquired:
+        if not acquired:
+            defer_task(run_pipeline_reduce, process, process_pk, cls_name)
+        else:
+            run_process(process, process.run_reduce)
+
+
+def run_process(process, run=None):
+    """
+    Helper function to call the run() method of an AsyncProcess (or the
+    function `run`, if given), catch errors, and update statuses and error
+    messages.
+
+    If the run() method of a pipeline which uses checkpoints fails
+    unexpectedly and has retries left, the exception is re-raised instead so
+    that dramatiq retries the message.
 
     Note that this runs in the dramatiq worker processes.
     """
     logger.info("running process")
     failure_message = None
     try:
-        process.run()
-    except AsyncError as ex:
-        failure_message = str(ex)
-    except NotImplementedError as ex:
-        logger.error('S3 not configured correctly: {}'.format(ex))
-        failure_message = str(ex)
-    except TypeError as ex:
-        logger.error('Unexpected input type: {}'.format(ex))
-        failure_message = 'Unexpected input type'
-    except Exception as ex:
-        logger.error('unknown error occurred: {}'.format(ex))
-        failure_message = f'An unexpected error occurred {ex}'
+        if run is None:
+            process.run()
+        else:
+            run()
+    except ProcessCancelled:
+        logger.info('process cancelled')
+        process.log('Cancelled')
+        process.status = ASYNC_STATUS_CANCELLED
+        process.save()
+        process.clear_checkpoints()
+        return
+    except (Exception, TimeLimitExceeded) as ex:
+        # Only whole runs are retried: map/reduce chunks fail the process
+        if run is None and isinstance(process, PipelineProcess) and process.should_retry(ex):
+            logger.warning(f'run failed: {ex}: retrying')
+            process.log(f'Attempt {process.attempts} failed: retrying from last checkpoint')
+            raise
+        failure_message = get_failure_message(ex)
 
     if failure_message is not None:
         logger.error('task failed: {}'.format(failure_message))
         process.failure_message = failure_message
         process.status = ASYNC_STATUS_FAILED
         process.save()
+        if isinstance(process, PipelineProcess):
+            process.clear_checkpoints()
     logger.info('process finished')
+
+
+def get_failure_message(ex):
+    """
+    Return the failure message to show for a process which raised `ex`
+    """
+    if isinstance(ex, AsyncError):
+        return str(ex)
+    if isinstance(ex, NotImplementedError):
+        logger.error('S3 not configured correctly: {}'.format(ex))
+        return str(ex)
+    if isinstance(ex, TypeError):
+        logger.error('Unexpected input type: {}'.format(ex))
+        return 'Unexpected input type'
+    if isinstance(ex, TimeLimitExceeded):
+        return 'Process took longer than its time limit'
+    logger.error('unknown error occurred: {}'.format(ex))
+    return f'An unexpected error occurred {ex}'
+
+
+if 'test' not in sys.argv:
+    declare_pipeline_actors()
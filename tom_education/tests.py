@@ -1,23 +1,34 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import hashlib
 from io import BytesIO, StringIO
 import json
 import os
-from unittest.mock import patch
+from pathlib import Path
+from unittest.mock import Mock, patch, PropertyMock
 import tempfile
 
 from astropy.io import fits
 from django import forms
 from django.core import mail
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.core.files.storage import FileSystemStorage
 from django.core.files.uploadedfile import File
 from django.core.management import call_command
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction
 from django.db.models.query import QuerySet
 from django.urls import reverse
+from django.utils.module_loading import import_string
 from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
+from fits2image.scaling import get_scaled_image, linear_scale
 from guardian.shortcuts import assign_perm
+import dramatiq
+from dramatiq.brokers.stub import StubBroker
+from dramatiq.rate_limits import ConcurrentRateLimiter
 import imageio
 import numpy as np
 from tom_dataproducts.models import DataProduct, ReducedDatum, DataProductGroup
@@ -26,27 +37,48 @@ from tom_observations.models import ObservationRecord
 from tom_observations.tests.factories import ObservingRecordFactory
 from tom_observations.tests.utils import FakeFacility, FakeFacilityForm
 
+from tom_education.events import get_event_broker
+from tom_education.file_cache import FileCache
 from tom_education.forms import DataProductActionForm, GalleryForm
 from tom_education.facilities import EducationLCOForm
 from tom_education.models import (
+    ASYNC_STATUS_CANCELLED,
     ASYNC_STATUS_CREATED,
     ASYNC_STATUS_FAILED,
     ASYNC_STATUS_PENDING,
     AsyncError,
     AsyncProcess,
+    BACKGROUND_EXACT,
+    BACKGROUND_MEDIAN,
+    BACKGROUND_MESH,
     crop_image,
+    DataProductMetadata,
+    frame_cache_key,
+    get_content_hash,
     InvalidPipelineError,
+    normalise_background,
     ObservationAlert,
     ObservationTemplate,
     PipelineProcess,
     PipelineOutput,
+    ProcessCancelled,
+    process_frame,
+    read_fits_metadata,
+    read_frame,
+    render_frame,
+    scale_frame,
+    SCALING_PERCENTILE,
+    SCALING_ZSCALE,
+    stack_scale_limits,
     TIMELAPSE_GIF,
     TIMELAPSE_MP4,
     TIMELAPSE_WEBM,
     TimelapsePipeline,
 )
 from tom_education.templatetags.tom_education_extras import dataproduct_selection_buttons
-from tom_education.tasks import run_pipeline
+from tom_education.tasks import (
+    defer_task, get_pipeline_actor, pipeline_slot, RETRY_MIN_BACKOFF, run_pipeline, run_process, send_task
+)
 
 
 class FakeTemplateFacilityForm(FakeFacilityForm):
@@ -91,6 +123,32 @@ def write_fits_image_file(data, date=None):
     return buf
 
 
+class RemoteStorage(FileSystemStorage):
+    """
+    Storage backend which does not provide local paths to files, like remote
+    storage backends
+    """
+    def path(self, name):
+        raise NotImplementedError
+
+    def _open(self, name, mode='rb'):
+        return File(open(super().path(name), mode))
+
+    def _save(self, name, content):
+        path = super().path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            for chunk in content.chunks():
+                f.write(chunk)
+        return name
+
+    def exists(self, name):
+        return os.path.exists(super().path(name))
+
+    def size(self, name):
+        return os.path.getsize(super().path(name))
+
+
 class TestDataHandler:
     """
     Small class to handle creating and deleting temporary directories to use as
@@ -431,11 +489,6 @@ class TargetDataViewTestCase(DataProductTestCase):
         })
 
 
-def mock_fits_to_jpg(inputfiles, outputfile, **kwargs):
-    f = open(outputfile, 'wb')
-    f.close()
-    return True
-
 @override_settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={
     'format': 'gif', 'fps': 10, 'size': 500, 'crop_scale': 0.5
 })
@@ -545,6 +598,55 @@ class TimelapseTestCase(DataProductTestCase):
         pipeline = self.create_timelapse_pipeline(self.prods)
         self.assertEqual(pipeline.sorted_frames(), correct_order)
 
+    def test_observation_date_index(self):
+        """
+        FITS header metadata should be stored when data products are saved,
+        and used to sort frames without reading the files again
+        """
+        prod = self.prods[3]
+        self.assertEqual(prod.metadata.date_obs.replace(tzinfo=None),
+                         datetime(year=2019, month=1, day=2, hour=3, minute=6))
+        self.assertEqual(prod.metadata.naxis1, self.test_fits_shape[1])
+        self.assertEqual(prod.metadata.naxis2, self.test_fits_shape[0])
+        self.assertEqual(prod.metadata.data_name, prod.data.name)
+
+        correct_order = [self.prods[0], self.prods[1], self.prods[3], self.prods[2]]
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        with patch('tom_education.models.timelapse.DataProductMetadata.index') as index_mock:
+            self.assertEqual(pipeline.sorted_frames(), correct_order)
+            index_mock.assert_not_called()
+
+        # Without an index entry, the header should be read and the index
+        # updated
+        DataProductMetadata.objects.filter(data_product=prod).delete()
+        pipeline = TimelapsePipeline.objects.get(pk=pipeline.pk)
+        self.assertEqual(pipeline.sorted_frames(), correct_order)
+        self.assertTrue(DataProductMetadata.objects.filter(data_product=prod).exists())
+
+    def test_content_hash_computed_lazily(self):
+        """
+        Saving a data product should only read its headers; the content hash
+        should be computed and stored the first time it is needed
+        """
+        prod = self.prods[0]
+        self.assertEqual(prod.metadata.content_hash, '')
+
+        prod = DataProduct.objects.get(pk=prod.pk)
+        content_hash = get_content_hash(prod)
+        prod.data.open('rb')
+        with prod.data:
+            self.assertEqual(content_hash, hashlib.sha256(prod.data.read()).hexdigest())
+        self.assertEqual(DataProductMetadata.objects.get(data_product=prod).content_hash, content_hash)
+
+        # The stored hash should be used from now on, and kept when the
+        # headers are read again
+        prod = DataProduct.objects.get(pk=prod.pk)
+        with patch('tom_education.models.data_product_metadata.hash_file') as hash_mock:
+            self.assertEqual(get_content_hash(prod), content_hash)
+            DataProductMetadata.index(prod)
+            hash_mock.assert_not_called()
+        self.assertEqual(DataProductMetadata.objects.get(data_product=prod).content_hash, content_hash)
+
     def test_multiple_observations(self):
         """
         Should be able to create a timelapse of data from several observations
@@ -578,6 +680,223 @@ class TimelapseTestCase(DataProductTestCase):
         # Check the size of the first frame
         self.assertEqual(frames[0].shape, self.image_data.shape)
 
+    @patch('tom_education.models.pipelines.CANCEL_CHECK_INTERVAL', 0)
+    def test_cancel_timelapse(self):
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        def log(msg):
+            if msg.startswith('Processing frame'):
+                pipeline.request_cancel()
+
+        with patch.object(TimelapsePipeline, 'log', side_effect=log) as log_mock:
+            with self.assertRaises(ProcessCancelled):
+                pipeline.write_timelapse(BytesIO(), fmt='gif')
+        # Should stop at the checkpoint after the first frame
+        log_mock.assert_called_with(f'Processing frame 1/{len(self.prods)}')
+
+        # With stack scaling, cancellation should take effect while frames
+        # are rendered, before the scaling is computed
+        pipeline2 = self.create_timelapse_pipeline(self.prods)
+        def log2(msg):
+            if msg.startswith('Processing frame'):
+                pipeline2.request_cancel()
+
+        tl_settings = {'scaling': {'method': 'zscale'}}
+        with self.settings(TOM_EDUCATION_TIMELAPSE_SETTINGS=tl_settings), \
+                patch.object(TimelapsePipeline, 'log', side_effect=log2) as log_mock:
+            with self.assertRaises(ProcessCancelled):
+                pipeline2.write_timelapse(BytesIO(), fmt='gif')
+        log_mock.assert_called_with(f'Processing frame 1/{len(self.prods)}')
+        self.assertFalse(any(c.args[0].startswith('Scaling all frames') for c in log_mock.call_args_list))
+
+    def test_checkpoint_resume(self):
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        calls = []
+
+        def process_frame_mock(*args):
+            calls.append(args)
+            if len(calls) == 3:
+                raise RuntimeError('worker died')
+            return process_frame(*args)
+
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                self.settings(TOM_EDUCATION_PIPELINE_SETTINGS={'checkpoint_dir': tmpdir}), \
+                patch.object(TimelapsePipeline, 'checkpoints', True), \
+                patch('tom_education.models.timelapse.process_frame', side_effect=process_frame_mock):
+            with self.assertRaises(RuntimeError):
+                pipeline.write_timelapse(BytesIO(), fmt='gif')
+            self.assertEqual(len(list(pipeline.get_checkpoint_dir().glob('*/*'))), 2)
+
+            # Retrying should only render the frames after the checkpoint
+            calls.clear()
+            pipeline.write_timelapse(BytesIO(), fmt='gif')
+            self.assertEqual(len(calls), len(self.prods) - 2)
+
+            pipeline.clear_checkpoints()
+            self.assertFalse(pipeline.get_checkpoint_dir().exists())
+
+    def test_parallel_rendering(self):
+        """
+        Rendering frames in a process pool should give the same timelapse as
+        rendering them sequentially
+        """
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        sequential_buf = BytesIO()
+        pipeline.write_timelapse(sequential_buf, fmt='gif')
+
+        with self.settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={'workers': 2}):
+            parallel_buf = BytesIO()
+            pipeline.write_timelapse(parallel_buf, fmt='gif')
+        self.assertEqual(parallel_buf.getvalue(), sequential_buf.getvalue())
+        self.assertIn(f'Processing frame {len(self.prods)}/{len(self.prods)}', pipeline.logs)
+
+    def test_frame_cache(self):
+        """
+        Frames rendered in one run should be reused by later runs with the
+        same render parameters
+        """
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        uncached_buf = BytesIO()
+        pipeline.write_timelapse(uncached_buf, fmt='gif')
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            tl_settings = {'frame_cache': {'path': cache_dir, 'max_bytes': 10 ** 7}}
+            with self.settings(TOM_EDUCATION_TIMELAPSE_SETTINGS=tl_settings):
+                with patch('tom_education.models.timelapse.process_frame', wraps=process_frame) as render_mock:
+                    buf = BytesIO()
+                    pipeline.write_timelapse(buf, fmt='gif')
+                    self.assertEqual(render_mock.call_count, len(self.prods))
+                    self.assertEqual(buf.getvalue(), uncached_buf.getvalue())
+
+                    # Second run should not render any frames
+                    buf = BytesIO()
+                    pipeline.write_timelapse(buf, fmt='gif')
+                    self.assertEqual(render_mock.call_count, len(self.prods))
+                    self.assertEqual(buf.getvalue(), uncached_buf.getvalue())
+                    self.assertIn(f'Using {len(self.prods)} cached frames', pipeline.logs)
+
+                    # Different render parameters should not use the cache
+                    pipeline.write_timelapse(BytesIO(), fmt='gif', image_size=100)
+                    self.assertEqual(render_mock.call_count, 2 * len(self.prods))
+
+    def test_stage_input_files(self):
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        # Files in local storage should be used in place
+        prods = list(pipeline.input_files.all())
+        paths = pipeline.stage_input_files()
+        self.assertEqual(paths, {prod.pk: Path(prod.data.path) for prod in prods})
+
+        storage = RemoteStorage(location=settings.MEDIA_ROOT)
+        field = DataProduct._meta.get_field('data')
+        with tempfile.TemporaryDirectory() as cache_dir, patch.object(field, 'storage', storage):
+            tl_settings = {'staging_cache': {'path': cache_dir, 'max_bytes': 10 ** 7}}
+            with self.settings(TOM_EDUCATION_PIPELINE_SETTINGS=tl_settings), \
+                    patch.object(storage, 'open', wraps=storage.open) as open_mock:
+                paths = pipeline.stage_input_files()
+                self.assertEqual(open_mock.call_count, len(prods))
+                for prod in prods:
+                    self.assertTrue(str(paths[prod.pk]).startswith(cache_dir))
+                    self.assertEqual(paths[prod.pk].read_bytes(), Path(prod.data.path).read_bytes())
+
+                # Staged files should be reused by later runs, including when
+                # creating a timelapse
+                self.assertEqual(pipeline.stage_input_files(), paths)
+                buf = BytesIO()
+                pipeline.write_timelapse(buf)
+                self.assert_gif_data(buf)
+                self.assertEqual(open_mock.call_count, len(prods))
+
+    def test_staging_cache_shared(self):
+        """
+        The same FileCache should be used for each staging call, so the cache
+        directory is only scanned on the first insert
+        """
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        storage = RemoteStorage(location=settings.MEDIA_ROOT)
+        field = DataProduct._meta.get_field('data')
+        with tempfile.TemporaryDirectory() as cache_dir, patch.object(field, 'storage', storage), \
+                patch.object(FileCache, 'evict', autospec=True, side_effect=FileCache.evict) as evict_mock:
+            with self.settings(TOM_EDUCATION_PIPELINE_SETTINGS={'staging_cache': {'path': cache_dir}}):
+                cache = PipelineProcess.get_staging_cache()
+                self.assertIs(PipelineProcess.get_staging_cache(), cache)
+                for prod in pipeline.input_files.all():
+                    pipeline.stage_input_files([prod])
+                self.assertEqual(evict_mock.call_count, 1)
+
+            # Changing settings should give a new cache
+            with self.settings(TOM_EDUCATION_PIPELINE_SETTINGS={'staging_cache': {'path': cache_dir}}):
+                self.assertIsNot(PipelineProcess.get_staging_cache(), cache)
+
+    def test_staging_bounded(self):
+        """
+        Input files should be staged in batches just ahead of rendering, so
+        the staging cache stays within its size limit when the inputs do not
+        all fit
+        """
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        storage = RemoteStorage(location=settings.MEDIA_ROOT)
+        field = DataProduct._meta.get_field('data')
+        file_size = max(Path(prod.data.path).stat().st_size for prod in self.prods)
+        max_bytes = int(2.5 * file_size)
+        with tempfile.TemporaryDirectory() as cache_dir, patch.object(field, 'storage', storage), \
+                patch.object(storage, 'open', wraps=storage.open) as open_mock, \
+                patch.object(pipeline, 'stage_input_files', wraps=pipeline.stage_input_files) as stage_mock:
+            pipeline_settings = {
+                'staging_cache': {'path': cache_dir, 'max_bytes': max_bytes},
+                'staging_workers': 2,
+            }
+            with self.settings(TOM_EDUCATION_PIPELINE_SETTINGS=pipeline_settings):
+                buf = BytesIO()
+                pipeline.write_timelapse(buf)
+            self.assert_gif_data(buf)
+            self.assertEqual([len(c[0][0]) for c in stage_mock.call_args_list], [2, 2])
+            # Each file should only have been fetched once
+            self.assertEqual(open_mock.call_count, len(self.prods))
+            staged = sum(p.stat().st_size for p in Path(cache_dir).glob('*/*'))
+            self.assertLessEqual(staged, max_bytes)
+
+    def test_run_fetches_inputs_once(self):
+        """
+        A first run with memoization should hash remote inputs as they are
+        staged, rather than reading them once for the fingerprint and again
+        for processing
+        """
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        storage = RemoteStorage(location=settings.MEDIA_ROOT)
+        field = DataProduct._meta.get_field('data')
+        with tempfile.TemporaryDirectory() as cache_dir, patch.object(field, 'storage', storage), \
+                self.settings(TOM_EDUCATION_PIPELINE_SETTINGS={'staging_cache': {'path': cache_dir}}), \
+                patch.object(storage, 'open', wraps=storage.open) as open_mock:
+            self.assertTrue(pipeline.memoize)
+            pipeline.run()
+            self.assertEqual(open_mock.call_count, len(self.prods))
+        pipeline.refresh_from_db()
+        self.assertEqual(pipeline.status, ASYNC_STATUS_CREATED)
+        self.assertTrue(pipeline.fingerprint)
+
+    def test_staged_file_evicted(self):
+        """
+        Input files evicted from the staging cache by another run before they
+        are read should be fetched again
+        """
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        storage = RemoteStorage(location=settings.MEDIA_ROOT)
+        field = DataProduct._meta.get_field('data')
+        stage = pipeline.stage_input_files
+
+        def stage_and_evict(products=None):
+            paths = stage(products)
+            if len(paths) > 1:
+                paths[self.prods[1].pk].unlink()
+            return paths
+
+        with tempfile.TemporaryDirectory() as cache_dir, patch.object(field, 'storage', storage), \
+                self.settings(TOM_EDUCATION_PIPELINE_SETTINGS={'staging_cache': {'path': cache_dir}}), \
+                patch.object(pipeline, 'stage_input_files', side_effect=stage_and_evict):
+            buf = BytesIO()
+            pipeline.write_timelapse(buf)
+        self.assert_gif_data(buf)
+        self.assertIn(f'{self.prods[1].data.name} was removed from the staging cache', pipeline.logs)
+
     def test_create_mp4(self):
         pipeline = self.create_timelapse_pipeline(self.prods)
         buf = BytesIO()
@@ -588,6 +907,108 @@ class TimelapseTestCase(DataProductTestCase):
         frames = imageio.mimread(buf, format='mp4')
         self.assertEqual(len(frames), len(self.prods))
 
+    @override_settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={'outputs': [
+        {'format': TIMELAPSE_GIF, 'size': 100},
+        {'format': TIMELAPSE_MP4, 'size': 500},
+        {'format': TIMELAPSE_WEBM},
+    ]})
+    def test_multiple_outputs(self):
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        with patch('tom_education.models.timelapse.process_frame', wraps=process_frame) as render_mock:
+            pipeline.run()
+        # Each frame should only be processed once
+        self.assertEqual(render_mock.call_count, len(self.prods))
+
+        # Output filenames are '<identifier>_<variant>'
+        outputs = {
+            dp.data.name.split('_')[-1]: BytesIO(dp.data.read())
+            for dp in pipeline.group.dataproduct_set.all()
+        }
+        self.assertEqual(set(outputs), {'t100.gif', 't500.mp4', 't500.webm'})
+        self.assert_gif_data(outputs['t100.gif'])
+        outputs['t100.gif'].seek(0)
+        self.assertEqual(imageio.mimread(outputs['t100.gif'])[0].shape[0], 100)
+        self.assert_mp4_data(outputs['t500.mp4'])
+        self.assert_webm_data(outputs['t500.webm'])
+
+        with self.settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={'outputs': [{'format': 'hello'}]}):
+            with self.assertRaises(AsyncError):
+                self.create_timelapse_pipeline(self.prods).run()
+
+        # Duplicate variants would be written to the same file, so should be
+        # refused (including when the size comes from the top-level setting)
+        duplicates = {'size': 200, 'outputs': [{'format': TIMELAPSE_GIF}, {'format': TIMELAPSE_GIF, 'size': 200}]}
+        with self.settings(TOM_EDUCATION_TIMELAPSE_SETTINGS=duplicates):
+            with self.assertRaisesRegex(AsyncError, "'gif' with size 200 is given more than once"):
+                TimelapsePipeline.get_output_variants()
+            pipeline = self.create_timelapse_pipeline(self.prods)
+            with self.assertRaises(AsyncError):
+                pipeline.run()
+            self.assertIsNone(pipeline.group)
+
+    @override_settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={'format': TIMELAPSE_MP4, 'incremental': True})
+    def test_incremental_timelapse(self):
+        # Sorted order is prods 0, 1, 3, 2
+        previous = self.create_timelapse_pipeline([self.prods[0], self.prods[1], self.prods[3]])
+        previous.run()
+        self.assertNotIn('Appending', previous.logs)
+
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        with patch('tom_education.models.timelapse.process_frame', wraps=process_frame) as render_mock:
+            pipeline.run()
+        pipeline.refresh_from_db()
+        self.assertEqual(pipeline.status, ASYNC_STATUS_CREATED)
+        self.assertIn(f'Appending 1 new frames to {previous.identifier}', pipeline.logs)
+        # Only the new frame should have been rendered
+        self.assertEqual(render_mock.call_count, 1)
+
+        output = pipeline.group.dataproduct_set.first()
+        buf = BytesIO(output.data.read())
+        self.assert_mp4_data(buf)
+        buf.seek(0)
+        self.assertEqual(len(imageio.mimread(buf, format='mp4')), len(self.prods))
+
+    @override_settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={'format': TIMELAPSE_MP4, 'incremental': True})
+    def test_incremental_timelapse_different_settings(self):
+        """
+        The timelapse should be rebuilt if the previous timelapse was rendered
+        with different settings, even if the frame size and rate are the same
+        """
+        tl_settings = {'format': TIMELAPSE_MP4, 'incremental': True, 'crop_scale': 0.8}
+        with self.settings(TOM_EDUCATION_TIMELAPSE_SETTINGS=tl_settings):
+            previous = self.create_timelapse_pipeline([self.prods[0], self.prods[1], self.prods[3]])
+            previous.run()
+        previous.refresh_from_db()
+        self.assertTrue(previous.settings_hash)
+
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        self.assertIsNone(pipeline.get_previous_timelapse(TIMELAPSE_MP4))
+        with patch('tom_education.models.timelapse.process_frame', wraps=process_frame) as render_mock:
+            pipeline.run()
+        self.assertNotIn('Appending', pipeline.logs)
+        self.assertEqual(render_mock.call_count, len(self.prods))
+
+        # Later runs with the same settings should append
+        pipeline.refresh_from_db()
+        self.assertNotEqual(pipeline.settings_hash, previous.settings_hash)
+        self.assertEqual(self.create_timelapse_pipeline(self.prods).get_previous_timelapse(TIMELAPSE_MP4),
+                         pipeline)
+
+    @override_settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={'format': TIMELAPSE_MP4, 'incremental': True})
+    def test_incremental_timelapse_out_of_order(self):
+        """
+        The timelapse should be rebuilt if a new frame comes before frames in
+        the previous timelapse
+        """
+        previous = self.create_timelapse_pipeline([self.prods[0], self.prods[1], self.prods[2]])
+        previous.run()
+
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        with patch('tom_education.models.timelapse.process_frame', wraps=process_frame) as render_mock:
+            pipeline.run()
+        self.assertIn('New frames are not all later than the previous timelapse: rebuilding', pipeline.logs)
+        self.assertEqual(render_mock.call_count, len(self.prods))
+
     def test_create_webm(self):
         pipeline = self.create_timelapse_pipeline(self.prods)
         buf = BytesIO()
@@ -713,10 +1134,8 @@ class TimelapseTestCase(DataProductTestCase):
         self.assertEqual(DataProductGroup.objects.count(), 1)
 
     @patch('tom_education.models.timelapse.normalise_background')
-    @patch('tom_education.models.timelapse.imageio.imread', return_value=np.array([[0,0,0],[0,10,0]]))
-    @patch('tom_education.models.timelapse.fits_to_jpg', mock_fits_to_jpg)
-    def test_background_normalisation(self, im_mock, norm_mock):
-        ## TODO: Don't really understand how this test avoid exception in fit2image
+    @patch('tom_education.models.timelapse.render_frame', return_value=np.zeros((3, 3), dtype=np.uint8))
+    def test_background_normalisation(self, render_mock, norm_mock):
         pipeline = self.create_timelapse_pipeline(self.prods)
 
         # With processing, the normalisation method should be called for each
@@ -730,6 +1149,106 @@ class TimelapseTestCase(DataProductTestCase):
         pipeline.write_timelapse(buf, normalise_background=False)
         self.assertEqual(norm_mock.call_count, len(self.prods))
 
+    def test_background_engines(self):
+        # Image with a background gradient and a bright 'star'
+        yy, xx = np.mgrid[0:200, 0:300]
+        data = 100 + 0.1 * xx + 0.05 * yy + np.random.default_rng(0).normal(0, 1, (200, 300))
+        data[100:103, 150:153] += 1000
+
+        for method in (BACKGROUND_EXACT, BACKGROUND_MESH, BACKGROUND_MEDIAN):
+            normalised = normalise_background(data, {}, method=method)
+            self.assertEqual(normalised.dtype, np.float32, method)
+            self.assertEqual(normalised.shape, data.shape, method)
+            # Background should be removed but the star kept
+            self.assertLess(abs(np.median(normalised)), 1, method)
+            self.assertGreater(normalised[101, 151], 900, method)
+
+        with self.assertRaises(ValueError):
+            normalise_background(data, {}, method='hello')
+
+    @patch('tom_education.models.timelapse.normalise_background', side_effect=lambda data, header, **kwargs: data)
+    def test_background_settings(self, norm_mock):
+        pipeline = self.create_timelapse_pipeline(self.prods)
+        bg_settings = {'method': BACKGROUND_MESH, 'box_size': 32}
+        with self.settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={'background': bg_settings}):
+            pipeline.write_timelapse(BytesIO(), normalise_background=True)
+        self.assertEqual(norm_mock.call_args[1], bg_settings)
+
+        # Method should default to the exact engine
+        pipeline.write_timelapse(BytesIO(), normalise_background=True)
+        self.assertEqual(norm_mock.call_args[1], {'method': BACKGROUND_EXACT})
+
+        # Background settings should be part of the frame cache key
+        self.assertNotEqual(frame_cache_key('abc', 500, None, bg_settings),
+                            frame_cache_key('abc', 500, None, {'method': BACKGROUND_EXACT}))
+
+        with self.settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={'background': {'method': 'hello'}}):
+            with self.assertRaises(AsyncError):
+                pipeline.write_timelapse(BytesIO(), normalise_background=True)
+
+    def test_scale_frame(self):
+        data = self.image_data * 3
+        self.assertTrue(np.array_equal(scale_frame(data, 1, 200), linear_scale(data, 1, 200)))
+
+        samples = np.arange(1001, dtype=float)
+        self.assertEqual(stack_scale_limits(samples, SCALING_PERCENTILE, percentiles=(1, 99)), (10, 990))
+        zmin, zmax = stack_scale_limits(samples, SCALING_ZSCALE)
+        self.assertEqual(zmin, 500)
+
+    def test_stack_scaling(self):
+        """
+        With stack scaling, frames with different brightness levels should
+        look different, whereas with per-frame scaling they look the same
+        """
+        prods = []
+        for i, factor in enumerate((1, 2)):
+            prod = DataProduct.objects.create(product_id=f'scaled{i}', target=self.target)
+            buf = write_fits_image_file(self.image_data * factor, datetime(2019, 1, 3, hour=i))
+            prod.data.save(f'scaled{i}.fits.fz', File(buf), save=True)
+            prods.append(prod)
+        pipeline = self.create_timelapse_pipeline(prods)
+
+        frames = [frame for _, frame in pipeline.render_frames(prods, 500)]
+        self.assertTrue(np.array_equal(frames[0], frames[1]))
+
+        for method in (SCALING_ZSCALE, SCALING_PERCENTILE):
+            frames = [frame for _, frame in pipeline.render_frames_with_stack_scaling(prods, 500, method=method)]
+            self.assertEqual(frames[0].dtype, np.uint8)
+            self.assertEqual(frames[0].shape, self.test_fits_shape)
+            self.assertFalse(np.array_equal(frames[0], frames[1]), method)
+            self.assertGreater(frames[1].mean(), frames[0].mean(), method)
+
+        with self.settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={'scaling': {'method': SCALING_ZSCALE}}):
+            buf = BytesIO()
+            pipeline.write_timelapse(buf)
+            self.assert_gif_data(buf)
+            self.assertIn('Scaling all frames between', pipeline.logs)
+
+        with self.settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={'scaling': {'method': 'hello'}}):
+            with self.assertRaises(AsyncError):
+                pipeline.write_timelapse(BytesIO())
+
+    def test_render_frame(self):
+        """
+        Frames rendered in memory should have the same brightness scaling as
+        images produced by fits2image
+        """
+        fits_bytes = write_fits_image_file(self.image_data).getvalue()
+        data, _ = read_frame(BytesIO(fits_bytes))
+        frame = render_frame(data, image_size=1000)
+        self.assertEqual(frame.dtype, np.uint8)
+        self.assertEqual(frame.shape, self.test_fits_shape)
+
+        with tempfile.NamedTemporaryFile(suffix='.fits') as fits_file:
+            fits_file.write(fits_bytes)
+            fits_file.flush()
+            expected = np.asarray(get_scaled_image(fits_file.name))
+        self.assertTrue(np.array_equal(frame, expected))
+
+        # Aspect ratio should be maintained when resizing
+        small_frame = render_frame(data, image_size=100)
+        self.assertEqual(small_frame.shape, (100, 10))
+
     @override_settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={'crop_scale': 0.8})
     def test_timelapse_cropping(self):
         pipeline = self.create_timelapse_pipeline(self.prods)
@@ -784,6 +1303,146 @@ class TimelapseTestCase(DataProductTestCase):
         self.assertTrue(np.all(hdu == np.full((2, 4), K2)), hdu)
 
 
+    def test_cropped_read(self):
+        """
+        Reading a cropped frame from a tile-compressed file should only
+        decompress the cropped section, and give the same result as cropping
+        the full image
+        """
+        data = np.arange(200 * 100, dtype=np.float32).reshape((200, 100))
+        fits_bytes = write_fits_image_file(data).getvalue()
+        full_data, full_header = read_frame(BytesIO(fits_bytes))
+        expected_data, expected_header = crop_image(full_data, full_header, 0.5)
+
+        with patch.object(fits.CompImageHDU, 'data', new_callable=PropertyMock) as data_mock:
+            cropped_data, cropped_header = read_frame(BytesIO(fits_bytes), crop_scale=0.5)
+        data_mock.assert_not_called()
+        self.assertTrue(np.array_equal(cropped_data, expected_data))
+        self.assertEqual(cropped_header['NAXIS1'], expected_header['NAXIS1'])
+        self.assertEqual(cropped_header['NAXIS2'], expected_header['NAXIS2'])
+
+    def test_read_paths_and_files(self):
+        """
+        Frames and metadata should be readable from paths, file objects and
+        Django File objects. Only Django File objects should be reopened
+        """
+        data = np.arange(20 * 10, dtype=np.float32).reshape((20, 10))
+        fits_bytes = write_fits_image_file(data).getvalue()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / 'frame.fits'
+            path.write_bytes(fits_bytes)
+            with patch.object(Path, 'open', side_effect=AssertionError('path opened')):
+                self.assertTrue(np.array_equal(read_frame(path)[0], data))
+                self.assertEqual(read_fits_metadata(path)['naxis1'], 10)
+
+            self.assertTrue(np.array_equal(read_frame(BytesIO(fits_bytes))[0], data))
+
+            django_file = File(path.open('rb'))
+            django_file.close()
+            self.assertEqual(read_fits_metadata(django_file)['naxis2'], 20)
+            self.assertTrue(django_file.closed)
+
+class FileCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = FileCache(self.tmpdir.name, max_bytes=25)
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmpdir.cleanup()
+
+    def test_get_and_put(self):
+        self.assertIsNone(self.cache.get('abcdef'))
+        self.assertNotIn('abcdef', self.cache)
+        path = self.cache.put('abcdef', lambda f: f.write(b'hello'))
+        self.assertIn('abcdef', self.cache)
+        self.assertEqual(self.cache.get('abcdef'), path)
+        self.assertEqual(path.read_bytes(), b'hello')
+
+    def test_failed_write(self):
+        def write(f):
+            f.write(b'partial')
+            raise ValueError('oops')
+
+        with self.assertRaises(ValueError):
+            self.cache.put('abcdef', write)
+        self.assertNotIn('abcdef', self.cache)
+        self.assertEqual(list(Path(self.tmpdir.name).glob('*/*')), [])
+
+    def test_lru_eviction(self):
+        for i, key in enumerate(['aa1', 'bb2', 'cc3']):
+            path = self.cache.put(key, lambda f: f.write(b'x' * 10))
+            # Set distinct modification times so the order is well defined
+            os.utime(path, (i, i))
+
+        # Total size is 30 bytes, so the least recently used entry should have
+        # been evicted
+        self.assertNotIn('aa1', self.cache)
+        self.assertIn('bb2', self.cache)
+        self.assertIn('cc3', self.cache)
+
+        # Using an entry should protect it from eviction
+        self.cache.get('bb2')
+        self.cache.put('dd4', lambda f: f.write(b'x' * 10))
+        self.assertIn('bb2', self.cache)
+        self.assertNotIn('cc3', self.cache)
+        self.assertIn('dd4', self.cache)
+
+
+    def test_keep(self):
+        for i, key in enumerate(['aa1', 'bb2']):
+            path = self.cache.put(key, lambda f: f.write(b'x' * 10))
+            os.utime(path, (i, i))
+        # Entries in `keep` should not be evicted, even if least recently used
+        self.cache.put('cc3', lambda f: f.write(b'x' * 10), keep={'aa1'})
+        self.assertIn('aa1', self.cache)
+        self.assertNotIn('bb2', self.cache)
+        self.assertIn('cc3', self.cache)
+
+    def test_keep_bounded(self):
+        """
+        Entries in `keep` should still be evicted if the cache would be over
+        its size limit otherwise, but the new entry should not
+        """
+        for i, key in enumerate(['aa1', 'bb2']):
+            path = self.cache.put(key, lambda f: f.write(b'x' * 10))
+            os.utime(path, (i, i))
+        self.cache.put('cc3', lambda f: f.write(b'x' * 10), keep={'aa1', 'bb2', 'cc3'})
+        self.assertNotIn('aa1', self.cache)
+        self.assertIn('bb2', self.cache)
+        self.assertIn('cc3', self.cache)
+
+        # An entry larger than the limit should be kept until the next insert
+        self.cache.put('dd4', lambda f: f.write(b'x' * 30), keep={'bb2', 'cc3'})
+        self.assertIn('dd4', self.cache)
+        self.assertNotIn('bb2', self.cache)
+        self.assertNotIn('cc3', self.cache)
+
+    def test_running_size(self):
+        """
+        The directory should only be scanned on the first insert and when the
+        cache goes over its size limit
+        """
+        with patch.object(FileCache, 'evict', autospec=True, side_effect=FileCache.evict) as evict_mock:
+            for i, key in enumerate(['aa1', 'bb2']):
+                path = self.cache.put(key, lambda f: f.write(b'x' * 10))
+                os.utime(path, (i, i))
+            self.assertEqual(evict_mock.call_count, 1)
+            self.assertEqual(self.cache.size, 20)
+
+            self.cache.put('cc3', lambda f: f.write(b'x' * 10))
+            self.assertEqual(evict_mock.call_count, 2)
+            self.assertEqual(self.cache.size, 20)
+            self.assertNotIn('aa1', self.cache)
+
+            # A new FileCache for the same directory should find the existing
+            # entries
+            other = FileCache(self.tmpdir.name, max_bytes=25)
+            other.put('dd4', lambda f: f.write(b'x'))
+            self.assertEqual(other.size, 21)
+
+
 class GalleryTestCase(TomEducationTestCase):
     def setUp(self):
         super().setUp()
@@ -912,6 +1571,7 @@ class AsyncStatusApiTestCase(TomEducationTestCase):
             'terminal_timestamp': None,
             'view_url': None,
             'failure_message': None,
+            'eta': None,
         }
         failed_proc_dict = {
             'process_type': 'PipelineProcess',
@@ -920,7 +1580,8 @@ class AsyncStatusApiTestCase(TomEducationTestCase):
             'status': 'failed',
             'failure_message': 'oops',
             'terminal_timestamp': terminal_timestamp,
-            'view_url': reverse('tom_education:pipeline_detail', kwargs={'pk': failed_proc.pk})
+            'view_url': reverse('tom_education:pipeline_detail', kwargs={'pk': failed_proc.pk}),
+            'eta': None,
         }
 
         response1 = self.client.get(url)
@@ -960,6 +1621,145 @@ class AsyncStatusApiTestCase(TomEducationTestCase):
         self.assertEqual(response4.status_code, 404)
         self.assertEqual(response4.json(), {'detail': 'Not found.'})
 
+    def test_since_and_etag(self):
+        target = Target.objects.create(name='polled target')
+        proc1 = AsyncProcess.objects.create(identifier='proc1', target=target)
+        url = reverse('tom_education:async_process_status_api', kwargs={'target': target.pk})
+
+        response1 = self.client.get(url)
+        self.assertEqual(response1.status_code, 200)
+        self.assertEqual([p['identifier'] for p in response1.json()['processes']], ['proc1'])
+        self.assertIn('Last-Modified', response1)
+        # The ETag depends on 'since', so should not match a full listing
+        response2 = self.client.get(url, {'since': response1.json()['timestamp']},
+                                    HTTP_IF_NONE_MATCH=response1['ETag'])
+        self.assertEqual(response2.status_code, 200)
+        self.assertEqual(response2.json()['processes'], [])
+        self.assertNotIn('Last-Modified', response2)
+        etag = response2['ETag']
+
+        # Nothing changed: should get 304
+        response2 = self.client.get(url, {'since': response1.json()['timestamp']}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response2.status_code, 304)
+        # ...but not with a different 'since', even though the same ETag is
+        # sent
+        response2 = self.client.get(url, {'since': 0}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response2.status_code, 200)
+        self.assertEqual([p['identifier'] for p in response2.json()['processes']], ['proc1'])
+
+        # Only new and changed processes should be included with 'since'
+        AsyncProcess.objects.create(identifier='proc2', target=target)
+        response3 = self.client.get(url, {'since': response1.json()['timestamp']}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response3.status_code, 200)
+        self.assertEqual([p['identifier'] for p in response3.json()['processes']], ['proc2'])
+        self.assertNotEqual(response3['ETag'], etag)
+
+        proc1.status = ASYNC_STATUS_FAILED
+        proc1.save()
+        response4 = self.client.get(url, {'since': response3.json()['timestamp']})
+        self.assertEqual([(p['identifier'], p['status']) for p in response4.json()['processes']],
+                         [('proc1', ASYNC_STATUS_FAILED)])
+
+    def test_if_modified_since(self):
+        target = Target.objects.create(name='polled target')
+        proc = AsyncProcess.objects.create(identifier='proc1', target=target)
+        url = reverse('tom_education:async_process_status_api', kwargs={'target': target.pk})
+
+        response1 = self.client.get(url)
+        self.assertEqual(response1.status_code, 200)
+        last_modified = response1['Last-Modified']
+        response2 = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response2.status_code, 304)
+        # Last-Modified does not cover 'since', so should not be used with it
+        response2 = self.client.get(url, {'since': 0}, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response2.status_code, 200)
+
+        # A later change should give a full response
+        AsyncProcess.objects.filter(pk=proc.pk).update(modified=proc.modified + timedelta(seconds=5))
+        response3 = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response3.status_code, 200)
+        self.assertEqual([p['identifier'] for p in response3.json()['processes']], ['proc1'])
+
+        response5 = self.client.get(url, {'since': 'yesterday'})
+        self.assertEqual(response5.status_code, 400)
+        self.assertEqual(response5.json(), {'since': 'Must be a timestamp'})
+
+    def test_query_count(self):
+        target = Target.objects.create(name='busy target')
+        url = reverse('tom_education:async_process_status_api', kwargs={'target': target.pk})
+
+        def create_processes(start):
+            AsyncProcess.objects.create(identifier=f'async{start}', target=target)
+            for i in range(start, start + 3):
+                PipelineProcess.objects.create(identifier=f'pipeline{i}', target=target)
+
+        # Target lookup, ETag aggregate and process listing, however many
+        # processes there are
+        create_processes(0)
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertEqual(len(response.json()['processes']), 4)
+        self.assertEqual(sum(p['view_url'] is not None for p in response.json()['processes']), 3)
+
+        create_processes(10)
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertEqual(len(response.json()['processes']), 8)
+
+    @override_settings(TOM_EDUCATION_PIPELINE_SETTINGS={
+        'event_broker': {'BACKEND': 'tom_education.events.LocalEventBroker'}
+    })
+    def test_event_stream(self):
+        target = Target.objects.create(name='watched target')
+        broker = get_event_broker()
+        subscription = broker.subscribe([f'target.{target.pk}'])
+
+        # Events should only be published once the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            proc = PipelineProcess.objects.create(identifier='streamed', target=target)
+            self.assertIsNone(subscription.get(timeout=0))
+        self.assertEqual(subscription.get(timeout=0), (f'target.{target.pk}', {
+            'type': 'status', 'data': {'identifier': 'streamed', 'status': ASYNC_STATUS_PENDING}
+        }))
+        subscription.close()
+
+        response = self.client.get(reverse('tom_education:pipeline_stream', kwargs={'pk': proc.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = iter(response.streaming_content)
+        self.assertEqual(next(stream), b'retry: 3000\n\n')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            proc.log('hello')
+        self.assertEqual(next(stream), b'event: log\ndata: {"identifier": "streamed", "index": 0, "text": "hello\\n"}\n\n')
+        with self.captureOnCommitCallbacks(execute=True):
+            proc.status = ASYNC_STATUS_FAILED
+            proc.save()
+        self.assertEqual(next(stream), b'event: status\ndata: {"identifier": "streamed", "status": "failed"}\n\n')
+
+        # Closing the response should unsubscribe
+        response.close()
+        self.assertEqual(broker.queues, {})
+
+        response2 = self.client.get(reverse('tom_education:async_process_stream', kwargs={'target': 100000}))
+        self.assertEqual(response2.status_code, 404)
+
+    @override_settings(TOM_EDUCATION_PIPELINE_SETTINGS={
+        'event_broker': {'BACKEND': 'tom_education.events.LocalEventBroker'},
+        'event_stream_duration': 0,
+    })
+    def test_event_stream_duration(self):
+        target = Target.objects.create(name='watched target')
+        response = self.client.get(reverse('tom_education:async_process_stream', kwargs={'target': target.pk}))
+        # The stream should end straight away, releasing the server worker
+        self.assertEqual(list(response.streaming_content), [b'retry: 3000\n\n'])
+        response.close()
+
+    def test_event_stream_disabled(self):
+        target = Target.objects.create(name='unwatched target')
+        response = self.client.get(reverse('tom_education:async_process_stream', kwargs={'target': target.pk}))
+        self.assertEqual(response.status_code, 404)
+
 
 class FakePipeline(PipelineProcess):
     short_name = 'fakepip'
@@ -1003,6 +1803,23 @@ class FakePipelineWithFlags(FakePipeline):
         return super().do_pipeline(tmpdir)
 
 
+class ChunkedPipeline(PipelineProcess):
+    chunk_size = 3
+
+    class Meta:
+        proxy = True
+
+    def do_map(self, tmpdir, products, **flags):
+        if any(prod.product_id == 'bad' for prod in products):
+            raise AsyncError('bad input')
+        return [prod.product_id for prod in products]
+
+    def do_reduce(self, tmpdir, results, **flags):
+        outfile = tmpdir / 'out.txt'
+        outfile.write_text(json.dumps(results))
+        return [PipelineOutput(outfile, DataProduct, 'image_file')]
+
+
 class FakePipelineBadFlags(FakePipeline):
     flags = 4
 
@@ -1084,6 +1901,297 @@ class PipelineTestCase(TomEducationTestCase):
         self.assertEqual(file2_rd.value, 'goodbye')
         self.assertEqual(file2_rd.source_location, '')
 
+    @override_settings(TOM_EDUCATION_PIPELINES={'chunked': 'tom_education.tests.ChunkedPipeline'})
+    def test_map_reduce(self):
+        prods = [DataProduct.objects.create(product_id=f'chunk_{i}', target=self.target) for i in range(7)]
+        for prod in prods:
+            prod.data.save(f'{prod.product_id}.txt', File(BytesIO(prod.product_id.encode())))
+        expected_results = [['chunk_0', 'chunk_1', 'chunk_2'], ['chunk_3', 'chunk_4', 'chunk_5'], ['chunk_6']]
+
+        proc = ChunkedPipeline.objects.create(identifier='mapreduce', target=self.target)
+        proc.input_files.add(*prods)
+        with patch.object(ChunkedPipeline, 'do_reduce', wraps=proc.do_reduce) as reduce_mock:
+            run_pipeline(proc.pk, 'chunked')
+        proc.refresh_from_db()
+        self.assertEqual(proc.status, ASYNC_STATUS_CREATED)
+        self.assertEqual(reduce_mock.call_count, 1)
+
+        chunks = proc.chunks.order_by('index')
+        self.assertEqual(chunks.count(), 3)
+        self.assertEqual([json.loads(chunk.result_json) for chunk in chunks], expected_results)
+        self.assertEqual(set(chunks.values_list('status', flat=True)), {ASYNC_STATUS_CREATED})
+        self.assertIn('Processing 7 files in 3 chunks', proc.logs)
+        self.assertIn('Finished chunk 3/3', proc.logs)
+
+        output = proc.group.dataproduct_set.get()
+        self.assertEqual(json.loads(output.data.read()), expected_results)
+
+        # Running outside of a worker should give the same result
+        proc2 = ChunkedPipeline.objects.create(identifier='mapreduce2', target=self.target)
+        proc2.input_files.add(*prods)
+        with patch.object(ChunkedPipeline, 'memoize', False):
+            proc2.run()
+        output2 = proc2.group.dataproduct_set.get()
+        self.assertNotEqual(output2, output)
+        self.assertEqual(json.loads(output2.data.read()), expected_results)
+
+        # A failed chunk should fail the process without running the reduce
+        # step
+        bad = DataProduct.objects.create(product_id='bad', target=self.target)
+        bad.data.save('bad.txt', File(BytesIO(b'bad')))
+        proc3 = ChunkedPipeline.objects.create(identifier='mapreduce3', target=self.target)
+        proc3.input_files.add(*prods, bad)
+        with patch.object(ChunkedPipeline, 'do_reduce') as reduce_mock:
+            run_pipeline(proc3.pk, 'chunked')
+        reduce_mock.assert_not_called()
+        proc3.refresh_from_db()
+        self.assertEqual(proc3.status, ASYNC_STATUS_FAILED)
+        self.assertEqual(proc3.failure_message, 'bad input')
+        self.assertEqual(proc3.chunks.get(index=2).status, ASYNC_STATUS_FAILED)
+
+    @patch('tom_education.models.pipelines.CANCEL_CHECK_INTERVAL', 0)
+    def test_cancel(self):
+        class CancelledPipeline(PipelineProcess):
+            class Meta:
+                proxy = True
+
+            def do_pipeline(pself, tmpdir, **flags):
+                for i in range(3):
+                    outfile = tmpdir / f'out{i}.txt'
+                    outfile.write_text('output')
+                    yield PipelineOutput(outfile, DataProduct, 'image_file')
+                    # Request cancellation once the first output has been
+                    # created
+                    CancelledPipeline.objects.get(pk=pself.pk).request_cancel()
+
+        proc = CancelledPipeline.objects.create(identifier='cancelme', target=self.target)
+        proc.input_files.add(*self.prods)
+        url = reverse('tom_education:pipeline_cancel_api', kwargs={'pk': proc.pk})
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['identifier'], 'cancelme')
+        proc.refresh_from_db()
+        self.assertTrue(proc.cancel_requested)
+
+        # Cancelled before starting
+        run_process(proc)
+        proc.refresh_from_db()
+        self.assertEqual(proc.status, ASYNC_STATUS_CANCELLED)
+        self.assertIsNotNone(proc.terminal_timestamp)
+        self.assertIsNone(proc.started)
+        self.assertIn('Cancelled', proc.logs)
+
+        # Cannot cancel a finished process
+        response2 = self.client.post(url)
+        self.assertEqual(response2.status_code, 400)
+        self.assertEqual(response2.json(), {'status': 'Process has already finished'})
+        self.assertEqual(
+            self.client.post(reverse('tom_education:pipeline_cancel_api', kwargs={'pk': 100000})).status_code,
+            404
+        )
+
+        # Anonymous users and users without permission on the target cannot
+        # cancel processes
+        proc_running = CancelledPipeline.objects.create(identifier='cancelme_running', target=self.target)
+        running_url = reverse('tom_education:pipeline_cancel_api', kwargs={'pk': proc_running.pk})
+        self.client.logout()
+        self.assertEqual(self.client.post(running_url).status_code, 403)
+        other_user = User.objects.create_user(username='other', email='other@example.com')
+        self.client.force_login(other_user)
+        self.assertEqual(self.client.post(running_url).status_code, 403)
+        proc_running.refresh_from_db()
+        self.assertFalse(proc_running.cancel_requested)
+        self.client.force_login(self.user)
+
+        # Cancelled while saving outputs: partial outputs should be deleted
+        proc2 = CancelledPipeline.objects.create(identifier='cancelme2', target=self.target)
+        proc2.input_files.add(*self.prods)
+        with patch.object(CancelledPipeline, 'memoize', False):
+            run_process(proc2)
+        proc2.refresh_from_db()
+        self.assertEqual(proc2.status, ASYNC_STATUS_CANCELLED)
+        self.assertIsNone(proc2.group)
+        self.assertFalse(DataProduct.objects.filter(product_id__startswith='cancelme2').exists())
+
+    def test_retry(self):
+        class FlakyPipeline(PipelineProcess):
+            checkpoints = True
+            max_retries = 1
+
+            class Meta:
+                proxy = True
+
+            def do_pipeline(pself, tmpdir, **flags):
+                store = pself.get_checkpoint_store()
+                if 'stage1' not in store:
+                    store.put('stage1', lambda f: f.write(b'stage 1 result'))
+                    raise RuntimeError('worker died')
+                outfile = tmpdir / 'out.txt'
+                outfile.write_bytes(store.get('stage1').read_bytes())
+                return [PipelineOutput(outfile, DataProduct, 'image_file')]
+
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                self.settings(TOM_EDUCATION_PIPELINE_SETTINGS={'checkpoint_dir': tmpdir}), \
+                patch.object(FlakyPipeline, 'memoize', False):
+            proc = FlakyPipeline.objects.create(identifier='flaky', target=self.target)
+            proc.input_files.add(*self.prods)
+
+            # Message should be sent with retries enabled
+            task_mock = Mock()
+            send_task(task_mock, proc)
+            self.assertEqual(task_mock.send_with_options.call_args[1]['max_retries'], 1)
+            # ...including when deferred because of the concurrency limit
+            task_mock.reset_mock()
+            defer_task(task_mock, proc, proc.pk)
+            options = task_mock.send_with_options.call_args[1]
+            self.assertEqual(options['max_retries'], 1)
+            self.assertEqual(options['min_backoff'], RETRY_MIN_BACKOFF)
+            self.assertEqual(options['time_limit'], 3600_000)
+
+            # The first failure should be raised for dramatiq to retry
+            with self.assertRaises(RuntimeError):
+                run_process(proc)
+            proc.refresh_from_db()
+            self.assertEqual(proc.status, ASYNC_STATUS_PENDING)
+            self.assertEqual(proc.attempts, 1)
+            self.assertIn('Attempt 1 failed: retrying from last checkpoint', proc.logs)
+
+            run_process(proc)
+            proc.refresh_from_db()
+            self.assertEqual(proc.status, ASYNC_STATUS_CREATED)
+            self.assertEqual(proc.group.dataproduct_set.get().data.read(), b'stage 1 result')
+            self.assertFalse(proc.get_checkpoint_dir().exists())
+
+            # No retries left: should fail
+            proc2 = FlakyPipeline.objects.create(identifier='flaky2', target=self.target)
+            proc2.input_files.add(*self.prods)
+            with patch.object(FlakyPipeline, 'max_retries', 0):
+                run_process(proc2)
+            proc2.refresh_from_db()
+            self.assertEqual(proc2.status, ASYNC_STATUS_FAILED)
+            self.assertEqual(proc2.failure_message, 'An unexpected error occurred worker died')
+            self.assertFalse(proc2.get_checkpoint_dir().exists())
+
+    def test_memoization(self):
+
+        class MemoPipeline(PipelineProcess):
+            flags = {'myflag': {'default': False, 'long_name': 'myflag'}}
+
+            class Meta:
+                proxy = True
+
+            def do_pipeline(pself, tmpdir, **flags):
+                outfile = tmpdir / 'out.txt'
+                outfile.write_text('output')
+                return [PipelineOutput(outfile, DataProduct, 'image_file')]
+
+        def run(products, flags=None):
+            proc = MemoPipeline.objects.create(
+                identifier=f'memo{MemoPipeline.objects.count()}',
+                target=self.target,
+                flags_json=json.dumps(flags) if flags else None
+            )
+            proc.input_files.add(*products)
+            with patch.object(MemoPipeline, 'do_pipeline', wraps=proc.do_pipeline) as do_mock:
+                proc.run()
+            proc.refresh_from_db()
+            self.assertEqual(proc.status, ASYNC_STATUS_CREATED)
+            return proc, do_mock.called
+
+        first, ran = run(self.prods)
+        self.assertTrue(ran)
+        self.assertEqual(len(first.fingerprint), 64)
+
+        # Same inputs (in any order) and flags: outputs should be reused
+        second, ran = run(list(reversed(self.prods)))
+        self.assertFalse(ran)
+        self.assertEqual(second.fingerprint, first.fingerprint)
+        self.assertEqual(second.group, first.group)
+        self.assertEqual(second.reused_from, first)
+        self.assertIn(f'Using outputs from previous run {first.identifier}', second.logs)
+
+        # Different inputs, flags or version should run the pipeline again
+        self.assertTrue(run(self.prods[:1])[1])
+        self.assertTrue(run(self.prods, {'myflag': True})[1])
+        with patch.object(MemoPipeline, 'version', 2):
+            self.assertTrue(run(self.prods)[1])
+        with patch.object(MemoPipeline, 'memoize', False):
+            self.assertTrue(run(self.prods)[1])
+
+    @override_settings(TOM_EDUCATION_PIPELINE_SETTINGS={'upload_workers': 3})
+    @patch('pathlib.Path.read_bytes', side_effect=AssertionError('output should be streamed'))
+    def test_upload_outputs(self, _mock):
+        class ManyOutputsPipeline(PipelineProcess):
+            class Meta:
+                proxy = True
+
+            def do_pipeline(pself, tmpdir):
+                outputs = []
+                for i in range(5):
+                    path = tmpdir / f'out{i}.txt'
+                    path.write_text(f'output {i}')
+                    outputs.append(PipelineOutput(path, DataProduct, 'image_file'))
+                return outputs
+
+        proc = ManyOutputsPipeline.objects.create(identifier='manyouts', target=self.target)
+        proc.input_files.add(*self.prods)
+        # Outputs should be indexed from the local files rather than read
+        # back from the storage backend (inputs are hashed first, since the
+        # fingerprint needs them)
+        for prod in self.prods:
+            get_content_hash(prod)
+        with patch('tom_education.models.pipelines.ThreadPoolExecutor', wraps=ThreadPoolExecutor) as pool_mock, \
+                patch.object(FileSystemStorage, 'open', side_effect=AssertionError('output read back')):
+            proc.run()
+        pool_mock.assert_called_once_with(max_workers=3)
+
+        self.assertEqual(proc.group.dataproduct_set.count(), 5)
+        for i in range(5):
+            prod = DataProduct.objects.get(product_id=f'manyouts_out{i}.txt')
+            self.assertEqual(prod.data.read(), f'output {i}'.encode())
+            self.assertEqual(prod.data_product_type, 'image_file')
+            self.assertEqual(prod.metadata.content_hash, hashlib.sha256(f'output {i}'.encode()).hexdigest())
+
+    @patch('tom_education.models.pipelines.REDUCED_DATUM_BATCH_SIZE', 2)
+    def test_save_reduced_data(self):
+        source_file = self.prods[0].data.name
+
+        class PhotometryPipeline(PipelineProcess):
+            class Meta:
+                proxy = True
+
+            def do_pipeline(pself, tmpdir):
+                return [
+                    PipelineOutput(tmpdir, ReducedDatum, 'photometry', (58000 + i, 15 + i, 0.1, source_file))
+                    for i in range(5)
+                ]
+
+        proc = PhotometryPipeline.objects.create(identifier='phot', target=self.target)
+        proc.input_files.add(*self.prods)
+        rows = [('photometry', (58000 + i, 15 + i, 0.1, source_file)) for i in range(5)]
+
+        # 1 query for data products, then a select and an insert for each of
+        # the 3 batches, plus savepoint queries for the transaction
+        with self.assertNumQueries(9):
+            proc.save_reduced_data(rows)
+        data = ReducedDatum.objects.filter(target=self.target).order_by('timestamp')
+        self.assertEqual(data.count(), 5)
+        self.assertEqual(data[0].source_name, 'phot_58000')
+        self.assertEqual(data[0].data_product, self.prods[0])
+        self.assertEqual(data[0].data_type, 'photometry')
+        self.assertEqual(json.loads(data[4].value), {'magnitude': 19, 'error': 0.1})
+        self.assertEqual(data[1].timestamp, datetime(2017, 9, 5, tzinfo=timezone.utc))
+
+        # Running again with new values should update existing data
+        proc.save_reduced_data([('photometry', (58000, 10, 0.2, 'unknown_file'))] + rows[1:])
+        self.assertEqual(ReducedDatum.objects.filter(target=self.target).count(), 5)
+        first = ReducedDatum.objects.get(source_name='phot_58000')
+        self.assertEqual(json.loads(first.value), {'magnitude': 10, 'error': 0.2})
+        self.assertIsNone(first.data_product)
+
+        proc.run()
+        self.assertEqual(ReducedDatum.objects.filter(target=self.target).count(), 5)
+
     def _test_no_data_products(self):
         # **** This seems to have a problem because dataproduct is required **
         # If outputs are only reduced data, a data product group should not be
@@ -1136,6 +2244,38 @@ class PipelineTestCase(TomEducationTestCase):
         proc.run()
         # Message comes from FakePipeline
         self.assertEqual(proc.logs, 'doing the thing\nand another thing\n')
+        self.assertEqual(proc.log_lines.count(), 2)
+
+        # Logging should append to existing lines
+        proc = FakePipeline.objects.get(pk=proc.pk)
+        proc.log('more', end='')
+        self.assertEqual(proc.get_logs(), ('doing the thing\nand another thing\nmore', 3))
+        self.assertEqual(proc.get_logs(offset=1), ('and another thing\nmore', 3))
+        self.assertEqual(proc.get_logs(offset=3), ('', 3))
+
+    def test_api_log_offset(self):
+        proc = FakePipeline.objects.create(identifier='someprocess', target=self.target)
+        for i in range(3):
+            proc.log(f'line {i}')
+        url = reverse('tom_education:pipeline_api', kwargs={'pk': proc.pk})
+
+        response = self.client.get(url)
+        self.assertEqual(response.json()['logs'], 'line 0\nline 1\nline 2\n')
+        self.assertEqual(response.json()['log_offset'], 3)
+
+        proc.log('line 3')
+        response = self.client.get(url, {'offset': 3})
+        self.assertEqual(response.json()['logs'], 'line 3\n')
+        self.assertEqual(response.json()['log_offset'], 4)
+
+        # No new lines
+        response = self.client.get(url, {'offset': 4})
+        self.assertEqual(response.json()['logs'], '')
+        self.assertEqual(response.json()['log_offset'], 4)
+
+        for offset in ('-1', 'hello'):
+            response = self.client.get(url, {'offset': offset})
+            self.assertEqual(response.status_code, 400)
 
     def test_update_status(self):
         class StatusTestPipeline(PipelineProcess):
@@ -1187,11 +2327,13 @@ class PipelineTestCase(TomEducationTestCase):
             'created': 300,
             'status': 'somestatus',
             'logs': '',
+            'log_offset': 0,
             'terminal_timestamp': None,
             'failure_message': None,
             'view_url': view_url,
             'group_name': None,
             'group_url': None,
+            'eta': None,
         })
 
         proc.run()
@@ -1207,7 +2349,9 @@ class PipelineTestCase(TomEducationTestCase):
             'view_url': view_url,
             'group_url': group_url,
             'group_name': 'someprocess_outputs',
-            'logs': proc.logs
+            'logs': proc.logs,
+            'log_offset': 2,
+            'eta': None
         })
 
         # Failure message should be included if process failed
@@ -1225,7 +2369,9 @@ class PipelineTestCase(TomEducationTestCase):
             'view_url': view_url,
             'group_url': group_url,
             'group_name': 'someprocess_outputs',
-            'logs': proc.logs
+            'logs': proc.logs,
+            'log_offset': 2,
+            'eta': None
         })
 
         # Bad PK should give 404
@@ -1309,6 +2455,144 @@ class PipelineTestCase(TomEducationTestCase):
                 with self.assertRaises(InvalidPipelineError):
                     self.client.get(url)
 
+    def test_pipeline_registry(self):
+        url = reverse('tom_education:target_data', kwargs={'pk': self.target.pk})
+        test_settings = {
+            'mypip': 'tom_education.tests.FakePipeline',
+            'withflags': 'tom_education.tests.FakePipelineWithFlags'
+        }
+        with patch('tom_education.models.pipelines.import_string', wraps=import_string) as import_mock:
+            with self.settings(TOM_EDUCATION_PIPELINES=test_settings):
+                for _ in range(3):
+                    self.assertEqual(self.client.get(url).status_code, 200)
+                    self.assertEqual(PipelineProcess.get_subclass('withflags'), FakePipelineWithFlags)
+                self.assertEqual(import_mock.call_count, 2)
+                self.assertEqual(PipelineProcess.get_registry().flags, {'withflags': FakePipelineWithFlags.flags})
+                with self.assertRaises(KeyError):
+                    PipelineProcess.get_subclass('blah')
+
+            # Registry should be reloaded when settings change
+            with self.settings(TOM_EDUCATION_PIPELINES={'other': 'tom_education.tests.FakePipeline',
+                                                        'bad': 'datetime.datetime'}):
+                self.assertEqual(PipelineProcess.get_subclass('other'), FakePipeline)
+                self.assertEqual(import_mock.call_count, 4)
+                # Invalid pipelines should only affect lookups for that name
+                with self.assertRaises(InvalidPipelineError):
+                    PipelineProcess.get_subclass('bad')
+
+    def test_pipeline_queues(self):
+        broker = StubBroker()
+
+        def fn(process_pk):
+            pass
+        base_actor = dramatiq.actor(fn, broker=broker, time_limit=1000, max_retries=0)
+        self.assertIs(get_pipeline_actor(base_actor, FakePipeline), base_actor)
+
+        proc = FakePipeline.objects.create(identifier='queued', target=self.target)
+        with patch.object(FakePipeline, 'queue_name', 'interactive'), \
+                patch.object(FakePipeline, 'priority', -10):
+            actor = get_pipeline_actor(base_actor, FakePipeline)
+            self.assertIs(get_pipeline_actor(base_actor, FakePipeline), actor)
+            self.assertEqual(actor.queue_name, 'interactive')
+            self.assertEqual(actor.priority, -10)
+            self.assertEqual(actor.fn, fn)
+            self.assertEqual(actor.options, {'time_limit': 1000, 'max_retries': 0})
+
+            send_task(base_actor, proc)
+        self.assertEqual(broker.queues['interactive'].qsize(), 1)
+        self.assertEqual(broker.queues['default'].qsize(), 0)
+
+    @override_settings(TOM_EDUCATION_PIPELINES={'mypip': 'tom_education.tests.FakePipeline'})
+    @patch.object(FakePipeline, 'max_concurrency', 1)
+    @patch.object(FakePipeline, 'run')
+    def test_max_concurrency(self, run_mock):
+        proc = FakePipeline.objects.create(identifier='limited', target=self.target)
+
+        with pipeline_slot(proc) as acquired:
+            self.assertTrue(acquired)
+            with pipeline_slot(proc) as acquired2:
+                self.assertFalse(acquired2)
+            # Task should be deferred while the only slot is in use
+            with patch('tom_education.tasks.defer_task') as defer_mock:
+                run_pipeline(proc.pk, 'mypip')
+            defer_mock.assert_called_once()
+            task, deferred_proc, *args = defer_mock.call_args[0]
+            self.assertEqual((task, deferred_proc, args), (run_pipeline, proc, [proc.pk, 'mypip']))
+            run_mock.assert_not_called()
+
+        run_pipeline(proc.pk, 'mypip')
+        run_mock.assert_called_once()
+
+        # Slots should expire after the time limit of the process
+        proc.estimated_duration = 8000
+        with patch('tom_education.tasks.ConcurrentRateLimiter', wraps=ConcurrentRateLimiter) as limiter_mock:
+            with pipeline_slot(proc):
+                pass
+        self.assertEqual(limiter_mock.call_args[1]['ttl'], 24_000_000)
+
+    @patch('django.utils.timezone.now')
+    def test_cost_model(self, now_mock):
+        now_mock.return_value = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        prods = [DataProduct.objects.create(product_id=f'cost_{i}', target=self.target) for i in range(2)]
+        for prod in prods:
+            prod.data.save(f'{prod.product_id}.txt', File(BytesIO(b'x' * 250)))
+
+        # No previous runs: default time limit. File sizes should come from
+        # the metadata stored at ingest, rather than the storage backend
+        proc = ChunkedPipeline.objects.create(identifier='cost', target=self.target)
+        proc.input_files.add(*prods)
+        with patch('django.db.models.fields.files.FieldFile.size', new_callable=PropertyMock,
+                   side_effect=AssertionError('size read from storage')):
+            proc.estimate_duration()
+        self.assertEqual(proc.input_bytes, 500)
+        # Files not indexed yet should be indexed
+        DataProductMetadata.objects.filter(data_product=prods[0]).update(file_size=None)
+        DataProductMetadata.objects.filter(data_product=prods[1]).delete()
+        self.assertEqual(proc.get_input_bytes(), 500)
+        self.assertEqual(DataProductMetadata.objects.get(data_product=prods[1]).file_size, 250)
+        self.assertIsNone(proc.estimated_duration)
+        self.assertEqual(proc.get_time_limit(), 3600)
+
+        # Runs should record their duration
+        with patch.object(ChunkedPipeline, 'memoize', False):
+            proc.run()
+        proc.refresh_from_db()
+        self.assertEqual(proc.started, now_mock.return_value)
+        self.assertEqual(proc.duration, 0)
+
+        for i, duration in enumerate((10, 30)):
+            ChunkedPipeline.objects.create(identifier=f'cost_history{i}', target=self.target,
+                                           status=ASYNC_STATUS_CREATED, input_bytes=1000, duration=duration)
+        # Estimate should include the run above
+        self.assertEqual(ChunkedPipeline.get_seconds_per_byte(), 40 / 2500)
+        self.assertIsNone(FakePipeline.get_seconds_per_byte())
+
+        proc2 = ChunkedPipeline.objects.create(identifier='cost2', target=self.target)
+        proc2.input_files.add(*prods)
+        task_mock = Mock()
+        with self.settings(TOM_EDUCATION_PIPELINE_SETTINGS={'min_time_limit': 1}):
+            send_task(task_mock, proc2, 'chunked')
+        self.assertEqual(proc2.estimated_duration, 8)
+        task_mock.send_with_options.assert_called_once_with(args=(proc2.pk, 'chunked'), time_limit=24_000)
+        # Time limit should not be less than the minimum
+        self.assertEqual(proc2.get_time_limit(), 60)
+
+        proc2.start()
+        response = self.client.get(reverse('tom_education:pipeline_api', kwargs={'pk': proc2.pk}))
+        self.assertEqual(response.json()['eta'], now_mock.return_value.timestamp() + 8)
+
+        # Jobs estimated to take too long should be refused
+        proc3 = ChunkedPipeline.objects.create(identifier='cost3', target=self.target)
+        proc3.input_files.add(*prods)
+        task_mock.reset_mock()
+        with self.settings(TOM_EDUCATION_PIPELINE_SETTINGS={'max_estimated_duration': 5}):
+            send_task(task_mock, proc3, 'chunked')
+        task_mock.send_with_options.assert_not_called()
+        proc3.refresh_from_db()
+        self.assertEqual(proc3.status, ASYNC_STATUS_FAILED)
+        self.assertEqual(proc3.failure_message,
+                         'Estimated run time of 8 seconds is longer than the maximum of 5 seconds')
+
     def test_validate_flags(self):
         invalid = [
             # Wrong type
@@ -1347,14 +2631,14 @@ class PipelineTestCase(TomEducationTestCase):
             proc.run()
 
 
-def mock_write_timelapse(_self, outfile, *args, **kwargs):
+def mock_write_timelapses(_self, outputs, *args, **kwargs):
     pass
 
 
 class TargetDetailApiTestCase(TomEducationTestCase):
     def setUp(self):
         super().setUp()
-        write_timelapse_method = 'tom_education.models.timelapse.TimelapsePipeline.write_timelapse'
+        write_timelapses_method = 'tom_education.models.timelapse.TimelapsePipeline.write_timelapses'
 
         now = datetime.now().timestamp()
         self.target_name = f'target_{now}'
@@ -1396,7 +2680,7 @@ class TargetDetailApiTestCase(TomEducationTestCase):
             target=self.target
         )
         tl_gif_pipeline.input_files.add(dp1, dp2)
-        with patch(write_timelapse_method, mock_write_timelapse):
+        with patch(write_timelapses_method, mock_write_timelapses):
             with self.settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={'format': 'gif'}):
                 tl_gif_pipeline.run()
 
@@ -1408,7 +2692,7 @@ class TargetDetailApiTestCase(TomEducationTestCase):
             target=self.target
         )
         tl_webm_pipeline.input_files.add(dp1)
-        with patch(write_timelapse_method, mock_write_timelapse):
+        with patch(write_timelapses_method, mock_write_timelapses):
             with self.settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={'format': 'webm'}):
                 tl_webm_pipeline.run()
 
@@ -1447,13 +2731,15 @@ class TargetDetailApiTestCase(TomEducationTestCase):
                 'format': 'webm',
                 'url': self.webm_url,
                 'frames': 1,
-                'created': self.webm_creation.timestamp()
+                'created': self.webm_creation.timestamp(),
+                'variants': [{'format': 'webm', 'size': 500, 'url': self.webm_url}],
             }, {
                 'name': 'gif_tl_t.gif',
                 'format': 'gif',
                 'url': self.gif_url,
                 'frames': 2,
-                'created': self.gif_creation.timestamp()
+                'created': self.gif_creation.timestamp(),
+                'variants': [{'format': 'gif', 'size': 500, 'url': self.gif_url}],
             }]
         })
 
@@ -1462,6 +2748,146 @@ class TargetDetailApiTestCase(TomEducationTestCase):
         self.assertEqual(response_404.status_code, 404)
         self.assertEqual(response_404.json(), {'detail': 'Not found.'})
 
+    def test_reused_timelapse(self):
+        def run(tl_settings):
+            pipeline = TimelapsePipeline.objects.create(
+                identifier=f'reuse_tl_{TimelapsePipeline.objects.count()}', target=self.target
+            )
+            pipeline.input_files.add(*DataProduct.objects.filter(product_id__in=['dp1', 'dp2']))
+            with patch('tom_education.models.timelapse.TimelapsePipeline.write_timelapses', mock_write_timelapses):
+                with self.settings(TOM_EDUCATION_TIMELAPSE_SETTINGS=tl_settings):
+                    pipeline.run()
+            return pipeline
+
+        # Settings which do not affect the output should not prevent reuse
+        reused = run({'format': 'gif', 'workers': 2, 'incremental': True})
+        self.assertEqual(reused.reused_from.identifier, 'gif_tl')
+
+        # The reused run should not be listed as another timelapse
+        url = reverse('tom_education:target_api', kwargs={'pk': self.target.pk})
+        timelapses = self.client.get(url).json()['timelapses']
+        self.assertEqual([tl['name'] for tl in timelapses], ['webm_tl_t.webm', 'gif_tl_t.gif'])
+
+        self.assertIsNone(run({'format': 'gif', 'fps': 5}).reused_from)
+
+    def test_timelapse_variants(self):
+        pipeline = TimelapsePipeline.objects.create(identifier='variants_tl', target=self.target)
+        pipeline.input_files.add(*DataProduct.objects.filter(product_id__in=['dp1', 'dp2']))
+        tl_settings = {'outputs': [{'format': 'gif', 'size': 200}, {'format': 'mp4', 'size': 800}]}
+        with patch('tom_education.models.timelapse.TimelapsePipeline.write_timelapses', mock_write_timelapses):
+            with self.settings(TOM_EDUCATION_TIMELAPSE_SETTINGS=tl_settings):
+                pipeline.run()
+
+        url = reverse('tom_education:target_api', kwargs={'pk': self.target.pk})
+        timelapse = self.client.get(url).json()['timelapses'][0]
+        urls = [dp.data.url for dp in pipeline.group.dataproduct_set.order_by('pk')]
+        self.assertEqual((timelapse['name'], timelapse['format'], timelapse['url']),
+                         ('variants_tl_t200.gif', 'gif', urls[0]))
+        self.assertEqual(timelapse['variants'], [
+            {'format': 'gif', 'size': 200, 'url': urls[0]},
+            {'format': 'mp4', 'size': 800, 'url': urls[1]},
+        ])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_query_count_and_cache(self):
+        # setUp runs before the cache is overridden, so clear it here
+        cache.clear()
+        url = reverse('tom_education:target_api', kwargs={'pk': self.target.pk})
+
+        def add_timelapse(identifier):
+            group = DataProductGroup.objects.create(name=f'{identifier} group')
+            dp = DataProduct.objects.create(product_id=f'{identifier} product', target=self.target)
+            dp.data.save(f'{identifier}.gif', File(BytesIO()))
+            dp.group.add(group)
+            tl = TimelapsePipeline.objects.create(
+                identifier=identifier, target=self.target, status=ASYNC_STATUS_CREATED, group=group
+            )
+            tl.input_files.add(dp)
+
+        with CaptureQueriesContext(connection) as queries:
+            response1 = self.client.get(url)
+        self.assertEqual(len(response1.json()['timelapses']), 2)
+
+        # Cached response should not need any queries
+        with self.assertNumQueries(0):
+            response2 = self.client.get(url)
+        self.assertEqual(response2.json(), response1.json())
+
+        # Adding timelapses should clear the cache, and the number of queries
+        # should not depend on the number of timelapses
+        for i in range(3):
+            add_timelapse(f'extra_tl_{i}')
+        with self.assertNumQueries(len(queries)):
+            response3 = self.client.get(url)
+        self.assertEqual([tl['name'] for tl in response3.json()['timelapses']][:3],
+                         ['extra_tl_2.gif', 'extra_tl_1.gif', 'extra_tl_0.gif'])
+        self.assertEqual([tl['frames'] for tl in response3.json()['timelapses']], [1, 1, 1, 1, 2])
+
+        # So should changing the target
+        self.target.name = 'renamed'
+        self.target.save()
+        self.assertEqual(self.client.get(url).json()['target']['name'], 'renamed')
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                       EXTRA_FIELDS=[{'name': 'extrafield', 'type': 'string'}, {'name': 'active', 'type': 'string'}])
+    def test_list_api(self):
+        cache.clear()
+        url = reverse('tom_education:target_list_api')
+        plot = DataProduct.objects.create(product_id='plot', target=self.target, data_product_type='plot')
+        plot.data.save('plot.png', File(BytesIO()))
+        other = Target(name='other target')
+        other.save(extras={'active': 'yes'})
+
+        detail = self.client.get(reverse('tom_education:target_api', kwargs={'pk': self.target.pk})).json()
+        self.assertEqual(detail['data']['plot'], plot.data.url)
+        cache.clear()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'pks': f'{other.pk},{self.target.pk}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 2)
+        self.assertEqual(response.json()['results'], [
+            dict(detail, pk=self.target.pk),
+            {
+                'pk': other.pk,
+                'target': {'name': 'other target', 'extra_fields': {'active': 'yes'}},
+                'timelapses': [],
+                'data': {'csv': detail['data']['csv'].replace(str(self.target.pk), str(other.pk)), 'plot': None},
+            },
+        ])
+
+        # Number of queries should not depend on the number of targets or
+        # timelapses
+        cache.clear()
+        for i in range(3):
+            target = Target.objects.create(name=f'extra target {i}')
+            group = DataProductGroup.objects.create(name=f'group {i}')
+            dp = DataProduct.objects.create(product_id=f'timelapse {i}', target=target)
+            dp.data.save(f'timelapse_{i}.gif', File(BytesIO()))
+            dp.group.add(group)
+            tl = TimelapsePipeline.objects.create(identifier=f'tl {i}', target=target,
+                                                  status=ASYNC_STATUS_CREATED, group=group)
+            tl.input_files.add(dp)
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(url)
+        self.assertEqual(response.json()['count'], 5)
+        self.assertEqual([len(result['timelapses']) for result in response.json()['results']], [2, 0, 1, 1, 1])
+
+        # Cached targets should only need the count and page queries
+        with self.assertNumQueries(2):
+            self.client.get(url)
+
+        # Sparse fields, filtering by extra field and pagination
+        response = self.client.get(url, {'fields': 'timelapses', 'extra_field': 'active', 'extra_value': 'yes'})
+        self.assertEqual(response.json()['results'], [{'pk': other.pk, 'timelapses': []}])
+        response = self.client.get(url, {'page_size': 2, 'page': 3, 'fields': 'target'})
+        self.assertEqual([result['target']['name'] for result in response.json()['results']], ['extra target 2'])
+        self.assertIsNone(response.json()['next'])
+
+        self.assertEqual(self.client.get(url, {'fields': 'target,colour'}).json(),
+                         {'fields': 'Unknown fields: colour'})
+        self.assertEqual(self.client.get(url, {'pks': '1,x'}).status_code, 400)
+
 
 @override_settings(TOM_FACILITY_CLASSES=FAKE_FACILITIES)
 @patch('tom_education.models.ObservationTemplate.get_identifier_field', return_value='test_input')
@@ -1583,7 +3009,7 @@ class ObservationAlertApiTestCase(TomEducationTestCase):
 
 @override_settings(TOM_FACILITY_CLASSES=FAKE_FACILITIES)
 @patch('tom_education.tests.FakeTemplateFacility.save_data_products')
-@patch('tom_education.models.TimelapsePipeline.write_timelapse', mock_write_timelapse)
+@patch('tom_education.models.TimelapsePipeline.write_timelapses', mock_write_timelapses)
 @override_settings(TOM_EDUCATION_FROM_EMAIL_ADDRESS='tom@toolkit.edu')
 class ProcessObservationAlertsTestCase(TomEducationTestCase):
     @classmethod
@@ -1658,6 +3084,23 @@ class ProcessObservationAlertsTestCase(TomEducationTestCase):
         # Should be one (new) timelapse
         self.assertEqual(DataProduct.objects.filter(data_product_type=settings.DATA_PRODUCT_TYPES['timelapse'][0]).count(), 1)
 
+    @override_settings(TOM_EDUCATION_TIMELAPSE_SETTINGS={
+        'outputs': [{'format': 'gif', 'size': 200}, {'format': 'mp4', 'size': 800}]
+    })
+    def test_timelapse_variants_kept(self, save_dp_mock):
+        alert = ObservationAlert.objects.create(observation=self.ob, email='someone@somesite.org')
+        old_tl = DataProduct.objects.create(
+            target=self.target, product_id='oldtimelapse', data_product_type=settings.DATA_PRODUCT_TYPES['timelapse'][0]
+        )
+        call_command('process_observation_alerts')
+        pipeline = TimelapsePipeline.objects.get()
+        # Every variant of the new timelapse should be kept, and only the old
+        # timelapse deleted
+        timelapses = DataProduct.objects.filter(data_product_type=settings.DATA_PRODUCT_TYPES['timelapse'][0])
+        self.assertEqual(timelapses.count(), 2)
+        self.assertEqual(set(timelapses), set(pipeline.group.dataproduct_set.all()))
+        self.assertFalse(DataProduct.objects.filter(pk=old_tl.pk).exists())
+
     @patch('tom_education.models.TimelapsePipeline.create_timestamped',
            wraps=TimelapsePipeline.create_timestamped)
     def test_multiple_alerts_single_target(self, pipeline_mock, save_dp_mock):
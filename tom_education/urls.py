@@ -10,10 +10,14 @@ from tom_education.views import (
     GalleryView,
     ObservationAlertApiCreateView,
     PipelineProcessApi,
+    PipelineProcessCancelApi,
     PipelineProcessDetailView,
     TemplatedObservationCreateView,
     TargetDetailApiView,
+    TargetListApiView,
+    async_status_stream,
     photometry_to_csv,
+    pipeline_process_stream,
 )
 
 app_name = "tom_education"
@@ -34,7 +38,11 @@ urlpatterns = [
 
     # API views
     path('api/async/status/<target>/', AsyncStatusApi.as_view(), name='async_process_status_api'),
+    path('api/async/stream/<int:target>/', async_status_stream, name='async_process_stream'),
     path('api/pipeline/logs/<pk>/', PipelineProcessApi.as_view(), name='pipeline_api'),
+    path('api/pipeline/cancel/<pk>/', PipelineProcessCancelApi.as_view(), name='pipeline_cancel_api'),
+    path('api/pipeline/stream/<int:pk>/', pipeline_process_stream, name='pipeline_stream'),
     path('api/target/<pk>/', TargetDetailApiView.as_view(), name='target_api'),
+    path('api/targets/', TargetListApiView.as_view(), name='target_list_api'),
     path('api/observe/', ObservationAlertApiCreateView.as_view(), name='observe_api'),
 ]
@@ -8,10 +8,17 @@ import logging
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import PermissionDenied
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, OuterRef, Prefetch, Subquery, prefetch_related_objects
 from django.db.utils import IntegrityError
-from django.http import JsonResponse, HttpResponseBadRequest, HttpResponseRedirect, Http404, HttpResponse
+from django.http import (
+    JsonResponse, HttpResponseBadRequest, HttpResponseRedirect, Http404, HttpResponse, StreamingHttpResponse
+)
 from django.shortcuts import redirect, reverse
-from django.utils.http import urlencode
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag, urlencode
 from django.views.generic import FormView, TemplateView
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import FormMixin
@@ -19,19 +26,23 @@ from tom_dataproducts.models import DataProduct, ObservationRecord, ReducedDatum
 from tom_observations.facility import get_service_class
 from tom_observations.views import ObservationCreateView
 from tom_targets.models import (
-    Target, GLOBAL_TARGET_FIELDS, REQUIRED_NON_SIDEREAL_FIELDS,
+    Target, TargetExtra, GLOBAL_TARGET_FIELDS, REQUIRED_NON_SIDEREAL_FIELDS,
     REQUIRED_NON_SIDEREAL_FIELDS_PER_SCHEME
 )
 from tom_targets.views import TargetDetailView, TargetCreateView, TargetUpdateView
-from rest_framework.exceptions import NotFound
-from rest_framework.generics import CreateAPIView, ListAPIView, RetrieveAPIView
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.generics import CreateAPIView, GenericAPIView, ListAPIView, RetrieveAPIView
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.permissions import IsAuthenticated
 from rest_framework import serializers
 from rest_framework.response import Response
 
+from tom_education.events import EventStream, get_event_broker, STREAM_DURATION
 from tom_education.forms import make_templated_form, DataProductActionForm, GalleryForm
 from tom_education.models import (
     AsyncProcess,
     ASYNC_STATUS_CREATED,
+    ASYNC_TERMINAL_STATES,
     ObservationAlert,
     ObservationTemplate,
     PipelineProcess,
@@ -40,14 +51,22 @@ from tom_education.models import (
 from tom_education.serializers import (
     AsyncProcessSerializer,
     ObservationAlertSerializer,
+    PhotometrySerializer,
     PipelineProcessSerializer,
     TargetDetailSerializer,
+    TargetSerializer,
+    TimelapsePipelineSerializer,
     TimestampField,
 )
 from tom_education.tasks import run_pipeline, send_task
 
 logger = logging.getLogger(__name__)
 
+# Seconds for which target detail API responses are cached. Responses are
+# also removed from the cache when they change, so this only limits how long
+# a change that is missed could go unnoticed
+TARGET_API_CACHE_TIMEOUT = 600
+
 class TemplatedObservationCreateView(ObservationCreateView):
     supported_facilities = ('LCO',)
 
@@ -163,12 +182,10 @@ class ActionableTargetDetailView(FormMixin, TargetDetailView):
         self.object = self.get_object()
         context = super().get_context_data(*args, **kwargs)
         context['dataproducts_form'] = self.get_form()
-        context['pipeline_names'] = sorted(PipelineProcess.get_available().keys())
-        context['pipeline_flags'] = {}
-        for name in context['pipeline_names']:
-            pipeline_cls = PipelineProcess.get_subclass(name)
-            if pipeline_cls.flags:
-                context['pipeline_flags'][name] = pipeline_cls.flags
+        registry = PipelineProcess.get_registry()
+        registry.check()
+        context['pipeline_names'] = registry.names
+        context['pipeline_flags'] = registry.flags
 
         return context
 
@@ -302,7 +319,14 @@ class GalleryView(FormView):
 class AsyncStatusApi(ListAPIView):
     """
     View that finds all AsyncProcess objects associated with a specified Target
-    and returns the listing in a JSON response
+    and returns the listing in a JSON response.
+
+    If the 'since' query parameter is given (the 'timestamp' from a previous
+    response), only processes created or changed since then are included.
+    Responses have an ETag which changes whenever any of the target's
+    processes change (or 'since' changes), and full listings have a
+    Last-Modified date, so polling clients can use If-None-Match or
+    If-Modified-Since to get a 304 response when there is nothing new
     """
     serializer_class = AsyncProcessSerializer
 
@@ -311,13 +335,57 @@ class AsyncStatusApi(ListAPIView):
             target = Target.objects.get(pk=self.kwargs['target'])
         except Target.DoesNotExist:
             raise Http404
-        return AsyncProcess.objects.filter(target=target).order_by('-created')
+        # Fetch the PipelineProcess child rows in the same query, since the
+        # serializer uses them to find the view URL and ETA of each process
+        return (AsyncProcess.objects.filter(target=target).select_related('pipelineprocess')
+                .order_by('-created'))
+
+    def get_since(self):
+        """
+        Return the datetime given by the 'since' query parameter, or None
+        """
+        since = self.request.query_params.get('since')
+        if since is None:
+            return None
+        try:
+            since = float(since)
+        except ValueError:
+            raise ValidationError({'since': 'Must be a timestamp'})
+        if settings.USE_TZ:
+            return datetime.fromtimestamp(since, tz=timezone.utc)
+        return datetime.fromtimestamp(since)
 
     def list(self, request, *args, **kwargs):
+        # Take the timestamp before querying, so that processes changed while
+        # the response is prepared are included in the next 'since' response
+        timestamp = TimestampField().to_representation(datetime.now())
+        since = self.get_since()
         queryset = self.filter_queryset(self.get_queryset())
+
+        # The body depends on 'since' as well as the processes, so it is part
+        # of the ETag. Last-Modified cannot include it, so is only used for
+        # full listings
+        state = queryset.aggregate(count=Count('pk'), last_modified=Max('modified'))
+        last_modified = state['last_modified'].timestamp() if state['last_modified'] else None
+        since_value = since.timestamp() if since is not None else None
+        etag = quote_etag(f'{since_value}-{state["count"]}-{last_modified}')
+        if since is not None or last_modified is None:
+            validator_date = None
+        else:
+            # HTTP dates only have a precision of seconds
+            validator_date = int(last_modified)
+        not_modified = get_conditional_response(request, etag=etag, last_modified=validator_date)
+        if not_modified is not None:
+            return not_modified
+
+        if since is not None:
+            queryset = queryset.filter(modified__gte=since)
         serializer = self.get_serializer(queryset, many=True)
-        timestamp = TimestampField().to_representation(datetime.now())
-        return Response({'timestamp': timestamp, 'processes': serializer.data})
+        response = Response({'timestamp': timestamp, 'processes': serializer.data})
+        response['ETag'] = etag
+        if validator_date is not None:
+            response['Last-Modified'] = http_date(validator_date)
+        return response
 
 
 class PipelineProcessDetailView(DetailView):
@@ -332,11 +400,95 @@ class PipelineProcessDetailView(DetailView):
 
 class PipelineProcessApi(RetrieveAPIView):
     """
-    Return information about a PipelineProcess in a JSON response
+    Return information about a PipelineProcess in a JSON response. If the
+    'offset' query parameter is given, only log lines from that offset
+    onwards are included
     """
     queryset = PipelineProcess.objects.all()
     serializer_class = PipelineProcessSerializer
 
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        try:
+            offset = int(self.request.query_params.get('offset', 0))
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            raise ValidationError({'offset': 'Must be a non-negative integer'})
+        context['log_offset'] = offset
+        return context
+
+
+class CanRunTargetProcesses(IsAuthenticated):
+    """
+    Allow authenticated users who can view the target a process belongs to,
+    which is the permission needed to start processes from the target page.
+    Processes with no target can only be managed by superusers
+    """
+    def has_object_permission(self, request, view, obj):
+        if obj.target is None:
+            return request.user.is_superuser
+        return request.user.has_perm('tom_targets.view_target', obj.target)
+
+
+class PipelineProcessCancelApi(GenericAPIView):
+    """
+    Request cancellation of a PipelineProcess. The process stops at its next
+    cancellation checkpoint, and its status is then set to 'cancelled'.
+    Returns information about the process as for PipelineProcessApi
+    """
+    queryset = PipelineProcess.objects.all()
+    serializer_class = PipelineProcessSerializer
+    permission_classes = [CanRunTargetProcesses]
+
+    def post(self, request, *args, **kwargs):
+        process = self.get_object()
+        if process.status in ASYNC_TERMINAL_STATES:
+            raise ValidationError({'status': 'Process has already finished'})
+        process.request_cancel()
+        return Response(self.get_serializer(process).data)
+
+
+def event_stream_response(channels):
+    """
+    Return a response which streams events published on `channels` as
+    server-sent events. Raises Http404 if events are not enabled, so that
+    clients fall back to polling.
+
+    The stream holds a web server worker (thread or greenlet) until it ends
+    after the 'event_stream_duration' pipeline setting, so servers must use
+    workers which can be held open (see the deployment notes in the docs)
+    """
+    broker = get_event_broker()
+    if broker is None:
+        raise Http404('Event streams are not enabled')
+    duration = PipelineProcess.get_pipeline_settings().get('event_stream_duration', STREAM_DURATION)
+    stream = EventStream(broker.subscribe(channels), duration=duration)
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def async_status_stream(request, target):
+    """
+    Stream 'status' events when any AsyncProcess for a target is created or
+    changes status
+    """
+    if not Target.objects.filter(pk=target).exists():
+        raise Http404
+    return event_stream_response([f'target.{target}'])
+
+
+def pipeline_process_stream(request, pk):
+    """
+    Stream 'status' and 'log' events for a PipelineProcess
+    """
+    if not PipelineProcess.objects.filter(pk=pk).exists():
+        raise Http404
+    return event_stream_response([f'process.{pk}'])
+
 
 @dataclass
 class TargetDetailApiInfo:
@@ -349,10 +501,45 @@ class TargetDetailApiInfo:
     data: Target
 
 
+def get_timelapses(targets):
+    """
+    Return a queryset of the finished timelapses for any of `targets`, most
+    recent first. Runs which reused the outputs of a previous run are
+    excluded, since the original run already lists the same files.
+
+    The group and timelapse file for all timelapses are fetched up front and
+    frames are counted in the same query, so that the number of queries does
+    not depend on the number of timelapses
+    """
+    return TimelapsePipeline.objects.filter(
+        target__in=targets, group__dataproduct__target__isnull=False,
+        status=ASYNC_STATUS_CREATED,
+        process_type='TimelapsePipeline',
+        reused_from__isnull=True
+    ).annotate(
+        frame_count=Count('input_files', distinct=True)
+    ).select_related('group').prefetch_related('group__dataproduct_set').order_by('-terminal_timestamp')
+
+
+def get_target_api_cache_key(target_pk):
+    return f'tom_education:target_api:{target_pk}'
+
+
+def clear_target_api_cache(target_pk):
+    """
+    Remove the cached target detail API response for a target, so that it is
+    generated again on the next request
+    """
+    cache.delete(get_target_api_cache_key(target_pk))
+
+
 class TargetDetailApiView(RetrieveAPIView):
     """
     Return information about a target and its timelapses, and return a JSON
-    response
+    response.
+
+    Responses are cached for each target, and the cache is cleared when the
+    target, its data products or its processes change (see signals.py)
     """
     serializer_class = TargetDetailSerializer
     # Note: we specify a Target queryset to make use of rest_framework methods
@@ -362,12 +549,123 @@ class TargetDetailApiView(RetrieveAPIView):
 
     def get_object(self):
         target = super().get_object()
-        tl_pipelines = TimelapsePipeline.objects.filter(
-            target=target, group__dataproduct__target__isnull=False,
-            status=ASYNC_STATUS_CREATED,
-            process_type='TimelapsePipeline'
-        ).order_by('-terminal_timestamp')
-        return TargetDetailApiInfo(target=target, timelapses=tl_pipelines, data=target)
+        return TargetDetailApiInfo(target=target, timelapses=get_timelapses([target]), data=target)
+
+    def retrieve(self, request, *args, **kwargs):
+        key = get_target_api_cache_key(self.kwargs['pk'])
+        data = cache.get(key)
+        if data is None:
+            data = super().retrieve(request, *args, **kwargs).data
+            cache.set(key, data, TARGET_API_CACHE_TIMEOUT)
+        return Response(data)
+
+
+class TargetListApiPagination(PageNumberPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class TargetListApiView(ListAPIView):
+    """
+    Return the information given by TargetDetailApiView for several targets
+    in a paginated JSON response. Targets can be selected by PK with the
+    'pks' query parameter, or by extra field with 'extra_field' and
+    (optionally) 'extra_value'. The 'fields' query parameter selects which of
+    the parts of the response for each target are included.
+
+    The same cache is used as for TargetDetailApiView, and the remaining
+    targets on each page are serialized with a fixed number of queries
+    """
+    pagination_class = TargetListApiPagination
+    fields = ('target', 'timelapses', 'data')
+
+    def get_queryset(self):
+        targets = Target.objects.order_by('pk')
+        params = self.request.query_params
+        if 'pks' in params:
+            try:
+                pks = [int(pk) for pk in params['pks'].split(',') if pk]
+            except ValueError:
+                raise ValidationError({'pks': 'Must be a comma-separated list of target IDs'})
+            targets = targets.filter(pk__in=pks)
+        if 'extra_field' in params:
+            extras = TargetExtra.objects.filter(key=params['extra_field'])
+            if 'extra_value' in params:
+                extras = extras.filter(value=params['extra_value'])
+            targets = targets.filter(pk__in=extras.values('target'))
+        return targets
+
+    def get_fields(self):
+        """
+        Return the list of fields requested with the 'fields' query parameter
+        """
+        if 'fields' not in self.request.query_params:
+            return list(self.fields)
+        fields = list(dict.fromkeys(field for field in self.request.query_params['fields'].split(',') if field))
+        unknown = set(fields) - set(self.fields)
+        if unknown:
+            raise ValidationError({'fields': f'Unknown fields: {", ".join(sorted(unknown))}'})
+        return fields
+
+    def list(self, request, *args, **kwargs):
+        fields = self.get_fields()
+        targets = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+
+        keys = {target.pk: get_target_api_cache_key(target.pk) for target in targets}
+        cached = cache.get_many(list(keys.values()))
+        uncached = [target for target in targets if keys[target.pk] not in cached]
+        serialized = self.serialize_targets(uncached, fields) if uncached else {}
+        # Only complete responses can be reused by TargetDetailApiView
+        if set(fields) == set(self.fields):
+            cache.set_many({keys[pk]: data for pk, data in serialized.items()}, TARGET_API_CACHE_TIMEOUT)
+
+        results = []
+        for target in targets:
+            data = cached.get(keys[target.pk]) or serialized[target.pk]
+            results.append(dict({'pk': target.pk}, **{field: data[field] for field in fields}))
+        return self.get_paginated_response(results)
+
+    def serialize_targets(self, targets, fields):
+        """
+        Return a dict mapping target PKs to the TargetDetailApiView response
+        for each of `targets`, containing only the keys in `fields`. Related
+        objects are fetched for all targets together
+        """
+        context = self.get_serializer_context()
+        serialized = {target.pk: {} for target in targets}
+
+        if 'target' in fields:
+            prefetch_related_objects(targets, Prefetch(
+                'targetextra_set',
+                queryset=TargetExtra.objects.filter(key__in=[f['name'] for f in settings.EXTRA_FIELDS]),
+                to_attr='defined_extras'
+            ))
+            for target in targets:
+                serialized[target.pk]['target'] = TargetSerializer(target, context=context).data
+
+        if 'timelapses' in fields:
+            timelapses = {target.pk: [] for target in targets}
+            for timelapse in get_timelapses(targets):
+                timelapses[timelapse.target_id].append(timelapse)
+            for target in targets:
+                serialized[target.pk]['timelapses'] = TimelapsePipelineSerializer(
+                    timelapses[target.pk], many=True, context=context
+                ).data
+
+        if 'data' in fields:
+            latest_plots = Subquery(
+                DataProduct.objects.filter(target=OuterRef('pk'), data_product_type='plot')
+                .order_by('-created').values('pk')[:1]
+            )
+            plot_pks = dict(Target.objects.filter(pk__in=list(serialized)).annotate(plot_pk=latest_plots)
+                            .values_list('pk', 'plot_pk'))
+            plots = DataProduct.objects.in_bulk([pk for pk in plot_pks.values() if pk is not None])
+            for target in targets:
+                target.latest_plot = plots.get(plot_pks[target.pk])
+                serialized[target.pk]['data'] = PhotometrySerializer(target, context=context).data
+
+        return serialized
 
 
 class ObservationAlertApiCreateView(CreateAPIView):